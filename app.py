@@ -1,15 +1,18 @@
 """App design"""
 import logging.config
+import time
 import traceback
-import re
 import os
 
 import sqlalchemy.exc
-from flask import Flask, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 from wtforms import SelectField
 from flask_wtf import FlaskForm
 
-from src.add_products import Product, ProductManager
+from src.add_products import InputItem, ModelVersion, Product, ProductManager
+from src.cache import LRUCache
+from src.instrument import REGISTRY, instrument
+from src.online_index import OnlineRecommender
 
 # Initialize the Flask application
 app = Flask(__name__, template_folder="app/templates", static_folder="app/static")
@@ -35,29 +38,110 @@ logger.debug(
 # Initialize the database session
 product_manager = ProductManager(app)
 
+# Cache recommendations per item and the dropdown choices until a new model is ingested
+recommendation_cache = LRUCache(app.config["CACHE_MAX_ITEMS"], app.config["CACHE_TTL_SECONDS"])
+choices_cache = LRUCache(1, app.config["CACHE_TTL_SECONDS"])
+cache_state = {"version": None, "checked_at": float("-inf")}
+
+# Load the model, item matrix and product metadata once for the online API
+try:
+    online_recommender = OnlineRecommender(app.config["ONLINE_PRODUCT_PATH"],
+                                           app.config["ONLINE_CSR_MAT_PATH"],
+                                           app.config["ONLINE_MODEL_PATH"],
+                                           app.config["ONLINE_ITEM_COL"])
+except FileNotFoundError as err:
+    logger.warning("Model artifacts are not found, the online recommendation API is "
+                   "disabled: %s", err)
+    online_recommender = None
+
 
 class Form(FlaskForm):
     """Format form for user input"""
     itemid = SelectField("input_itemid", choices=[])
 
 
+def check_model_version():
+    """Drop cached results if a new model version was ingested since the last check"""
+    now = time.monotonic()
+    if now - cache_state["checked_at"] < app.config["CACHE_VERSION_CHECK_SECONDS"]:
+        return
+    cache_state["checked_at"] = now
+    version = query_model_version()
+    if version != cache_state["version"]:
+        if cache_state["version"] is not None:
+            logger.info("Model version changed to %s, clearing caches.", version)
+        recommendation_cache.clear()
+        choices_cache.clear()
+        cache_state["version"] = version
+
+
+def query_model_version():
+    """Query the id of the ingested model version, None for a database created before
+    model versions were recorded, so that the caches are not dropped"""
+    try:
+        return product_manager.session.query(ModelVersion.version).scalar()
+    except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+        product_manager.session.rollback()
+        if has_table(ModelVersion):
+            raise
+        logger.warning("The %s table is not in the database, so cached results are kept "
+                       "until they expire. Run `python run.py create_db` to add it.",
+                       ModelVersion.__tablename__)
+        return None
+
+
+def has_table(model):
+    """Check if the table of a data model is in the database"""
+    return sqlalchemy.inspect(product_manager.session.connection()) \
+        .has_table(model.__tablename__)
+
+
+def query_choices():
+    """Query the input item ids for the dropdown, from the products themselves on a
+    database that was ingested before the input_items table was filled"""
+    itemids = []
+    if has_table(InputItem):
+        itemids = product_manager.session.query(InputItem.input_itemid) \
+            .order_by(InputItem.input_itemid).all()
+    if not itemids:
+        itemids = product_manager.session.query(Product.input_itemid).distinct() \
+            .order_by(Product.input_itemid).all()
+    return [str(itemid) for itemid, in itemids]
+
+
+def query_products(input_itemid):
+    """Query the recommendations of an input item as plain records"""
+    products = product_manager.session.query(Product) \
+        .filter_by(input_itemid=input_itemid).order_by(Product.rank) \
+        .limit(app.config["MAX_ROWS_SHOW"]).all()
+    return [{column.name: getattr(product, column.name)
+             for column in Product.__table__.columns} for product in products]
+
+
 @app.route("/")
+@instrument("app.index")
 def index():
     """Format options for input in form"""
     form = Form()
-    form.itemid.choices = [re.sub(r"[^\w]", "", str(itemid)) for itemid in
-                           product_manager.session.query(Product.input_itemid).distinct()]
+    try:
+        check_model_version()
+        form.itemid.choices = choices_cache.get_or_compute("choices", query_choices)
+    except sqlalchemy.exc.OperationalError:
+        traceback.print_exc()
+        return render_template("error.html")
     return render_template("index.html", form=form)
 
 
 @app.route("/", methods=["POST"])
+@instrument("app.data")
 def data():
     """Format output page with user input"""
     if request.method == "POST":
         input_itemid = request.form.to_dict()["itemid"]
         try:
-            products = product_manager.session.query(Product) \
-                .filter_by(input_itemid=input_itemid).limit(app.config["MAX_ROWS_SHOW"]).all()
+            check_model_version()
+            products = recommendation_cache.get_or_compute(
+                input_itemid, lambda: query_products(input_itemid))
             if len(products) != 0:
                 return render_template("recommend.html", products=products,
                                        input_itemid=input_itemid)
@@ -67,5 +151,40 @@ def data():
             return render_template("error.html")
 
 
+@app.route("/api/cache")
+@instrument("app.cache_stats")
+def cache_stats():
+    """Report the size and hit/miss counters of the response caches"""
+    return jsonify(model_version=cache_state["version"],
+                   recommendations=recommendation_cache.stats(),
+                   choices=choices_cache.stats())
+
+
+@app.route("/api/recommend/<int:itemid>")
+@instrument("app.recommend")
+def recommend(itemid):
+    """Recommend products similar to any item from the in-memory index"""
+    if online_recommender is None:
+        return jsonify(error="The online recommendation index is not loaded."), 503
+    k = request.args.get("k", default=app.config["ONLINE_DEFAULT_K"], type=int)
+    if k is None or not 0 < k <= app.config["ONLINE_MAX_K"]:
+        return jsonify(error=f"k has to be an integer between 1 and "
+                             f"{app.config['ONLINE_MAX_K']}."), 400
+    try:
+        products = online_recommender.recommend(itemid, k)
+    except KeyError:
+        return jsonify(error=f"Item {itemid} is not in the index."), 404
+    return jsonify(input_itemid=itemid, k=k, recommendations=products)
+
+
+@app.route("/metrics")
+def metrics():
+    """Expose the call totals of the pipeline functions and routes run by this process in
+    the Prometheus text format"""
+    if not app.config["METRICS_ENABLED"]:
+        return jsonify(error="Metrics are disabled."), 404
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     app.run(debug=app.config["DEBUG"], port=app.config["PORT"], host=app.config["HOST"])
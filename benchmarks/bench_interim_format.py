@@ -0,0 +1,111 @@
+"""Benchmark the model pipeline with csv, Parquet and Feather interim files
+
+Generates synthetic raw data, then runs every stage of `run_model.sh` once per interim
+format, with the interim and model paths of `config/model_config.yaml` pointed at a
+temporary directory, and times each stage.
+
+    python -m benchmarks.bench_interim_format --products 20000 --reviews 1000000
+"""
+import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import yaml
+
+from benchmarks.synthetic import write_raw_data
+
+STAGES = ["preprocess_products", "preprocess_reviews", "truncate_reviews",
+          "get_csr_matrix", "fit_model", "recommend"]
+INTERIM_TABLES = {
+    ("preprocess_products", "save_product_data", "output_path"): "processed_products",
+    ("preprocess_reviews", "save_review_data", "output_path"): "processed_reviews",
+    ("truncate_reviews", "save_truncated_review_data", "output_path"): "truncated_reviews",
+    ("truncate_reviews", "truncate_reviews", "review_path"): "processed_reviews",
+    ("truncate_reviews", "truncate_reviews", "product_path"): "processed_products",
+    ("get_csr_matrix", "get_csr_matrix", "review_data_path"): "truncated_reviews",
+    ("recommend_products", "recommend_items", "product_path"): "processed_products",
+}
+INTERIM_FILES = {
+    ("get_csr_matrix", "save_csr_matrix", "output_path"): "csr_matrix.npz",
+    ("fit_model", "fit_model", "csr_mat_path"): "csr_matrix.npz",
+    ("fit_model", "fit_model", "output_path"): "model",
+    ("recommend_products", "recommend_items", "csr_mat_path"): "csr_matrix.npz",
+    ("recommend_products", "recommend_items", "model_path"): "model",
+    ("recommend_products", "recommend_items", "neighbors_path"): "neighbors.npy",
+    ("recommend_products", "recommend_items", "scores_path"): "scores.npy",
+    ("recommend_products", "recommend_items", "store_path"): "neighbors",
+    ("recommend_products", "save_recommendations", "output_path"): "recommendations.csv",
+}
+
+
+def make_config(config: dict, extension: str, product_path: str, review_path: str,
+                output_dir: str) -> dict:
+    """Point a model configuration at synthetic raw data and a scratch output directory"""
+    config = copy.deepcopy(config)
+    config["preprocess_products"]["get_product_features"]["input_path"] = product_path
+    config["preprocess_reviews"]["get_review_features"]["input_path"] = review_path
+    for (section, function, key), name in INTERIM_TABLES.items():
+        config[section][function][key] = os.path.join(output_dir, name + extension)
+    for (section, function, key), name in INTERIM_FILES.items():
+        config[section][function][key] = os.path.join(output_dir, name)
+    return config
+
+
+def time_stages(config_path: str) -> dict:
+    """Run every pipeline stage in its own process and time it, in seconds"""
+    timings = {}
+    for stage in STAGES:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "run.py", "model", stage, "--config_file", config_path],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings[stage] = time.perf_counter() - start
+    timings["total"] = sum(timings.values())
+    return timings
+
+
+def main():
+    """Run the pipeline once per interim format and print one row per format"""
+    parser = argparse.ArgumentParser(description="Benchmark interim file formats")
+    parser.add_argument("--products", type=int, default=20000, help="number of products")
+    parser.add_argument("--reviews", type=int, default=1000000, help="number of reviews")
+    parser.add_argument("--formats", nargs="+", default=[".csv", ".parquet", ".feather"],
+                        help="interim file extensions to compare")
+    parser.add_argument("--config_file", default="config/model_config.yaml",
+                        help="model configuration to start from")
+    parser.add_argument("--output", default=None, help="path to also write results as json")
+    args = parser.parse_args()
+
+    with open(args.config_file, "r", encoding="ASCII") as f:
+        base_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        product_path, review_path = write_raw_data(os.path.join(tmp_dir, "raw"),
+                                                   args.products, args.reviews)
+        for extension in args.formats:
+            output_dir = os.path.join(tmp_dir, extension.lstrip("."))
+            os.makedirs(output_dir)
+            config_path = os.path.join(output_dir, "model_config.yaml")
+            with open(config_path, "w", encoding="ASCII") as f:
+                yaml.dump(make_config(base_config, extension, product_path, review_path,
+                                      output_dir), f)
+            timings = time_stages(config_path)
+            interim_mb = sum(os.path.getsize(os.path.join(output_dir, name + extension))
+                             for name in set(INTERIM_TABLES.values())) / 2 ** 20
+            results.append({"format": extension.lstrip("."), "interim_mb": interim_mb,
+                            **timings})
+
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
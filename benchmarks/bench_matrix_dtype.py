@@ -0,0 +1,71 @@
+"""Benchmark the ratings matrix saved as float64, float32 and int8
+
+Encodes synthetic reviews into a sparse matrix, converts it to every dtype the same way
+`save_csr_matrix` does, and reports the size of the matrix, the time of the blocked
+top-k search on the ratings read back, and how many top-k neighbor lists differ from
+the float64 ones.
+
+    python -m benchmarks.bench_matrix_dtype --products 20000 --reviews 1000000 --users 200000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+from benchmarks.synthetic import make_reviews
+from src.get_csr_matrix import DTYPES, convert_matrix, encode_ratings, restore_matrix
+from src.similarity import blocked_top_k
+
+
+def matrix_mb(mat, scale) -> float:
+    """Size of the arrays a matrix is saved as, in megabytes"""
+    arrays = [mat.data, mat.indices, mat.indptr] if sp.issparse(mat) else [mat]
+    if scale is not None:
+        arrays.append(scale)
+    return sum(array.nbytes for array in arrays) / 2 ** 20
+
+
+def main():
+    """Search the top-k neighbors once per dtype and print one row per dtype"""
+    parser = argparse.ArgumentParser(description="Benchmark ratings matrix dtypes")
+    parser.add_argument("--products", type=int, default=20000, help="number of products")
+    parser.add_argument("--reviews", type=int, default=1000000, help="number of reviews")
+    parser.add_argument("--users", type=int, default=200000,
+                        help="number of distinct reviewers")
+    parser.add_argument("--k", type=int, default=7, help="number of recommendations")
+    parser.add_argument("--block_size", type=int, default=1024, help="query rows per block")
+    parser.add_argument("--output", default=None, help="path to also write results as json")
+    args = parser.parse_args()
+
+    item_ids = 10 ** 8 + np.arange(args.products)
+    reviews = make_reviews(args.reviews, item_ids, n_users=args.users, unknown_share=0)
+    mat = encode_ratings(reviews, "itemid", "cmtid", "rating_star", sparse=True)
+
+    results, reference = [], None
+    for dtype in DTYPES:
+        converted, scale = convert_matrix(mat, dtype)
+        ratings = restore_matrix(converted, scale)
+        start = time.perf_counter()
+        indices, _ = blocked_top_k(ratings, args.k + 1, args.block_size)
+        search_s = time.perf_counter() - start
+        if reference is None:
+            reference = indices
+        results.append({
+            "dtype": dtype, "matrix_mb": matrix_mb(converted, scale),
+            "values_mb": converted.data.nbytes / 2 ** 20, "search_s": search_s,
+            "reordered_lists": int((indices != reference).any(axis=1).sum()),
+            "changed_lists": int((np.sort(indices, axis=1)
+                                  != np.sort(reference, axis=1)).any(axis=1).sum()),
+            "items": mat.shape[0]})
+
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark the web app queries on the products table against table size
+
+Builds sqlite databases of synthetic recommendations, with and without the
+(input_itemid, rank) index, and times the recommendation lookup and the dropdown
+query of `app.py`.
+
+    python -m benchmarks.bench_product_lookup --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from src.add_products import InputItem, Product, ProductManager, create_db
+
+
+def make_recommendations(n_rows: int, k: int = 7, seed: int = 42) -> pd.DataFrame:
+    """Generate synthetic recommendations with the schema of models/recommendations.csv"""
+    rng = np.random.default_rng(seed)
+    n_items = max(n_rows // k, 1)
+    item_ids = rng.choice(10 ** 10, n_items, replace=False)
+    n_rows = n_items * k
+    return pd.DataFrame({
+        "input_itemid": np.repeat(item_ids, k),
+        "rank": np.tile(np.arange(1, k + 1), n_items),
+        "product_itemid": rng.choice(item_ids, n_rows),
+        "product_category": rng.choice(["Top", "Crop Top", "Long Sleeves"], n_rows),
+        "product_name": "korean fashion knitted blouse top",
+        "avg_price": rng.uniform(100, 1000, n_rows).round(2),
+        "avg_discount": rng.integers(0, 90, n_rows).astype(float),
+        "like_count": rng.integers(0, 10000, n_rows),
+        "comment_count": rng.integers(0, 1000, n_rows),
+        "product_views": rng.integers(0, 100000, n_rows),
+        "avg_rating": rng.uniform(1, 5, n_rows).round(2),
+        "units_sold": rng.integers(0, 10000, n_rows),
+    }).sample(frac=1, random_state=seed)
+
+
+def time_queries(engine_string: str, item_ids: np.ndarray, n_queries: int) -> dict:
+    """Time recommendation lookups and the dropdown queries, in milliseconds"""
+    session = sessionmaker(bind=create_engine(engine_string))()
+    lookups = []
+    for itemid in item_ids[:n_queries]:
+        start = time.perf_counter()
+        session.query(Product).filter_by(input_itemid=int(itemid)) \
+            .order_by(Product.rank).limit(100).all()
+        lookups.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    session.execute(select(Product.input_itemid).distinct()).all()
+    distinct_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    session.execute(select(InputItem.input_itemid)).all()
+    input_items_ms = (time.perf_counter() - start) * 1000
+    session.close()
+    return {"lookup_p50_ms": np.percentile(lookups, 50),
+            "lookup_p99_ms": np.percentile(lookups, 99),
+            "distinct_ms": distinct_ms, "input_items_ms": input_items_ms}
+
+
+def main():
+    """Run the benchmark for every table size and print one row per configuration"""
+    parser = argparse.ArgumentParser(description="Benchmark products table lookups")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="number of rows in the products table")
+    parser.add_argument("--queries", type=int, default=200,
+                        help="number of lookups to time per table")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in args.sizes:
+            data = make_recommendations(n_rows)
+            csv_path = os.path.join(tmp_dir, "recommendations.csv")
+            data.to_csv(csv_path, index=False)
+            for indexed in (False, True):
+                engine_string = f"sqlite:///{tmp_dir}/products_{n_rows}_{indexed}.db"
+                create_db(engine_string)
+                if not indexed:
+                    for index in Product.__table__.indexes:
+                        index.drop(create_engine(engine_string))
+                product_manager = ProductManager(engine_string=engine_string)
+                product_manager.add_products(csv_path, batch_size=50000)
+                product_manager.close()
+                timings = time_queries(engine_string, data["input_itemid"].unique(),
+                                       args.queries)
+                results.append({"rows": len(data), "indexed": indexed, **timings})
+
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
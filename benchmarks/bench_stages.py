@@ -0,0 +1,295 @@
+"""Benchmark every model pipeline function and the web app lookups at several data scales
+
+For every number of reviews, synthetic raw data is generated with `benchmarks.synthetic`,
+the stages of `run_model.sh` are run in this process with the configuration of
+`config/model_config.yaml` pointed at a temporary directory, and every function call is
+timed and memory-profiled. The recommendations are then ingested with `add_products`
+and looked up through the Flask app. Results are written as json, so that two runs, e.g.
+on two commits, can be compared:
+
+    python -m benchmarks.bench_stages --reviews 10000 100000 1000000 --output before.json
+    python -m benchmarks.bench_stages --reviews 10000 100000 1000000 --output after.json
+    python -m benchmarks.bench_stages --compare before.json after.json
+
+Peak memory is the peak resident set size of the process during the call, reset before
+every call through `/proc/self/clear_refs` on Linux. Elsewhere it falls back to the peak
+of the whole process so far.
+"""
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy
+import sklearn
+import yaml
+
+from benchmarks.bench_interim_format import make_config
+from benchmarks.synthetic import write_raw_data
+from src import preprocess_products, preprocess_reviews, truncate_reviews
+from src.add_products import Product, ProductManager, create_db
+from src.fit_model import fit_model
+from src.get_csr_matrix import get_csr_matrix, save_csr_matrix
+from src.instrument import status_mb, track
+from src.online_index import OnlineRecommender
+from src.recommend_products import recommend_items, save_recommendations
+
+# a result is identified by its scale and function
+KEYS = ["reviews", "products", "function"]
+
+
+def measure(function: str, func: Callable, *args: Any, **kwargs: Any) -> Tuple[Any, dict]:
+    """Call a function and record its wall time and peak memory
+
+    Args:
+        function (`str`): name to record the call under
+        func (`Callable`): function to call
+        *args: positional arguments of the function
+        **kwargs: keyword arguments of the function
+
+    Returns:
+        result (`Any`): return value of the function
+        record (`dict`): `function`, `seconds`, `peak_rss_mb`, the peak resident set
+            size during the call, and `rss_increase_mb`, the peak over the resident set
+            size before the call
+    """
+    gc.collect()
+    rss_before = status_mb("VmRSS")
+    start = time.perf_counter()
+    # measured as a call of its own, so the instrumented functions it calls keep its peak
+    with track("benchmark." + function) as call:
+        result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = call["peak_rss_mb"]
+    return result, {"function": function, "seconds": seconds, "peak_rss_mb": peak,
+                    "rss_increase_mb": None if rss_before is None else peak - rss_before}
+
+
+def bench_pipeline(config: dict) -> List[dict]:
+    """Run the model pipeline stage by stage and measure every function
+
+    Streamed product and review features are read into lists of chunks, so that reading
+    them is measured apart from aggregating them.
+
+    Args:
+        config (`dict`): model configuration with every path in a scratch directory
+
+    Returns:
+        records (:obj:`list` of `dict`): one record per function, see :func:`measure`
+    """
+    records = []
+
+    def run(function: str, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        result, record = measure(function, func, *args, **kwargs)
+        records.append(record)
+        return result
+
+    section = config["preprocess_products"]
+    products = run("get_product_features", lambda: _materialize(
+        preprocess_products.get_product_features(**section["get_product_features"])))
+    products = run("get_aggregated_features", preprocess_products.get_aggregated_features,
+                   products, **section["get_aggregated_features"])
+    records[-1]["rows"] = len(products)
+    preprocess_products.save_product_data(products, **section["save_product_data"])
+    del products
+
+    section = config["preprocess_reviews"]
+    reviews = run("get_review_features", preprocess_reviews.get_review_features,
+                  **section["get_review_features"])
+    records[-1]["rows"] = len(reviews)
+    preprocess_reviews.save_review_data(reviews, **section["save_review_data"])
+    del reviews
+
+    # truncated chunks are streamed, so reading, filtering and writing them is one call
+    section = config["truncate_reviews"]
+    run("truncate_reviews", lambda: truncate_reviews.save_truncated_review_data(
+        truncate_reviews.truncate_reviews(**section["truncate_reviews"]),
+        **section["save_truncated_review_data"]))
+
+    section = config["get_csr_matrix"]
+    mat, item_ids, user_ids = run("get_csr_matrix", get_csr_matrix,
+                                  **section["get_csr_matrix"], return_ids=True)
+    records[-1]["rows"], records[-1]["nnz"] = mat.shape[0], int(mat.nnz)
+    run("save_csr_matrix", save_csr_matrix, mat, **section["save_csr_matrix"],
+        item_ids=item_ids, user_ids=user_ids)
+    del mat, item_ids, user_ids
+
+    run("fit_model", fit_model, **config["fit_model"]["fit_model"])
+    section = config["recommend_products"]
+    recommendations = run("recommend_items", recommend_items, **section["recommend_items"])
+    records[-1]["rows"] = len(recommendations)
+    save_recommendations(recommendations, **section["save_recommendations"])
+    return records
+
+
+def _materialize(data: Any) -> Any:
+    """Read every chunk of a streamed table, or return a dataframe as it is"""
+    return data if isinstance(data, pd.DataFrame) else list(data)
+
+
+def bench_web(config: dict, engine_string: str, n_queries: int) -> List[dict]:
+    """Ingest the recommendations and time lookups through the Flask app
+
+    The app is imported on the first call, with `engine_string` as its database, so
+    every later call has to use the same database. Its products table is emptied
+    before every ingest.
+
+    Args:
+        config (`dict`): model configuration the pipeline was run with
+        engine_string (`str`): SQLAlchemy engine string of the app database
+        n_queries (`int`): number of items to look up
+
+    Returns:
+        records (:obj:`list` of `dict`): one record per function, with the median and
+            99th percentile latency of the lookups in milliseconds
+    """
+    os.environ["SQLALCHEMY_DATABASE_URI"] = engine_string
+    import app as web  # pylint: disable=import-outside-toplevel
+
+    recommendations_path = config["recommend_products"]["save_recommendations"]["output_path"]
+    manager = ProductManager(engine_string=engine_string)
+    manager.session.execute(Product.__table__.delete())
+    manager.session.commit()
+    _, record = measure("add_products", manager.add_products, recommendations_path, 10000)
+    record["rows"] = manager.session.query(Product).count()
+    manager.close()
+    records = [record]
+
+    recommend_config = config["recommend_products"]["recommend_items"]
+    web.online_recommender = OnlineRecommender(
+        recommend_config["product_path"], recommend_config["csr_mat_path"],
+        recommend_config["model_path"], recommend_config["item_col"])
+    web.recommendation_cache.clear()
+    web.cache_state.update(version=None, checked_at=float("-inf"))
+    item_ids = pd.read_csv(recommendations_path, usecols=["input_itemid"])["input_itemid"]
+    item_ids = item_ids.drop_duplicates().sample(min(n_queries, item_ids.nunique()),
+                                                 random_state=0).tolist()
+    client = web.app.test_client()
+
+    def lookups(request: Callable[[int], Any]) -> List[float]:
+        latencies = []
+        for itemid in item_ids:
+            start = time.perf_counter()
+            response = request(itemid)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise RuntimeError(f"Lookup of item {itemid} returned {response.status_code}")
+        return latencies
+
+    for function, request in [
+            ("flask_lookup", lambda itemid: client.post("/", data={"itemid": str(itemid)})),
+            ("flask_lookup_cached", lambda itemid: client.post("/", data={"itemid": str(itemid)})),
+            ("flask_api_recommend", lambda itemid: client.get(f"/api/recommend/{itemid}?k=7"))]:
+        latencies, record = measure(function, lookups, request)
+        record.update(rows=len(latencies), p50_ms=float(np.percentile(latencies, 50)),
+                      p99_ms=float(np.percentile(latencies, 99)))
+        records.append(record)
+    return records
+
+
+def environment() -> dict:
+    """Describe the commit, library versions and machine the benchmark runs on"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], check=True, capture_output=True,
+                                text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "scipy": scipy.__version__,
+            "sklearn": sklearn.__version__, "platform": platform.platform(),
+            "cpus": os.cpu_count()}
+
+
+def compare(baseline_path: str, current_path: str, threshold: float) -> bool:
+    """Print the time and memory of two benchmark runs side by side
+
+    Args:
+        baseline_path (`str`): json results of the earlier run
+        current_path (`str`): json results of the later run
+        threshold (`float`): ratio of current over baseline above which a function
+            counts as a regression
+
+    Returns:
+        regressed (`bool`): whether any function regressed in time or memory
+    """
+    runs = []
+    for path in (baseline_path, current_path):
+        with open(path, "r", encoding="utf-8") as f:
+            runs.append(pd.DataFrame(json.load(f)["results"]))
+    merged = runs[0].merge(runs[1], on=KEYS, suffixes=("_baseline", "_current"))
+    merged["time_ratio"] = merged["seconds_current"] / merged["seconds_baseline"]
+    merged["memory_ratio"] = merged["peak_rss_mb_current"] / merged["peak_rss_mb_baseline"]
+    merged["regressed"] = (merged["time_ratio"] > threshold) | \
+        (merged["memory_ratio"] > threshold)
+    columns = KEYS + ["seconds_baseline", "seconds_current", "time_ratio",
+                      "peak_rss_mb_baseline", "peak_rss_mb_current", "memory_ratio",
+                      "regressed"]
+    print(merged[columns].round(3).to_string(index=False))
+    return bool(merged["regressed"].any())
+
+
+def main():
+    """Run the benchmark at every scale, or compare two runs"""
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages and the app")
+    parser.add_argument("--reviews", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="numbers of reviews to benchmark, e.g. 10000 up to 10000000")
+    parser.add_argument("--products", type=int, default=None,
+                        help="number of products, one per 50 reviews and at least 1000 "
+                             "if not given")
+    parser.add_argument("--queries", type=int, default=200,
+                        help="number of items to look up through the app")
+    parser.add_argument("--config_file", default="config/model_config.yaml",
+                        help="model configuration to start from")
+    parser.add_argument("--output", default=None, help="path to write the results as json")
+    parser.add_argument("--compare", nargs=2, default=None, metavar=("BASELINE", "CURRENT"),
+                        help="compare two json results instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="with --compare, ratio above which a function counts as a "
+                             "regression, which makes the exit status 1")
+    parser.add_argument("--verbose", default=False, action="store_true",
+                        help="show the info logs of the pipeline")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    with open(args.config_file, "r", encoding="ASCII") as f:
+        base_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine_string = f"sqlite:///{os.path.join(tmp_dir, 'products.db')}"
+        create_db(engine_string)
+        for n_reviews in args.reviews:
+            n_products = args.products or max(1000, n_reviews // 50)
+            scale_dir = os.path.join(tmp_dir, str(n_reviews))
+            product_path, review_path = write_raw_data(os.path.join(scale_dir, "raw"),
+                                                       n_products, n_reviews)
+            config = make_config(copy.deepcopy(base_config), ".parquet", product_path,
+                                 review_path, scale_dir)
+            records = bench_pipeline(config) + bench_web(config, engine_string, args.queries)
+            for record in records:
+                results.append({"reviews": n_reviews, "products": n_products, **record})
+            print(pd.DataFrame(results[-len(records):]).round(3).to_string(index=False))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
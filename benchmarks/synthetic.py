@@ -0,0 +1,149 @@
+"""Generate synthetic raw product and review data with the schema of the Shopee files
+
+    python -m benchmarks.synthetic --products 20000 --reviews 1000000 --output_dir data/bench
+"""
+import argparse
+import os
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+CATEGORIES = ["Top", "Short Sleeves", "Crop Top", "Long Sleeves"]
+LOCATIONS = ["Taytay, Rizal", "San Nicolas, Metro Manila", "Mainland China",
+             "Makati City, Metro Manila", "Pasay City, Metro Manila"]
+DATES = ["2021-06-13", "2021-06-21", "2021-06-28", "2021-07-06"]
+WORDS = ["korean", "fashion", "women", "top", "blouse", "crop", "sleeve", "shirt", "knit",
+         "floral", "casual", "oversized", "cotton", "basic", "polo", "tie", "puff"]
+REVIEW_TAGS = ["no_tag", "pos_good_quality", "pos_excellent_quality", "pos_very_accomodating",
+               "pos_well_packaged", "pos_item_shipped_immediately", "pos_will_order_again",
+               "neg_defective", "neg_did_not_receive_item", "neg_damaged_packaging",
+               "neg_will_not_order_again", "neg_rude_seller", "neg_item_shipped_late",
+               "neg_item_different_from_picture"]
+
+
+def make_products(n_products: int, n_snapshots: int = 4, seed: int = 42) -> pd.DataFrame:
+    """Generate daily product snapshots like `2021June-July_product_data.csv`
+
+    Args:
+        n_products (`int`): number of distinct products
+        n_snapshots (`int`): number of collection dates each product appears on
+        seed (`int`): random seed
+
+    Returns:
+        products (:obj:`pandas.DataFrame`): n_products x n_snapshots rows
+    """
+    rng = np.random.default_rng(seed)
+    item_ids = 10 ** 8 + rng.choice(10 ** 10 - 10 ** 8, n_products, replace=False)
+    n_rows = n_products * n_snapshots
+    itemid = np.tile(item_ids, n_snapshots)
+    dates = np.repeat(np.array(DATES * (n_snapshots // len(DATES) + 1))[:n_snapshots],
+                      n_products)
+    names = np.array([" ".join(rng.choice(WORDS, 8)) for _ in range(n_products)])
+    price = rng.uniform(100, 1200, n_rows).round(0)
+    price[rng.random(n_rows) < 0.1] = np.nan
+    ratings = rng.integers(0, 500, (n_rows, 6))
+    return pd.DataFrame({
+        "pk_product": [f"{date.replace('-', '')}{item}" for date, item in zip(dates, itemid)],
+        "date_collected": dates,
+        "product_itemid": itemid,
+        "product_shopid": rng.integers(10 ** 5, 10 ** 9, n_rows),
+        "product_category": np.tile(rng.choice(CATEGORIES, n_products), n_snapshots),
+        "product_name": np.tile(names, n_snapshots),
+        "product_price": price,
+        "product_price_min": rng.integers(100, 600, n_rows),
+        "product_price_max": rng.integers(600, 1200, n_rows),
+        "product_discount": rng.integers(0, 90, n_rows),
+        "product_brand": "No Brand",
+        "product_like_count": rng.integers(0, 5000, n_rows),
+        "product_comment_count": rng.integers(0, 4000, n_rows),
+        "product_views": rng.integers(0, 150000, n_rows),
+        **{f"prod_rate_star_{star}": ratings[:, star] for star in range(6)},
+        "product_total_rating": rng.uniform(3.5, 5, n_rows).round(2),
+        "stock": rng.integers(0, 150000, n_rows),
+        "units_sold": rng.integers(0, 10000, n_rows),
+        "status": 1,
+        "shop_location": rng.choice(LOCATIONS, n_rows),
+        **{column: rng.integers(0, 2, n_rows) for column in
+           ["shop_is_on_flash_sale", "shop_is_preferred_plus_seller",
+            "feature_lowest_price_guarantee", "feature_can_use_bundle_deal",
+            "feature_can_use_cod", "feature_can_use_wholesale", "feature_show_free_shipping"]},
+        "product_variation_count": rng.integers(1, 30, n_rows),
+    })
+
+
+def make_reviews(n_reviews: int, item_ids: np.ndarray, n_users: int = None,
+                 unknown_share: float = 0.1, seed: int = 42) -> pd.DataFrame:
+    """Generate reviews like `2021June-July_review_data.csv`
+
+    Item popularity follows a Zipf-like distribution, and a share of the reviews are for
+    items that are not in the product data, so that truncating them matters.
+
+    Args:
+        n_reviews (`int`): number of reviews
+        item_ids (:obj:`numpy.ndarray`): ids of the products being reviewed
+        n_users (`int`): number of distinct reviewers, one per review if None
+        unknown_share (`float`): share of reviews of items not in `item_ids`
+        seed (`int`): random seed
+
+    Returns:
+        reviews (:obj:`pandas.DataFrame`): one row per review
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, len(item_ids) + 1) ** 0.8
+    itemid = rng.choice(item_ids, n_reviews, p=weights / weights.sum())
+    unknown = rng.random(n_reviews) < unknown_share
+    itemid[unknown] = rng.integers(10 ** 10, 2 * 10 ** 10, unknown.sum())
+    cmtid = 10 ** 9 + rng.choice(10 ** 10 - 10 ** 9, n_reviews, replace=False)
+    users = cmtid if n_users is None else rng.integers(10 ** 8, 10 ** 8 + n_users, n_reviews)
+    dates = rng.choice(DATES, n_reviews)
+    tags = rng.random((n_reviews, len(REVIEW_TAGS))) < 0.1
+    return pd.DataFrame({
+        "pk_review": [f"{date.replace('-', '')}{cmt}" for date, cmt in zip(dates, cmtid)],
+        "date_collected": dates,
+        "cmtid": users,
+        "itemid": itemid,
+        "shopid": rng.integers(10 ** 5, 10 ** 9, n_reviews),
+        "author_username": np.char.add("user", rng.integers(0, 10 ** 6, n_reviews).astype(str)),
+        "rating_star": rng.choice([1, 2, 3, 4, 5], n_reviews, p=[0.03, 0.02, 0.05, 0.1, 0.8]),
+        **{tag: tags[:, i].astype(int) for i, tag in enumerate(REVIEW_TAGS)},
+    })
+
+
+def write_raw_data(output_dir: str, n_products: int, n_reviews: int,
+                   seed: int = 42) -> Tuple[str, str]:
+    """Write synthetic raw product and review csv files
+
+    Args:
+        output_dir (`str`): directory to write the files to
+        n_products (`int`): number of distinct products
+        n_reviews (`int`): number of reviews
+        seed (`int`): random seed
+
+    Returns:
+        product_path (`str`): path to the product csv file
+        review_path (`str`): path to the review csv file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    products = make_products(n_products, seed=seed)
+    reviews = make_reviews(n_reviews, products["product_itemid"].unique(), seed=seed)
+    product_path = os.path.join(output_dir, "product_data.csv")
+    review_path = os.path.join(output_dir, "review_data.csv")
+    products.to_csv(product_path, index=False)
+    reviews.to_csv(review_path, index=False)
+    return product_path, review_path
+
+
+def main():
+    """Write synthetic raw data files at the requested scale"""
+    parser = argparse.ArgumentParser(description="Generate synthetic Shopee data")
+    parser.add_argument("--products", type=int, default=20000, help="number of products")
+    parser.add_argument("--reviews", type=int, default=100000, help="number of reviews")
+    parser.add_argument("--seed", type=int, default=42, help="random seed")
+    parser.add_argument("--output_dir", default="data/bench", help="output directory")
+    args = parser.parse_args()
+    print(*write_raw_data(args.output_dir, args.products, args.reviews, args.seed), sep="\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,22 @@ HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False # If true, SQL for queries made will be printed
 MAX_ROWS_SHOW = 100
 
+# In-process caches of recommendation pages and dropdown choices
+CACHE_MAX_ITEMS = 5000
+CACHE_TTL_SECONDS = 3600
+CACHE_VERSION_CHECK_SECONDS = 30
+
+# Artifacts loaded at startup for the online recommendation API
+ONLINE_PRODUCT_PATH = "data/interim/processed_products.parquet"
+ONLINE_CSR_MAT_PATH = "data/interim/csr_matrix.npz"
+ONLINE_MODEL_PATH = "models/model"
+ONLINE_ITEM_COL = "product_itemid"
+ONLINE_DEFAULT_K = 7
+ONLINE_MAX_K = 100
+
+# Serve the totals of the instrumented functions and routes at /metrics
+METRICS_ENABLED = True
+
 # Connection string
 DB_HOST = os.environ.get('MYSQL_HOST')
 DB_PORT = os.environ.get('MYSQL_PORT')
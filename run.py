@@ -8,11 +8,16 @@ import sys
 import yaml
 
 from src import preprocess_products, preprocess_reviews, truncate_reviews
-from src.get_csr_matrix import get_csr_matrix, save_csr_matrix
+from src.get_csr_matrix import append_ratings, get_csr_matrix, save_csr_matrix
 from src.fit_model import fit_model
 from src.recommend_products import recommend_items, save_recommendations
+from src.instrument import profiled
+from src.pipeline import run_pipeline
+from src.stage_cache import STAGES, is_up_to_date, record_fingerprint, stage_fingerprint
 from src.add_products import ProductManager, create_db
-from src.s3 import download_file_from_s3, upload_file_to_s3
+from src.artifact_store import ArtifactCache, Workspace, action_paths
+from src.s3 import (MAX_CONCURRENCY, PART_SIZE_MB, SYNC_WORKERS, download_file_from_s3,
+                    sync_prefix, upload_file_to_s3)
 from config.flaskconfig import SQLALCHEMY_DATABASE_URI
 
 logging.config.fileConfig("config/logging/local.conf")
@@ -34,6 +39,15 @@ if __name__ == "__main__":
                        help="If used, will load data via pandas")
     sb_s3.add_argument("--local_path", default="data/external/2021June-July_product_data.csv",
                        help="Where to load data to in S3")
+    sb_s3.add_argument("--sync", default=False, action="store_true",
+                       help="If used, sync every file under --local_path, a directory, with "
+                            "every object under --s3_path, a prefix")
+    sb_s3.add_argument("--workers", type=int, default=SYNC_WORKERS,
+                       help="number of files transferred at the same time with --sync")
+    sb_s3.add_argument("--part_size_mb", type=int, default=PART_SIZE_MB,
+                       help="size of each part of a multipart transfer, in megabytes")
+    sb_s3.add_argument("--max_concurrency", type=int, default=MAX_CONCURRENCY,
+                       help="number of parts of a file transferred at the same time")
 
     # Sub-parser for creating a database
     sb_create = subparsers.add_parser("create_db", description="Create database")
@@ -43,34 +57,65 @@ if __name__ == "__main__":
     # Sub-parser for ingesting new data from a csv file
     sb_ingest = subparsers.add_parser("ingest_data", description="Add data to database")
     sb_ingest.add_argument("--input_path", default="models/recommendations.csv",
-                           help="path to the file that store product data to be added")
+                           help="path to the csv file that store product data to be added, "
+                                "or to a neighbor store directory such as models/neighbors")
     sb_ingest.add_argument("--engine_string", default=SQLALCHEMY_DATABASE_URI,
                            help="SQLAlchemy connection URI for database")
+    sb_ingest.add_argument("--batch_size", type=int, default=10000,
+                           help="number of rows to insert and commit at a time")
+    sb_ingest.add_argument("--mode", default="append", choices=["append", "refresh", "diff"],
+                           help="append rows, atomically replace the table, or only replace "
+                                "input items whose neighbor lists changed")
 
     # Sub-parser for model pipeline
     sb_model = subparsers.add_parser("model",
                                      description="Model pipeline to recommend fashion products")
     actions = ["preprocess_products", "preprocess_reviews", "truncate_reviews",
-               "get_csr_matrix", "fit_model", "recommend"]
+               "get_csr_matrix", "append_ratings", "fit_model", "recommend", "pipeline"]
     sb_model.add_argument("action",
                           help="action to take",
                           choices=actions)
     sb_model.add_argument("--config_file", default="config/model_config.yaml",
                           help="path to the file that store product data to be added")
+    sb_model.add_argument("--workers", type=int, default=None,
+                          help="number of processes for the recommend neighbor search, "
+                               "overrides the value in the configuration file")
+    sb_model.add_argument("--save_interim", default=False, action="store_true",
+                          help="with the pipeline action, also save the interim data "
+                               "passed between stages")
+    sb_model.add_argument("--delta_path", default=None,
+                          help="with the append_ratings action, path to the new review data, "
+                               "overrides the value in the configuration file")
+    sb_model.add_argument("--force", default=False, action="store_true",
+                          help="rerun the action even if its inputs and configuration "
+                               "have not changed since its outputs were saved")
+    sb_model.add_argument("--profile", nargs="?", const="profiles", default=None,
+                          help="save the cProfile statistics of the action, or of every "
+                               "stage of the pipeline action, to this directory "
+                               "(profiles/ if no directory is given)")
 
     args = parser.parse_args()
     sp_used = args.subparser_name
 
     if sp_used == "s3":
-        if args.download:
-            download_file_from_s3(args.local_path, args.s3_path)
+        if args.sync:
+            sync_prefix(args.local_path, args.s3_path, args.download, args.workers,
+                        args.part_size_mb, args.max_concurrency)
+        elif args.download:
+            download_file_from_s3(args.local_path, args.s3_path, args.part_size_mb,
+                                  args.max_concurrency)
         else:
-            upload_file_to_s3(args.local_path, args.s3_path)
+            upload_file_to_s3(args.local_path, args.s3_path, args.part_size_mb,
+                              args.max_concurrency)
     elif sp_used == "create_db":
         create_db(args.engine_string)
     elif sp_used == "ingest_data":
         product_manager = ProductManager(engine_string=args.engine_string)
-        product_manager.add_products(args.input_path)
+        if args.mode == "append":
+            product_manager.add_products(args.input_path, args.batch_size)
+        else:
+            product_manager.refresh_products(args.input_path, args.batch_size,
+                                             diff_only=args.mode == "diff")
         product_manager.close()
     elif sp_used == "model":
         # process configuration file
@@ -83,38 +128,73 @@ if __name__ == "__main__":
         else:
             logger.info("Successfully loaded configuration file from %s", args.config_file)
 
-        if args.action == "preprocess_products":
-            product_df = preprocess_products.get_product_features(
-                **config["preprocess_products"]["get_product_features"])
-            processed_product_df = preprocess_products.get_aggregated_features(
-                product_df, **config["preprocess_products"]["get_aggregated_features"])
-            preprocess_products.save_product_data(
-                processed_product_df, **config["preprocess_products"]["save_product_data"])
-
-        if args.action == "preprocess_reviews":
-            review_df = preprocess_reviews.get_review_features(
-                **config["preprocess_reviews"]["get_review_features"])
-            preprocess_reviews.save_review_data(
-                review_df, **config["preprocess_reviews"]["save_review_data"])
-
-        if args.action == "truncate_reviews":
-            truncated_review_df = truncate_reviews.truncate_reviews(
-                **config["truncate_reviews"]["truncate_reviews"])
-            truncate_reviews.save_truncated_review_data(
-                truncated_review_df, **config["truncate_reviews"]["save_truncated_review_data"])
-
-        if args.action == "get_csr_matrix":
-            csr_matrix = get_csr_matrix(**config["get_csr_matrix"]["get_csr_matrix"])
-            save_csr_matrix(csr_matrix, **config["get_csr_matrix"]["save_csr_matrix"])
-
-        if args.action == "fit_model":
-            fit_model(**config["fit_model"]["fit_model"])
-
-        if args.action == "recommend":
-            RECOMMEND = recommend_items(
-                **config["recommend_products"]["recommend_items"])
-            save_recommendations(
-                RECOMMEND, **config["recommend_products"]["save_recommendations"])
+        if args.workers is not None:
+            config["recommend_products"]["recommend_items"]["workers"] = args.workers
+        if args.delta_path is not None:
+            config["get_csr_matrix"]["append_ratings"]["delta_path"] = args.delta_path
+
+        # run the action on local copies of the s3:// paths of the configuration
+        workspace = Workspace(ArtifactCache())
+        config = workspace.localize(config, *action_paths(config, args.action))
+
+        # skip a stage whose outputs were saved from the same inputs and configuration
+        fingerprint = None
+        if args.action in STAGES:
+            fingerprint = stage_fingerprint(config, args.action)
+            if not args.force and is_up_to_date(config, args.action, fingerprint):
+                logger.info("Inputs and configuration of %s are unchanged, skipping it. "
+                            "Use --force to rerun it.", args.action)
+                sys.exit(0)
+
+        # the pipeline action profiles each of its stages on its own
+        stage_profile = args.profile if args.action != "pipeline" else None
+        with profiled(stage_profile, args.action):
+            if args.action == "preprocess_products":
+                product_df = preprocess_products.get_product_features(
+                    **config["preprocess_products"]["get_product_features"])
+                processed_product_df = preprocess_products.get_aggregated_features(
+                    product_df, **config["preprocess_products"]["get_aggregated_features"])
+                preprocess_products.save_product_data(
+                    processed_product_df, **config["preprocess_products"]["save_product_data"])
+
+            if args.action == "preprocess_reviews":
+                review_df = preprocess_reviews.get_review_features(
+                    **config["preprocess_reviews"]["get_review_features"])
+                preprocess_reviews.save_review_data(
+                    review_df, **config["preprocess_reviews"]["save_review_data"])
+
+            if args.action == "truncate_reviews":
+                truncated_review_df = truncate_reviews.truncate_reviews(
+                    **config["truncate_reviews"]["truncate_reviews"])
+                truncate_reviews.save_truncated_review_data(
+                    truncated_review_df,
+                    **config["truncate_reviews"]["save_truncated_review_data"])
+
+            if args.action == "get_csr_matrix":
+                csr_matrix, item_ids, user_ids = get_csr_matrix(
+                    **config["get_csr_matrix"]["get_csr_matrix"], return_ids=True)
+                save_csr_matrix(csr_matrix, **config["get_csr_matrix"]["save_csr_matrix"],
+                                item_ids=item_ids, user_ids=user_ids)
+
+            if args.action == "append_ratings":
+                append_ratings(**config["get_csr_matrix"]["append_ratings"])
+
+            if args.action == "fit_model":
+                fit_model(**config["fit_model"]["fit_model"])
+
+            if args.action == "pipeline":
+                run_pipeline(config, save_interim=args.save_interim,
+                             profile_dir=args.profile)
+
+            if args.action == "recommend":
+                RECOMMEND = recommend_items(
+                    **config["recommend_products"]["recommend_items"])
+                save_recommendations(
+                    RECOMMEND, **config["recommend_products"]["save_recommendations"])
+
+        if fingerprint is not None:
+            record_fingerprint(config, args.action, fingerprint)
+        workspace.publish()
 
     else:
         parser.print_help()
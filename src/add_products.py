@@ -1,26 +1,36 @@
 """Creates, ingests data into, and enables querying of a table of
  products for the Fashion Recommender app to query from and display results to the user."""
 import logging.config
+import os
 import typing
 import sys
+import uuid
 
 import flask
 import pandas as pd
-from sqlalchemy import Column, Integer, String, Float, BigInteger, create_engine
+from sqlalchemy import Column, Integer, String, Float, BigInteger, Index, create_engine, \
+    select
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from flask_sqlalchemy import SQLAlchemy
 
+from src.instrument import instrument
+from src.neighbor_store import NeighborStore
+
 logger = logging.getLogger(__name__)
 
 Base: typing.Any = declarative_base()
 
+DELETE_BATCH_SIZE = 500
+
 
 class Product(Base):
     """Creates a data model for the database to be set up for capturing products"""
 
     __tablename__ = "products"
+    # lookups filter on input_itemid and read the recommendations in rank order
+    __table_args__ = (Index("ix_products_input_itemid_rank", "input_itemid", "rank"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     input_itemid = Column(BigInteger, unique=False, nullable=False)
@@ -40,6 +50,30 @@ class Product(Base):
         return f"<Products {self.input_itemid}>"
 
 
+class InputItem(Base):
+    """Creates a compact data model with one row per input item for the app dropdown"""
+
+    __tablename__ = "input_items"
+
+    input_itemid = Column(BigInteger, primary_key=True, autoincrement=False)
+
+    def __repr__(self):
+        return f"<InputItems {self.input_itemid}>"
+
+
+class ModelVersion(Base):
+    """Creates a single-row data model recording which ingest the products table holds,
+    so that app processes know when to drop their cached results"""
+
+    __tablename__ = "model_version"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(String(32), unique=False, nullable=False)
+
+    def __repr__(self):
+        return f"<ModelVersion {self.version}>"
+
+
 class ProductManager:
     """Creates a SQLAlchemy connection to the product table.
 
@@ -68,33 +102,177 @@ class ProductManager:
         """
         self.session.close()
 
-    def add_products(self, input_path: str) -> None:
-        """Add all the data in a csv file into the database
+    @instrument(reads=("input_path",))
+    def add_products(self, input_path: str, batch_size: int = 10000) -> None:
+        """Add all the data in a csv file or a neighbor store into the database
+
+        The input is streamed in chunks of `batch_size` rows, each inserted with a
+        single executemany statement and committed on its own.
 
         Args:
-            input_path (`str`): path to the input csv file
+            input_path (`str`): path to the input csv file, or to a neighbor store
+                directory saved by :func:`src.neighbor_store.save_neighbors`
+            batch_size (`int`): number of rows to read, insert and commit at a time
 
         Returns:
               None
         """
+        if not (str(batch_size).isdigit() and batch_size > 0):
+            logger.error("The input batch_size has to be a positive integer.")
+            sys.exit(1)
         session = self.session
-        # transform data into list of element {column -> value} for easy ingest
-        data_list = pd.read_csv(input_path).to_dict(orient="records")
-        product_list = [Product(**data) for data in data_list]
+        n_rows = 0
         try:
-            session.add_all(product_list)
+            for chunk in _read_batches(input_path, batch_size):
+                session.execute(Product.__table__.insert(), _to_records(chunk))
+                session.commit()
+                n_rows += len(chunk)
+                logger.info("%d records are added to the table", n_rows)
+            self._sync_input_items()
+            self._bump_model_version()
             session.commit()
+        except FileNotFoundError:
+            logger.error("No such file or directory to load products. Please try again.")
+            sys.exit(1)
         except OperationalError as err:
+            session.rollback()
             error_message = "Error page returned. Not able to add products to MySQL database. " \
                             "Please check engine string and connection to Northwestern VPN."
-            logger.error(error_message, "\n Error:", err)
+            logger.error("%s\n Error: %s", error_message, err)
             sys.exit(1)
         else:
             logger.info("records are added to the table")
 
+    @instrument(reads=("input_path",))
+    def refresh_products(self, input_path: str, batch_size: int = 10000,
+                         diff_only: bool = False) -> None:
+        """Replace the products table with the data in a csv file or a neighbor store in
+        one transaction
+
+        Rows of input items that are no longer in the csv file are deleted, so re-running
+        the ingest never duplicates rows. Readers keep seeing the previous recommendations
+        until the single commit at the end. With `diff_only`, only the input items whose
+        neighbor lists (product_itemid by rank) changed are deleted and re-inserted.
+
+        Args:
+            input_path (`str`): path to the input csv file or neighbor store directory
+            batch_size (`int`): number of rows to read and insert at a time
+            diff_only (`bool`): whether to only touch input items whose neighbor lists changed
+
+        Returns:
+              None
+        """
+        if not (str(batch_size).isdigit() and batch_size > 0):
+            logger.error("The input batch_size has to be a positive integer.")
+            sys.exit(1)
+        session = self.session
+        table = Product.__table__
+        try:
+            if diff_only:
+                changed, stale = self._diff_items(input_path)
+                self._delete_items(changed.union(stale))
+                logger.info("%d input items changed and %d are stale",
+                            len(changed), len(stale))
+            else:
+                session.execute(table.delete())
+            n_rows = 0
+            for chunk in _read_batches(input_path, batch_size):
+                if diff_only:
+                    chunk = chunk[chunk["input_itemid"].isin(changed)]
+                if len(chunk) > 0:
+                    session.execute(table.insert(), _to_records(chunk))
+                n_rows += len(chunk)
+                logger.info("%d records are staged", n_rows)
+            self._sync_input_items()
+            self._bump_model_version()
+            session.commit()
+        except FileNotFoundError:
+            session.rollback()
+            logger.error("No such file or directory to load products. Please try again.")
+            sys.exit(1)
+        except OperationalError as err:
+            session.rollback()
+            error_message = "Error page returned. Not able to refresh products in MySQL " \
+                            "database. Please check engine string and connection to " \
+                            "Northwestern VPN."
+            logger.error("%s\n Error: %s", error_message, err)
+            sys.exit(1)
+        else:
+            logger.info("products table is refreshed with %d records", n_rows)
+
+    def _sync_input_items(self) -> None:
+        """Rebuild the input_items table from the distinct input items of the products table,
+        in the current transaction"""
+        self.session.execute(InputItem.__table__.delete())
+        self.session.execute(InputItem.__table__.insert().from_select(
+            ["input_itemid"], select(Product.input_itemid).distinct()))
+
+    def _bump_model_version(self) -> None:
+        """Record a new model version, in the current transaction"""
+        self.session.execute(ModelVersion.__table__.delete())
+        self.session.execute(ModelVersion.__table__.insert(),
+                             {"id": 1, "version": uuid.uuid4().hex})
+
+    def _diff_items(self, input_path: str) -> typing.Tuple[typing.Set[int], typing.Set[int]]:
+        """Compare the neighbor lists in a csv file or a neighbor store with the ones in
+        the products table
+
+        Args:
+            input_path (`str`): path to the input csv file or neighbor store directory
+
+        Returns:
+            changed (:obj:`set` of `int`): input items that are new or whose neighbor
+                lists differ, including items with duplicated ranks in the table
+            stale (:obj:`set` of `int`): input items in the table but not in the file
+        """
+        keys = ["input_itemid", "rank"]
+        if os.path.isdir(input_path):
+            new = NeighborStore.load(input_path).to_frame(columns=["product_itemid"])
+        else:
+            new = pd.read_csv(input_path, usecols=keys + ["product_itemid"])
+        query = select(Product.input_itemid, Product.rank, Product.product_itemid)
+        old = pd.DataFrame(self.session.execute(query).all(),
+                           columns=keys + ["product_itemid"])
+        merged = new.merge(old, on=keys, how="outer", suffixes=("_new", "_old"),
+                           indicator=True)
+        mismatched = (merged["_merge"] != "both") | \
+            (merged["product_itemid_new"] != merged["product_itemid_old"])
+        changed = set(merged.loc[mismatched, "input_itemid"]) | \
+            set(old.loc[old.duplicated(keys), "input_itemid"])
+        stale = set(old["input_itemid"]) - set(new["input_itemid"])
+        return changed - stale, stale
+
+    def _delete_items(self, input_itemids: typing.Iterable[int]) -> None:
+        """Delete all rows of the given input items, a batch of ids at a time"""
+        input_itemids = sorted(int(itemid) for itemid in input_itemids)
+        # stay below the bound parameter limit of older sqlite builds
+        for start in range(0, len(input_itemids), DELETE_BATCH_SIZE):
+            self.session.execute(Product.__table__.delete().where(
+                Product.input_itemid.in_(input_itemids[start:start + DELETE_BATCH_SIZE])))
+
+
+def _read_batches(input_path: str, batch_size: int) -> typing.Iterator[pd.DataFrame]:
+    """Stream the recommendation table from a csv file, or expand it from a neighbor
+    store directory, `batch_size` rows at a time"""
+    if os.path.isdir(input_path):
+        return NeighborStore.load(input_path).iter_frames(batch_size)
+    return pd.read_csv(input_path, chunksize=batch_size)
+
+
+def _to_records(data: pd.DataFrame) -> typing.List[dict]:
+    """Transform data into list of element {column -> value} for easy ingest
+
+    Going through `Series.tolist` converts whole columns to Python scalars at once,
+    which is much faster than `DataFrame.to_dict(orient="records")`.
+    """
+    columns = list(data.columns)
+    return [dict(zip(columns, row)) for row in
+            zip(*(data[column].tolist() for column in columns))]
+
 
 def create_db(engine_string: str) -> None:
-    """Create database with Products() data model from provided engine string.
+    """Create database with Products(), InputItem() and ModelVersion() data models from
+    provided engine string.
 
     Args:
         engine_string (`str`): SQLAlchemy engine string specifying which database
@@ -106,10 +284,13 @@ def create_db(engine_string: str) -> None:
     engine = create_engine(engine_string)
     try:
         Base.metadata.create_all(engine)
+        # tables created before the indexes were declared do not get them from create_all
+        for index in Product.__table__.indexes:
+            index.create(engine, checkfirst=True)
     except OperationalError as err:
         error_message = "Error page returned. Not able to create database." \
                         "Please check engine string and connection to Northwestern VPN."
-        logger.error(error_message, "\n Error:", err)
+        logger.error("%s\n Error: %s", error_message, err)
         sys.exit(1)
     else:
         logger.info("Database created.")
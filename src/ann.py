@@ -0,0 +1,164 @@
+"""This module is to find approximate cosine neighbors with random-projection LSH"""
+import logging.config
+import warnings
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from scipy import sparse as sp
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import NearestNeighbors
+from sklearn.exceptions import DataDimensionalityWarning
+from sklearn.random_projection import SparseRandomProjection
+
+from src.similarity import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+Matrix = Union[np.ndarray, csr_matrix]
+
+
+class LSHIndex:
+    """Approximate nearest-neighbor index for cosine similarity
+
+    Every item is hashed into one bucket per table by the signs of `n_bits` random
+    projections. A query only scores the items sharing at least one of its buckets, then
+    re-ranks them by exact cosine similarity. More tables raise recall, more bits per
+    table shrink the buckets and speed up queries. Queries with fewer candidates than
+    neighbors requested fall back to an exact scan.
+
+    Args:
+        n_neighbors (`int`): default number of neighbors to return
+        n_tables (`int`): number of hash tables
+        n_bits (`int`): number of random projections per table
+        random_state (`int`): seed for the random projections
+    """
+    algorithm = "lsh"
+    metric = "cosine"
+
+    def __init__(self, n_neighbors: int = 5, n_tables: int = 8, n_bits: int = 12,
+                 random_state: int = 42):
+        if not all(str(value).isdigit() and value > 0 for value in (n_tables, n_bits)):
+            raise ValueError("The inputs n_tables and n_bits have to be positive integers.")
+        if n_bits > 62:
+            raise ValueError("The input n_bits can be at most 62.")
+        self.n_neighbors = n_neighbors
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.random_state = random_state
+        self.items: Optional[Matrix] = None
+        self.projection: Optional[SparseRandomProjection] = None
+        self.sorted_codes: Optional[np.ndarray] = None
+        self.orders: Optional[np.ndarray] = None
+
+    def fit(self, mat: Matrix) -> "LSHIndex":
+        """Hash every item into its bucket of each table
+
+        Args:
+            mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+
+        Returns:
+            self (:obj:`LSHIndex`): fitted index
+        """
+        self.items = normalize_rows(mat)
+        self.projection = SparseRandomProjection(n_components=self.n_tables * self.n_bits,
+                                                 dense_output=True,
+                                                 random_state=self.random_state)
+        with warnings.catch_warnings():
+            # projections only feed the hash, so more of them than features is fine
+            warnings.simplefilter("ignore", DataDimensionalityWarning)
+            self.projection.fit(self.items)
+        codes = self._hash(self.items)
+        # sort each table's codes so a bucket is a contiguous range found by searchsorted
+        self.orders = np.argsort(codes, axis=0, kind="stable")
+        self.sorted_codes = np.take_along_axis(codes, self.orders, axis=0)
+        return self
+
+    def kneighbors(self, X: Optional[Matrix] = None, n_neighbors: Optional[int] = None,
+                   return_distance: bool = True
+                   ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Find approximate neighbors, with the same interface as
+        :meth:`sklearn.neighbors.NearestNeighbors.kneighbors`
+
+        Args:
+            X (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): query rows,
+                the fitted items if None
+            n_neighbors (`int`): number of neighbors, `n_neighbors` of the index if None
+            return_distance (`bool`): whether to return cosine distances too
+
+        Returns:
+            distances (:obj:`numpy.ndarray`): queries x n_neighbors cosine distances,
+                only if `return_distance`
+            indices (:obj:`numpy.ndarray`): queries x n_neighbors item positions,
+                closest first
+        """
+        if self.items is None:
+            raise ValueError("The index has to be fitted before querying.")
+        n_neighbors = min(n_neighbors or self.n_neighbors, self.items.shape[0])
+        queries = self.items if X is None else normalize_rows(X)
+        codes = self._hash(queries)
+        indices = np.empty((queries.shape[0], n_neighbors), dtype=np.int64)
+        scores = np.empty((queries.shape[0], n_neighbors), dtype=np.float64)
+        for row in range(queries.shape[0]):
+            candidates = self._candidates(codes[row])
+            if len(candidates) < n_neighbors:
+                candidates = np.arange(self.items.shape[0])
+            sims = self.items[candidates] @ queries[row].T
+            sims = sims.toarray().ravel() if sp.issparse(sims) else np.asarray(sims).ravel()
+            order = np.lexsort((candidates, -sims))[:n_neighbors]
+            indices[row], scores[row] = candidates[order], sims[order]
+        if return_distance:
+            return 1 - scores, indices
+        return indices
+
+    def _hash(self, mat: Matrix) -> np.ndarray:
+        """Pack the projection signs of every row into one integer code per table"""
+        signs = self.projection.transform(mat) > 0
+        signs = signs.reshape(mat.shape[0], self.n_tables, self.n_bits)
+        return signs.astype(np.int64) @ (1 << np.arange(self.n_bits, dtype=np.int64))
+
+    def _candidates(self, codes: np.ndarray) -> np.ndarray:
+        """Collect the items sharing a bucket with a query in any table"""
+        buckets = []
+        for table, code in enumerate(codes):
+            start, stop = np.searchsorted(self.sorted_codes[:, table], [code, code + 1])
+            buckets.append(self.orders[start:stop, table])
+        return np.unique(np.concatenate(buckets))
+
+
+def recall_at_k(approx_indices: np.ndarray, exact_indices: np.ndarray) -> float:
+    """Share of the exact neighbors that the approximate search also found
+
+    Args:
+        approx_indices (:obj:`numpy.ndarray`): queries x k approximate neighbor positions
+        exact_indices (:obj:`numpy.ndarray`): queries x k exact neighbor positions
+
+    Returns:
+        recall (`float`): mean recall@k over the queries
+    """
+    hits = [len(np.intersect1d(approx, exact)) for approx, exact in
+            zip(approx_indices, exact_indices)]
+    return float(np.sum(hits) / exact_indices.size)
+
+
+def evaluate_recall(index: LSHIndex, mat: Matrix, k: int, sample_size: int = 1000,
+                    random_state: int = 42) -> float:
+    """Measure recall@k of an approximate index against a brute-force cosine search
+
+    Args:
+        index (:obj:`LSHIndex`): fitted approximate index
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+            the index was fitted on
+        k (`int`): number of neighbors to compare
+        sample_size (`int`): number of items to query, sampled without replacement
+        random_state (`int`): seed for sampling the queries
+
+    Returns:
+        recall (`float`): mean recall@k over the sampled queries
+    """
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(mat.shape[0], min(sample_size, mat.shape[0]), replace=False))
+    queries = mat[sample]
+    exact = NearestNeighbors(n_neighbors=k, algorithm="brute", metric="cosine") \
+        .fit(mat).kneighbors(queries, return_distance=False)
+    approx = index.kneighbors(queries, n_neighbors=k, return_distance=False)
+    return recall_at_k(approx, exact)
@@ -0,0 +1,350 @@
+"""This module is to let the model pipeline read and write `s3://` paths as if they
+were local. Objects are downloaded once into a local cache keyed by their ETag, and the
+outputs of an action are uploaded back when it finishes. csv files an action only reads
+stay on S3, and are streamed by `src.table_io`."""
+import copy
+import logging.config
+import os
+import shutil
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from src.s3 import get_client, head_object, is_s3, parse_s3, transfer_config
+from src.stage_cache import STAGES, stage_paths
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", "data/cache")
+CACHE_MAX_MB = float(os.environ.get("ARTIFACT_CACHE_MAX_MB", "10240"))
+# object metadata that keeps the modification time of an uploaded file, so that the
+# fingerprints of `src.stage_cache` still match on the machine that downloads it
+MTIME_KEY = "mtime-ns"
+
+# action -> (section, function, key) of the paths it reads and writes, besides the
+# inputs and outputs of the cached stages in STAGES
+ACTION_PATHS = {
+    "append_ratings": ([("get_csr_matrix", "append_ratings", "delta_path"),
+                        ("get_csr_matrix", "append_ratings", "product_path")],
+                       [("get_csr_matrix", "append_ratings", "csr_mat_path")]),
+    # the neighbors are updated in place after append_ratings
+    "recommend": ([], [("recommend_products", "recommend_items", "neighbors_path"),
+                       ("recommend_products", "recommend_items", "scores_path")]),
+    # the pipeline rewrites every artifact after the raw data, so only that is read
+    "pipeline": ([("preprocess_products", "get_product_features", "input_path"),
+                  ("preprocess_reviews", "get_review_features", "input_path")], []),
+}
+
+State = Tuple[int, int]
+
+
+class ArtifactCache:
+    """Content-addressed cache of S3 objects on local disk
+
+    Every object is saved once under its ETag, so an object that did not change is never
+    downloaded again, whatever its key. The least recently used objects are removed once
+    the cache is bigger than `max_mb`.
+
+    Args:
+        directory (`str`): directory of the cache, `CACHE_DIR` if None
+        max_mb (`float`): maximum size of the cache in megabytes, `CACHE_MAX_MB` if None
+    """
+    def __init__(self, directory: Optional[str] = None, max_mb: Optional[float] = None):
+        self.directory = directory or CACHE_DIR
+        self.max_bytes = int((max_mb or CACHE_MAX_MB) * 2 ** 20)
+        self.objects_dir = os.path.join(self.directory, "objects")
+
+    def fetch(self, s3path: str) -> str:
+        """Get the local copy of an S3 object, downloading it if it is not cached
+
+        Args:
+            s3path (`str`): s3 path of the object
+
+        Returns:
+            local_path (`str`): path to the cached object, which must not be written to
+
+        Raises:
+            FileNotFoundError: if there is no such object
+        """
+        s3bucket, key = parse_s3(s3path)
+        return self.get(s3bucket, key, head_object(s3bucket, key)["ETag"])
+
+    def get(self, s3bucket: str, key: str, etag: str) -> str:
+        """Get the local copy of an S3 object with a known ETag
+
+        Args:
+            s3bucket (`str`): bucket name
+            key (`str`): object key
+            etag (`str`): ETag of the object
+
+        Returns:
+            local_path (`str`): path to the cached object, which must not be written to
+        """
+        path = self._object_path(etag)
+        if os.path.exists(path):
+            _touch(path)
+            logger.debug("s3://%s/%s is cached as %s", s3bucket, key, path)
+            return path
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_path = f"{path}.part-{uuid.uuid4().hex}"
+        try:
+            get_client().download_file(s3bucket, key, tmp_path, Config=transfer_config())
+            # never cache the content of an object under the ETag of another version
+            if head_object(s3bucket, key)["ETag"] != etag:
+                raise RuntimeError(f"s3://{s3bucket}/{key} changed while it was "
+                                   "downloaded, please try again.")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        logger.info("s3://%s/%s is downloaded to the artifact cache", s3bucket, key)
+        self.evict(keep=path)
+        return path
+
+    def add(self, local_path: str, etag: str) -> None:
+        """Add a file that was just uploaded to the cache, without copying it if possible
+
+        Args:
+            local_path (`str`): path to the uploaded file
+            etag (`str`): ETag of the uploaded object
+        """
+        path = self._object_path(etag)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.objects_dir, exist_ok=True)
+        _link_or_copy(local_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Remove the least recently used objects until the cache fits in its size
+
+        Objects still linked from a :class:`Workspace` are kept, as removing them would
+        not free any space.
+
+        Args:
+            keep (`str`): path to an object to keep anyway
+
+        Returns:
+            n_bytes (`int`): number of bytes freed
+        """
+        if not os.path.isdir(self.objects_dir):
+            return 0
+        entries = [entry for entry in os.scandir(self.objects_dir) if entry.is_file()]
+        stats = {entry.path: entry.stat() for entry in entries}
+        total = sum(stat.st_size for stat in stats.values())
+        freed = 0
+        for path, stat in sorted(stats.items(), key=lambda item: item[1].st_atime_ns):
+            if total - freed <= self.max_bytes:
+                break
+            if path == keep or stat.st_nlink > 1:
+                continue
+            os.remove(path)
+            freed += stat.st_size
+        if freed:
+            logger.info("%.1f MB of least recently used objects are removed from the "
+                        "artifact cache", freed / 2 ** 20)
+        return freed
+
+    def _object_path(self, etag: str) -> str:
+        """Path of the object with an ETag, which is hex digits and maybe a part count"""
+        return os.path.join(self.objects_dir, etag.strip('"'))
+
+
+class Workspace:
+    """Local files standing in for the `s3://` paths of a model configuration
+
+    An S3 path is mapped to `<cache directory>/files/<bucket>/<key>`, together with the
+    files saved next to it, such as the id indexes of a matrix and the fingerprint of a
+    stage output, so that every function keeps working on local paths.
+
+    Args:
+        cache (:obj:`ArtifactCache`): cache to fetch the objects through
+    """
+    def __init__(self, cache: ArtifactCache):
+        self.cache = cache
+        self.root = os.path.join(cache.directory, "files")
+        self._fetched: Dict[str, Dict[str, State]] = {}
+
+    def local_path(self, s3path: str) -> str:
+        """Get the local path an S3 path is mapped to"""
+        s3bucket, key = parse_s3(s3path)
+        return os.path.join(self.root, s3bucket, *key.split("/"))
+
+    def localize(self, config: dict, read_paths: List[str], write_paths: List[str]) -> dict:
+        """Map every S3 path of a configuration to a local path, and fetch the objects
+        of the paths an action reads or writes
+
+        csv files that are only read keep their S3 path, to be streamed without saving
+        them to local disk. Other objects that are only read are linked from the cache.
+        Objects that may be written are copied, so that the cache is never changed.
+
+        Args:
+            config (`dict`): model configuration, as in `config/model_config.yaml`
+            read_paths (:obj:`list` of `str`): paths the action reads
+            write_paths (:obj:`list` of `str`): paths the action reads and writes
+
+        Returns:
+            local_config (`dict`): copy of the configuration with local paths
+        """
+        streamed = {path for path in read_paths
+                    if path not in write_paths and os.path.splitext(path)[1].lower() == ".csv"}
+        local_config = _map_paths(copy.deepcopy(config),
+                                  lambda path: path if path in streamed else self._register(path))
+        # drop what earlier runs left, so only what is fetched or written now is published
+        for s3path in self._fetched:
+            for path in _local_group(self.local_path(s3path)):
+                os.remove(path)
+        for path in (set(read_paths) | set(write_paths)) - streamed:
+            if is_s3(path):
+                self._fetch(path, writable=path in write_paths)
+        return local_config
+
+    def publish(self) -> int:
+        """Upload every file next to a mapped S3 path that was written since it was
+        fetched, and remove the objects next to it that were removed locally
+
+        Returns:
+            n_files (`int`): number of files uploaded
+        """
+        n_files = 0
+        for s3path, fetched in self._fetched.items():
+            local_path = self.local_path(s3path)
+            states = {path: _state(path) for path in _local_group(local_path)}
+            changed = [path for path, state in states.items() if fetched.get(path) != state]
+            if not changed and set(fetched) <= set(states):
+                continue
+            s3bucket, key = parse_s3(s3path)
+            client = get_client()
+            for path in changed:
+                object_key = self._key(s3bucket, path)
+                client.upload_file(path, s3bucket, object_key, Config=transfer_config(),
+                                   ExtraArgs={"Metadata": {
+                                       MTIME_KEY: str(os.stat(path).st_mtime_ns)}})
+                self.cache.add(path, head_object(s3bucket, object_key)["ETag"])
+            kept = {self._key(s3bucket, path) for path in states}
+            for object_key in set(_remote_group(s3bucket, key)) - kept:
+                client.delete_object(Bucket=s3bucket, Key=object_key)
+            self._fetched[s3path] = states
+            n_files += len(changed)
+            logger.info("%d files of %s are uploaded", len(changed), s3path)
+        return n_files
+
+    def _register(self, s3path: str) -> str:
+        """Map an S3 path to its local path, remembering to publish it"""
+        self._fetched.setdefault(s3path, {})
+        local_path = self.local_path(s3path)
+        # the stages expect the directories of their outputs to exist
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return local_path
+
+    def _fetch(self, s3path: str, writable: bool) -> None:
+        """Replace the local files of an S3 path with the objects saved there now"""
+        s3bucket, key = parse_s3(s3path)
+        fetched = {}
+        for object_key in _remote_group(s3bucket, key):
+            head = head_object(s3bucket, object_key)
+            cached = self.cache.get(s3bucket, object_key, head["ETag"])
+            path = self.local_path(f"s3://{s3bucket}/{object_key}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if writable:
+                shutil.copyfile(cached, path)
+            else:
+                _link_or_copy(cached, path)
+            mtime_ns = head.get("Metadata", {}).get(MTIME_KEY)
+            mtime_ns = int(mtime_ns) if mtime_ns else int(head["LastModified"].timestamp() * 1e9)
+            os.utime(path, ns=(time.time_ns(), mtime_ns))
+            fetched[path] = _state(path)
+        self._fetched[s3path] = fetched
+
+    def _key(self, s3bucket: str, path: str) -> str:
+        """Object key of a local file"""
+        return os.path.relpath(path, os.path.join(self.root, s3bucket)).replace(os.sep, "/")
+
+
+def action_paths(config: dict, action: str) -> Tuple[List[str], List[str]]:
+    """Get the paths a `run.py model` action reads, and the paths it may write
+
+    The outputs of the cached stages are fetched too, to check if the stage is up to
+    date.
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        action (`str`): action name
+
+    Returns:
+        read_paths (:obj:`list` of `str`): paths the action only reads
+        write_paths (:obj:`list` of `str`): paths the action may write
+    """
+    read_paths, write_paths = stage_paths(config, action) if action in STAGES else ([], [])
+    reads, writes = ACTION_PATHS.get(action, ([], []))
+    return read_paths + _configured(config, reads), write_paths + _configured(config, writes)
+
+
+def _configured(config: dict, entries: List[Tuple[str, str, str]]) -> List[str]:
+    """Get the paths at (section, function, key) entries that are configured"""
+    paths = [config[section][function].get(key) for section, function, key in entries]
+    return [path for path in paths if path]
+
+
+def _map_paths(value, mapper):
+    """Replace every S3 path in a nested configuration"""
+    if isinstance(value, dict):
+        return {key: _map_paths(item, mapper) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_map_paths(item, mapper) for item in value]
+    return mapper(value) if is_s3(value) else value
+
+
+def _in_group(name: str, base: str) -> bool:
+    """Whether a file belongs to the artifact at `base`: the artifact itself, the files
+    under it if it is a directory, and the files saved next to it by this repo, such as
+    `<base>.fingerprint` and `<stem>_items.npy`"""
+    if name == base or name.startswith(base + "/") or name.startswith(base + "."):
+        return True
+    stem, extension = os.path.splitext(base)
+    return bool(extension) and name.startswith(stem + "_")
+
+
+def _remote_group(s3bucket: str, key: str) -> List[str]:
+    """Keys of the objects of the artifact at an S3 key"""
+    pages = get_client().get_paginator("list_objects_v2").paginate(
+        Bucket=s3bucket, Prefix=os.path.splitext(key)[0])
+    return [obj["Key"] for page in pages for obj in page.get("Contents", [])
+            if _in_group(obj["Key"], key) and not obj["Key"].endswith("/")]
+
+
+def _local_group(path: str) -> List[str]:
+    """Paths of the local files of the artifact at a path"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        return []
+    base = path.replace(os.sep, "/")
+    files = []
+    for entry in os.scandir(directory):
+        if not _in_group(entry.path.replace(os.sep, "/"), base):
+            continue
+        if entry.is_dir():
+            files += [os.path.join(root, name)
+                      for root, _, names in os.walk(entry.path) for name in names]
+        else:
+            files.append(entry.path)
+    return files
+
+
+def _state(path: str) -> State:
+    """Size and modification time of a file"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _touch(path: str) -> None:
+    """Mark a cached object as used now, keeping its modification time"""
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    """Hard link a file, or copy it if it is on another file system"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
@@ -0,0 +1,93 @@
+"""This module is to cache query results in process with LRU eviction and expiry"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe cache that keeps at most `max_size` entries, evicts the least recently
+    used one first, and expires entries `ttl` seconds after they were stored.
+
+    Args:
+        max_size (`int`): maximum number of entries
+        ttl (`float`): seconds an entry stays valid, never expires if None
+    """
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        if not (str(max_size).isdigit() and max_size > 0):
+            raise ValueError("The input max_size has to be a positive integer.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a cached value and mark it as recently used
+
+        Args:
+            key (`Hashable`): cache key
+            default (`Any`): value returned on a miss
+
+        Returns:
+            value (`Any`): cached value, or `default` if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or time.monotonic() < entry[1]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entry if the cache is full
+
+        Args:
+            key (`Hashable`): cache key
+            value (`Any`): value to cache
+        """
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Get a cached value, or compute and cache it on a miss
+
+        Args:
+            key (`Hashable`): cache key
+            compute (`Callable`): function without arguments returning the value
+
+        Returns:
+            value (`Any`): cached or freshly computed value
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        """Drop every entry, counters are kept"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Get the size and hit/miss counters of the cache
+
+        Returns:
+            stats (`dict`): size, max_size, hits, misses and hit_rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
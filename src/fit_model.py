@@ -1,51 +1,120 @@
 """This module is to build recommendation system"""
 import logging.config
 import sys
+from typing import Optional, Union
 
 import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.neighbors import NearestNeighbors
-import joblib
+
+from src.ann import LSHIndex, evaluate_recall
+from src.get_csr_matrix import load_csr_matrix
+from src.instrument import instrument
+from src.model_store import save_model as store_model
 
 logger = logging.getLogger(__name__)
 
 
-def fit_model(k: int, metric: str, csr_mat_path: str, output_path: str) -> None:
+@instrument(reads=("csr_mat_path",), writes=("output_path",))
+def fit_model(k: int, metric: str, csr_mat_path: str, output_path: str,
+              algorithm: str = "brute", ann_params: Optional[dict] = None,
+              recall_sample: int = 1000) -> None:
     """Fit a KNN model for recommendations
 
     Args:
         k (`int`): number of neighbors to use
         metric (`str`): distance metric used for finding neighbors
-        csr_mat_path (`str`): path to csr matrix
+        csr_mat_path (`str`): path to csr matrix, `.npz` for sparse and `.npy` for dense
         output_path (`str`): output path to save model
+        algorithm (`str`): "brute" for an exact search, or "lsh" for an approximate
+            random-projection index (cosine metric only)
+        ann_params (`dict`): keyword arguments for :class:`src.ann.LSHIndex`,
+            e.g. `n_tables` and `n_bits` to trade recall against speed
+        recall_sample (`int`): number of items to query when reporting the recall@k of
+            an approximate index against the brute-force result
 
     Returns:
         None
     """
     # load csr matrix
     try:
-        mat = np.load(csr_mat_path)
+        mat = load_csr_matrix(csr_mat_path)
     except FileNotFoundError:
         logger.error("No such directory or file to load the csr matrix. Please try again.")
         sys.exit(1)
     else:
         logger.info("csr matrix is successfully loaded.")
 
+    model = build_model(mat, k, metric, algorithm, ann_params, recall_sample)
+    save_model(model, output_path)
+
+
+@instrument()
+def build_model(mat: Union[np.ndarray, csr_matrix], k: int, metric: str,
+                algorithm: str = "brute", ann_params: Optional[dict] = None,
+                recall_sample: int = 1000) -> Union[NearestNeighbors, LSHIndex]:
+    """Fit a KNN model on an items x users ratings matrix
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        k (`int`): number of neighbors to use
+        metric (`str`): distance metric used for finding neighbors
+        algorithm (`str`): "brute" or "lsh", see :func:`fit_model`
+        ann_params (`dict`): keyword arguments for :class:`src.ann.LSHIndex`
+        recall_sample (`int`): number of items to query when reporting the recall@k of
+            an approximate index
+
+    Returns:
+        model (:obj:`sklearn.neighbors.NearestNeighbors` or :obj:`src.ann.LSHIndex`):
+            fitted model
+    """
     # check input k
     if not (str(k).isdigit() and k > 0):
         logger.error("The input k has to be a positive integer.")
         raise ValueError("The input k has to be a positive integer.")
 
     # fit model
-    try:
-        model = NearestNeighbors(n_neighbors=k+1, algorithm="brute", metric=metric)
-    except ValueError:
-        logger.error("The input metric is not valid")
+    if algorithm == "brute":
+        try:
+            model = NearestNeighbors(n_neighbors=k+1, algorithm="brute", metric=metric)
+        except ValueError:
+            logger.error("The input metric is not valid")
+            sys.exit(1)
+        model.fit(mat)
+    elif algorithm == "lsh":
+        if metric != "cosine":
+            logger.error("The lsh algorithm only supports the cosine metric.")
+            sys.exit(1)
+        try:
+            model = LSHIndex(n_neighbors=k+1, **(ann_params or {})).fit(mat)
+        except (TypeError, ValueError) as err:
+            logger.error("The input `ann_params` is not valid: %s", err)
+            sys.exit(1)
+        recall = evaluate_recall(model, mat, k+1, sample_size=recall_sample)
+        logger.info("Approximate index recall@%d against brute force: %.4f", k+1, recall)
+    else:
+        logger.error("The input algorithm has to be either `brute` or `lsh`.")
         sys.exit(1)
-    model.fit(mat)
 
+    return model
+
+
+@instrument(writes=("output_path",))
+def save_model(model: Union[NearestNeighbors, LSHIndex], output_path: str) -> None:
+    """Save a fitted KNN model
+
+    Args:
+        model (:obj:`sklearn.neighbors.NearestNeighbors` or :obj:`src.ann.LSHIndex`):
+            fitted model
+        output_path (`str`): output path to save model, a `.joblib` file or else a
+            directory of raw arrays that :func:`src.model_store.load_model` memory-maps
+
+    Returns:
+        None
+    """
     # save model
     try:
-        joblib.dump(model, output_path)
+        store_model(model, output_path)
     except FileNotFoundError:
         logger.error("No such directory to save the model. Please try again.")
         sys.exit(1)
@@ -1,17 +1,37 @@
 """This module is to get csr matrix for ratings"""
+import hashlib
 import logging.config
+import os
+import struct
 import sys
+import uuid
+import zipfile
+from typing import Dict, Optional, Tuple, Union
 
 import pandas as pd
 import numpy as np
+from scipy import sparse as sp
 from scipy.sparse import csr_matrix
 
+from src.id_index import IdIndex
+from src.instrument import instrument
+from src.similarity import compare_top_k
+from src.table_io import read_table
+from src.truncate_reviews import filter_reviews
+
 
 logger = logging.getLogger(__name__)
 
+Matrix = Union[np.ndarray, csr_matrix]
+
+# dtypes a ratings matrix can be saved with, int8 with a float32 scale per row
+DTYPES = ("float64", "float32", "int8")
+
 
-def get_csr_matrix(review_data_path: str, item_col: str,
-                   user_col: str, rating_col: str) -> np.ndarray:
+@instrument(reads=("review_data_path",))
+def get_csr_matrix(review_data_path: str, item_col: str, user_col: str, rating_col: str,
+                   sparse: bool = False, return_ids: bool = False
+                   ) -> Union[Matrix, Tuple[Matrix, np.ndarray, np.ndarray]]:
     """Get sparse matrix for recommendation
 
     Args:
@@ -19,19 +39,56 @@ def get_csr_matrix(review_data_path: str, item_col: str,
         item_col (`str`): column name for item id in review data
         user_col (`str`): column name for user id in review data
         rating_col (`str`): column name for ratings in review data
+        sparse (`bool`): if True, encode the ratings straight into a
+            :obj:`scipy.sparse.csr_matrix` instead of a dense pivot table
+        return_ids (`bool`): if True, also return the item id of every row and the
+            user id of every column
 
     Returns:
-        mat (:obj:`numpy.ndarray`): numpy ndarray
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        item_ids (:obj:`numpy.ndarray`): item id of every row, only if `return_ids`
+        user_ids (:obj:`numpy.ndarray`): user id of every column, only if `return_ids`
     """
-    # load review data
+    # load review data, only the item, user and rating columns are needed
     try:
-        review_data = pd.read_csv(review_data_path, index_col=False)
+        review_data = read_table(review_data_path, columns=[item_col, user_col, rating_col])
     except FileNotFoundError:
         logger.error("No such file or directory to load product data. Please try again.")
         sys.exit(1)
+    except KeyError:
+        logger.error("At least one of provided columns is not in provided data")
+        sys.exit(1)
     else:
         logger.info("Review data is successfully loaded.")
 
+    return encode_ratings(review_data, item_col, user_col, rating_col, sparse, return_ids)
+
+
+@instrument()
+def encode_ratings(review_data: pd.DataFrame, item_col: str, user_col: str, rating_col: str,
+                   sparse: bool = False, return_ids: bool = False
+                   ) -> Union[Matrix, Tuple[Matrix, np.ndarray, np.ndarray]]:
+    """Encode review data into an items x users ratings matrix
+
+    Args:
+        review_data (:obj:`pandas.DataFrame`): review data
+        item_col (`str`): column name for item id in review data
+        user_col (`str`): column name for user id in review data
+        rating_col (`str`): column name for ratings in review data
+        sparse (`bool`): if True, encode the ratings straight into a
+            :obj:`scipy.sparse.csr_matrix` instead of a dense pivot table
+        return_ids (`bool`): if True, also return the item id of every row and the
+            user id of every column
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        item_ids (:obj:`numpy.ndarray`): item id of every row, only if `return_ids`
+        user_ids (:obj:`numpy.ndarray`): user id of every column, only if `return_ids`
+    """
+    if sparse:
+        mat, item_ids, user_ids = _encode_sparse(review_data, item_col, user_col, rating_col)
+        return (mat, item_ids, user_ids) if return_ids else mat
+
     # pivot review data to get rating per user per item, fill na with 0
     try:
         pivot_df = review_data.pivot_table(index=item_col, columns=user_col,
@@ -43,24 +100,435 @@ def get_csr_matrix(review_data_path: str, item_col: str,
         logger.info("Review data is successfully pivoted")
     # transform csr matrix to numpy ndarray
     mat = csr_matrix(pivot_df).toarray()
+    if return_ids:
+        return mat, pivot_df.index.to_numpy(), pivot_df.columns.to_numpy()
     return mat
 
 
-def save_csr_matrix(mat: np.ndarray, output_path: str) -> None:
+def _encode_sparse(review_data: pd.DataFrame, item_col: str, user_col: str,
+                   rating_col: str) -> Tuple[csr_matrix, np.ndarray, np.ndarray]:
+    """Encode item/user/rating triplets into a csr matrix without pivoting
+
+    Rows and columns follow the sorted item and user ids, and repeated
+    (item, user) pairs are averaged, so the result matches the dense pivot table.
+
+    Args:
+        review_data (:obj:`pandas.DataFrame`): review data
+        item_col (`str`): column name for item id in review data
+        user_col (`str`): column name for user id in review data
+        rating_col (`str`): column name for ratings in review data
+
+    Returns:
+        mat (:obj:`scipy.sparse.csr_matrix`): items x users ratings
+        item_ids (:obj:`numpy.ndarray`): sorted item id of every row
+        user_ids (:obj:`numpy.ndarray`): sorted user id of every column
+    """
+    try:
+        triplets = review_data[[item_col, user_col, rating_col]].dropna()
+    except KeyError:
+        logger.error("At least one of provided columns is not in provided data")
+        sys.exit(1)
+    item_ids, rows = np.unique(triplets[item_col].to_numpy(), return_inverse=True)
+    user_ids, cols = np.unique(triplets[user_col].to_numpy(), return_inverse=True)
+    ratings = triplets[rating_col].to_numpy(dtype=np.float64)
+    shape = (len(item_ids), len(user_ids))
+
+    # duplicates are summed when converting to csr, so divide by the counts to average them
+    mat = sp.coo_matrix((ratings, (rows, cols)), shape=shape).tocsr()
+    counts = sp.coo_matrix((np.ones_like(ratings), (rows, cols)), shape=shape).tocsr()
+    mat.data /= counts.data
+    logger.info("Review data is successfully encoded into a %d x %d csr matrix "
+                "with %d ratings", shape[0], shape[1], mat.nnz)
+    return mat, item_ids, user_ids
+
+
+def load_csr_matrix(csr_mat_path: str,
+                    mmap_mode: Optional[str] = None) -> Union[np.ndarray, csr_matrix]:
+    """Load a ratings matrix saved by :func:`save_csr_matrix`
+
+    int8 matrices are scaled back to float32 with the scale of their rows.
+
+    Args:
+        csr_mat_path (`str`): path to the matrix, `.npz` for sparse and `.npy` for dense
+        mmap_mode (`str`): memory-map mode of :func:`numpy.load`, e.g. "r" so that
+            processes reading the same matrix share one copy of it in the page cache,
+            read into memory if None. Matrices saved compressed, and int8 matrices once
+            scaled back, are always in memory
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+    """
+    if csr_mat_path.endswith(".npz"):
+        arrays = _map_npz(csr_mat_path, mmap_mode) if mmap_mode else None
+        if arrays is not None and arrays["format"] == b"csr":
+            mat = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                             shape=tuple(arrays["shape"]), copy=False)
+        else:
+            mat = sp.load_npz(csr_mat_path).tocsr()
+    else:
+        mat = np.load(csr_mat_path, mmap_mode=mmap_mode)
+    scale_path = index_paths(csr_mat_path)["scale"]
+    if mat.dtype == np.int8 and os.path.exists(scale_path):
+        mat = restore_matrix(mat, np.load(scale_path))
+    return mat
+
+
+def _map_npz(path: str, mmap_mode: str) -> Optional[Dict[str, np.ndarray]]:
+    """Memory-map the arrays of an uncompressed `.npz` file, None if it is compressed
+
+    Every array of an uncompressed `.npz` file is a `.npy` file stored as it is in the
+    zip archive, so its data starts at a fixed offset of the archive.
+    """
+    headers = {(1, 0): np.lib.format.read_array_header_1_0,
+               (2, 0): np.lib.format.read_array_header_2_0}
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                return None
+            # the member follows its 30 byte local header, which ends with the lengths
+            # of its file name and extra field
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version not in headers:
+                return None
+            shape, fortran_order, dtype = headers[version](f)
+            if dtype.hasobject:
+                return None
+            arrays[os.path.splitext(info.filename)[0]] = np.memmap(
+                path, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape,
+                order="F" if fortran_order else "C")
+    return arrays
+
+
+def convert_matrix(mat: Matrix, dtype: Optional[str]) -> Tuple[Matrix, Optional[np.ndarray]]:
+    """Convert a ratings matrix to the dtype it is saved with
+
+    For int8, every row is divided by its largest absolute rating over 127 and rounded,
+    so each row keeps 8 bits of precision whatever its range.
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        dtype (`str`): one of `DTYPES`, or None to keep the dtype of `mat`
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): converted matrix
+        scale (:obj:`numpy.ndarray`): float32 scale of every row for int8, else None
+
+    Raises:
+        ValueError: if the dtype is not supported
+    """
+    if dtype is None:
+        return mat, None
+    if dtype not in DTYPES:
+        raise ValueError(f"The dtype has to be one of {', '.join(DTYPES)}.")
+    if dtype != "int8":
+        return mat.astype(dtype), None
+
+    if sp.issparse(mat):
+        mat = mat.tocsr()
+        peak = np.asarray(abs(mat).max(axis=1).todense()).ravel()
+    else:
+        peak = np.abs(mat).max(axis=1) if mat.shape[1] > 0 else np.zeros(mat.shape[0])
+    scale = np.where(peak > 0, peak / 127, 1).astype(np.float32)
+    return _quantize(mat, scale), scale
+
+
+def _quantize(mat: Matrix, scale: np.ndarray) -> Matrix:
+    """Divide every row by its scale and round to int8"""
+    if sp.issparse(mat):
+        quantized = mat.copy()
+        quantized.data = np.rint(mat.data / np.repeat(scale, np.diff(mat.indptr)))
+        return quantized.astype(np.int8)
+    return np.rint(mat / scale[:, None]).astype(np.int8)
+
+
+def restore_matrix(mat: Matrix, scale: Optional[np.ndarray]) -> Matrix:
+    """Scale an int8 matrix from :func:`convert_matrix` back to float32 ratings
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): converted matrix
+        scale (:obj:`numpy.ndarray`): scale of every row, None if `mat` is not int8
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+    """
+    if scale is None:
+        return mat
+    if sp.issparse(mat):
+        restored = mat.astype(np.float32)
+        restored.data *= np.repeat(scale, np.diff(restored.indptr))
+        return restored
+    return mat.astype(np.float32) * scale[:, None]
+
+
+@instrument(writes=("output_path",))
+def save_csr_matrix(mat: Union[np.ndarray, csr_matrix], output_path: str,
+                    item_ids: Optional[np.ndarray] = None,
+                    user_ids: Optional[np.ndarray] = None,
+                    dtype: Optional[str] = None,
+                    check_k: Optional[int] = None,
+                    check_sample: Optional[int] = 1000,
+                    check_block_size: int = 1024) -> None:
     """Save csr matrix
 
+    Any pending item changes recorded by :func:`append_ratings` for a previous matrix at
+    the same path are dropped.
+
     Args:
-        mat (:obj:`numpy.ndarray`): csr matrix
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): csr matrix
         output_path (`str`): output path to save csr matrix
+        item_ids (:obj:`numpy.ndarray`): optional item id of every row, saved next to
+            the matrix as an :obj:`src.id_index.IdIndex` for every later stage
+        user_ids (:obj:`numpy.ndarray`): optional user id of every column, saved the same way
+        dtype (`str`): "float64", "float32", or "int8" with a scale per row saved next to
+            the matrix, the dtype of `mat` if None
+        check_k (`int`): if given with `dtype`, report how many top `check_k`
+            neighbor lists change compared with float64 ratings
+        check_sample (`int`): number of items to compare, all items if None
+        check_block_size (`int`): number of items compared per similarity block
 
     Returns:
         None
     """
-    # save the array
+    paths = index_paths(output_path)
+    try:
+        converted, scale = convert_matrix(mat, dtype)
+    except ValueError as err:
+        logger.error(err)
+        sys.exit(1)
+    if check_k and dtype is not None:
+        # the item itself is found too, as recommend_items searches k + 1 neighbors
+        n_items, n_reordered, n_changed = compare_top_k(
+            mat.astype(np.float64, copy=False), restore_matrix(converted, scale),
+            check_k + 1, check_sample, check_block_size)
+        logger.info("Top %d neighbors of %d items with %s ratings compared with float64: "
+                    "%d lists reordered, %d lists with other neighbors.",
+                    check_k, n_items, dtype, n_reordered, n_changed)
+    # save the array, sparse matrices keep their csr components
     try:
-        np.save(output_path, mat)
+        _save_matrix(converted, output_path, scale)
+        if item_ids is not None and user_ids is not None:
+            IdIndex(item_ids).save(paths["items"])
+            IdIndex(user_ids).save(paths["users"])
     except FileNotFoundError:
         logger.error("No such directory to save the results. Please try again.")
         sys.exit(1)
     else:
         logger.info("csr matrix is successfully saved.")
+    if os.path.exists(paths["changes"]):
+        os.remove(paths["changes"])
+
+
+def _save_matrix(mat: Matrix, output_path: str, scale: Optional[np.ndarray]) -> None:
+    """Save a converted matrix, with the scale of its rows if it is int8
+
+    Sparse matrices are saved uncompressed, so that :func:`load_csr_matrix` can
+    memory-map them. The matrix is written next to the old one and renamed over it, so
+    processes that memory-mapped the old one keep valid files.
+    """
+    # numpy adds the extension if it is missing
+    extension = ".npz" if sp.issparse(mat) else ".npy"
+    stem = output_path[:-len(extension)] if output_path.endswith(extension) else output_path
+    tmp_path = f"{stem}.tmp-{uuid.uuid4().hex}{extension}"
+    if sp.issparse(mat):
+        sp.save_npz(tmp_path, mat, compressed=False)
+    else:
+        np.save(tmp_path, mat)
+    os.replace(tmp_path, stem + extension)
+    scale_path = index_paths(output_path)["scale"]
+    if scale is not None:
+        np.save(scale_path, scale)
+    elif os.path.exists(scale_path):
+        os.remove(scale_path)
+
+
+def index_paths(csr_mat_path: str) -> Dict[str, str]:
+    """Get the paths of the files saved next to a matrix
+
+    Args:
+        csr_mat_path (`str`): path to the matrix
+
+    Returns:
+        paths (`dict`): paths to the row item ids (`items`), the column user ids
+            (`users`), the pending item changes (`changes`) and the row scale of an
+            int8 matrix (`scale`)
+    """
+    stem = os.path.splitext(csr_mat_path)[0]
+    return {"items": stem + "_items.npy", "users": stem + "_users.npy",
+            "changes": stem + "_changes.npz", "scale": stem + "_scale.npy"}
+
+
+def load_index(csr_mat_path: str, mmap_mode: Optional[str] = "r") -> Tuple[IdIndex, IdIndex]:
+    """Load the item id of every row and the user id of every column of a matrix
+
+    Args:
+        csr_mat_path (`str`): path to the matrix
+        mmap_mode (`str`): memory-map mode of :func:`numpy.load`, read into memory if None
+
+    Returns:
+        item_index (:obj:`src.id_index.IdIndex`): item id of every row
+        user_index (:obj:`src.id_index.IdIndex`): user id of every column
+
+    Raises:
+        FileNotFoundError: if the ids were not saved with the matrix
+    """
+    paths = index_paths(csr_mat_path)
+    return IdIndex.load(paths["items"], mmap_mode), IdIndex.load(paths["users"], mmap_mode)
+
+
+def load_changes(csr_mat_path: str) -> Optional[Dict[str, np.ndarray]]:
+    """Load the items changed by :func:`append_ratings` since the matrix was last built
+    or its changes were consumed
+
+    Args:
+        csr_mat_path (`str`): path to the matrix
+
+    Returns:
+        changes (`dict`): positions (`rows`) and ids (`items`) of the changed items, and
+            the digest (`base`) of the matrix before the changes, or None if no changes
+    """
+    path = index_paths(csr_mat_path)["changes"]
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as changes:
+        return {"rows": changes["rows"], "items": changes["items"],
+                "base": str(changes["base"])}
+
+
+def clear_changes(csr_mat_path: str) -> None:
+    """Drop the pending item changes of a matrix once neighbors were updated for them
+
+    Args:
+        csr_mat_path (`str`): path to the matrix
+    """
+    path = index_paths(csr_mat_path)["changes"]
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def matrix_digest(mat: Union[np.ndarray, csr_matrix]) -> str:
+    """Hash the content of a matrix, to tell which matrix neighbors were computed on
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+
+    Returns:
+        digest (`str`): hex digest
+    """
+    digest = hashlib.blake2b(str(mat.shape).encode("ASCII"), digest_size=16)
+    arrays = (mat.indptr, mat.indices, mat.data) if sp.issparse(mat) else (mat,)
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+@instrument(reads=("delta_path", "csr_mat_path"), writes=("csr_mat_path",))
+def append_ratings(delta_path: str, csr_mat_path: str, item_col: str, user_col: str,
+                   rating_col: str, product_path: Optional[str] = None,
+                   product_col: Optional[str] = None) -> np.ndarray:
+    """Update a saved sparse matrix in place with a new batch of reviews
+
+    Items and users not seen before get new rows and columns at the end, so the rows of
+    existing items keep their positions. A review of an (item, user) pair that is
+    already in the matrix replaces its rating, as the same review collected again on a
+    later date. The changed items are recorded next to the matrix, so that
+    :func:`src.recommend_products.recommend_items` only searches neighbors again where
+    they can differ.
+
+    Args:
+        delta_path (`str`): path to the new review data
+        csr_mat_path (`str`): path to the `.npz` matrix saved with its ids by
+            :func:`save_csr_matrix`
+        item_col (`str`): column name for item id in review data
+        user_col (`str`): column name for user id in review data
+        rating_col (`str`): column name for ratings in review data
+        product_path (`str`): optional path to product data, to drop reviews of products
+            that are not in it as :func:`src.truncate_reviews.truncate_reviews` does
+        product_col (`str`): product id column in product data
+
+    Returns:
+        changed_items (:obj:`numpy.ndarray`): ids of the items whose vectors changed
+    """
+    if not csr_mat_path.endswith(".npz"):
+        logger.error("Only sparse `.npz` matrices can be appended to.")
+        sys.exit(1)
+    try:
+        mat = load_csr_matrix(csr_mat_path)
+        item_index, user_index = load_index(csr_mat_path, mmap_mode=None)
+    except FileNotFoundError:
+        logger.error("No csr matrix with saved item and user ids to append to. "
+                     "Please run get_csr_matrix first.")
+        sys.exit(1)
+    try:
+        delta = read_table(delta_path, columns=[item_col, user_col, rating_col]).dropna()
+        if product_path is not None:
+            delta = filter_reviews(delta, item_col,
+                                   read_table(product_path, columns=[product_col]),
+                                   product_col)
+    except FileNotFoundError:
+        logger.error("No such file or directory to load review data. Please try again.")
+        sys.exit(1)
+    except KeyError:
+        logger.error("At least one of provided columns is not in provided data")
+        sys.exit(1)
+    else:
+        logger.info("%d new reviews are successfully loaded.", len(delta))
+
+    item_index = item_index.extend(delta[item_col].to_numpy())
+    user_index = user_index.extend(delta[user_col].to_numpy())
+    rows = item_index.positions(delta[item_col].to_numpy())
+    cols = user_index.positions(delta[user_col].to_numpy())
+    shape = (len(item_index), len(user_index))
+    ratings = delta[rating_col].to_numpy(dtype=np.float64)
+    delta_mat = sp.coo_matrix((ratings, (rows, cols)), shape=shape).tocsr()
+    counts = sp.coo_matrix((np.ones_like(ratings), (rows, cols)), shape=shape).tocsr()
+    delta_mat.data /= counts.data
+
+    # keep the dtype the matrix was saved with
+    paths = index_paths(csr_mat_path)
+    dtype = "int8" if os.path.exists(paths["scale"]) else mat.dtype.name
+    base = matrix_digest(mat)
+    mat = mat.copy()
+    mat.resize(shape)
+    pairs = delta_mat.tocoo()
+    previous = np.asarray(mat[pairs.row, pairs.col]).ravel()
+    if dtype == "int8":
+        # a rating of an int8 matrix only changes if it rounds to another step of its row
+        previous_scale = np.load(paths["scale"])
+        steps = np.concatenate([previous_scale, np.full(shape[0] - len(previous_scale),
+                                                        np.nan, np.float32)])[pairs.row]
+        changed = np.rint(previous / steps) != np.rint(pairs.data / steps)
+    else:
+        changed = previous != pairs.data
+    changed_rows = np.unique(pairs.row[changed])
+    # replace the ratings of the new pairs, keeping every other rating
+    mat = (mat - mat.multiply(delta_mat.astype(bool)) + delta_mat).tocsr()
+    if dtype == "int8":
+        # rows that did not change keep their scale, so their vectors stay identical
+        _, scale = convert_matrix(mat, dtype)
+        unchanged = np.setdiff1d(np.arange(len(previous_scale)), changed_rows)
+        scale[unchanged] = previous_scale[unchanged]
+        mat = _quantize(mat, scale)
+    else:
+        mat, scale = convert_matrix(mat, dtype)
+
+    changes = load_changes(csr_mat_path)
+    if changes is not None:
+        changed_rows = np.union1d(changes["rows"], changed_rows)
+        base = changes["base"]
+    try:
+        _save_matrix(mat, csr_mat_path, scale)
+        item_index.save(paths["items"])
+        user_index.save(paths["users"])
+        np.savez(paths["changes"], rows=changed_rows, items=item_index.ids[changed_rows],
+                 base=np.array(base))
+    except FileNotFoundError:
+        logger.error("No such directory to save the results. Please try again.")
+        sys.exit(1)
+    logger.info("csr matrix is updated to %d x %d, vectors of %d items changed.",
+                shape[0], shape[1], len(changed_rows))
+    return item_index.ids[changed_rows]
+
@@ -0,0 +1,108 @@
+"""This module is to map ids to matrix positions and back with arrays saved to disk"""
+import os
+import uuid
+from typing import Optional
+
+import numpy as np
+
+
+class IdIndex:
+    """Two-way mapping between the rows (or columns) of a matrix and their ids
+
+    `ids` holds the id of every position. The ids sorted, and the position each sorted id
+    is at, are kept too, so looking positions up is a vectorized binary search even when
+    the ids are not in sorted order, e.g. after new items were appended. All three
+    arrays are plain `.npy` files that load memory-mapped, without building a dict.
+
+    Args:
+        ids (:obj:`numpy.ndarray`): id of every position
+        sorted_ids (:obj:`numpy.ndarray`): `ids` sorted, computed if None
+        order (:obj:`numpy.ndarray`): position of every sorted id, computed if None
+    """
+    SUFFIXES = ("", "_sorted", "_order")
+
+    def __init__(self, ids: np.ndarray, sorted_ids: Optional[np.ndarray] = None,
+                 order: Optional[np.ndarray] = None):
+        if sorted_ids is None or order is None:
+            order = np.argsort(ids, kind="stable")
+            sorted_ids = ids[order]
+        self.ids = ids
+        self.sorted_ids = sorted_ids
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def positions(self, values: np.ndarray) -> np.ndarray:
+        """Find the position of every id
+
+        Args:
+            values (:obj:`numpy.ndarray`): ids to look up
+
+        Returns:
+            positions (:obj:`numpy.ndarray`): position of every id, -1 if not in the index
+        """
+        values = np.asarray(values)
+        if len(self.ids) == 0:
+            return np.full(values.shape, -1, dtype=np.int64)
+        found_at = np.minimum(np.searchsorted(self.sorted_ids, values), len(self.ids) - 1)
+        return np.where(self.sorted_ids[found_at] == values,
+                        self.order[found_at], -1).astype(np.int64)
+
+    def position(self, value: int) -> Optional[int]:
+        """Find the position of one id
+
+        Args:
+            value (`int`): id to look up
+
+        Returns:
+            position (`int`): position of the id, or None if it is not in the index
+        """
+        position = int(self.positions(np.array([value]))[0])
+        return None if position < 0 else position
+
+    def extend(self, values: np.ndarray) -> "IdIndex":
+        """Append the ids that are not in the index yet, in sorted order
+
+        Args:
+            values (:obj:`numpy.ndarray`): ids, possibly repeated or already indexed
+
+        Returns:
+            index (:obj:`IdIndex`): index with the new ids at the end
+        """
+        values = np.asarray(values)
+        new_ids = np.unique(values[self.positions(values) < 0])
+        return IdIndex(np.concatenate([np.asarray(self.ids), new_ids.astype(self.ids.dtype)]))
+
+    def save(self, path: str) -> None:
+        """Save the index as `.npy` files
+
+        Args:
+            path (`str`): path of the ids, `<stem>.npy`; the sorted ids and their order
+                are saved to `<stem>_sorted.npy` and `<stem>_order.npy`
+        """
+        stem = os.path.splitext(path)[0]
+        for suffix, array in zip(self.SUFFIXES, (self.ids, self.sorted_ids, self.order)):
+            # renamed over the old file, so processes that memory-mapped it keep it
+            tmp_path = f"{stem}{suffix}.tmp-{uuid.uuid4().hex}.npy"
+            np.save(tmp_path, np.asarray(array))
+            os.replace(tmp_path, stem + suffix + ".npy")
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "IdIndex":
+        """Load an index saved by :meth:`save`
+
+        Args:
+            path (`str`): path of the ids, `<stem>.npy`
+            mmap_mode (`str`): memory-map mode of :func:`numpy.load`, read into memory
+                if None
+
+        Returns:
+            index (:obj:`IdIndex`): loaded index
+
+        Raises:
+            FileNotFoundError: if one of the files does not exist
+        """
+        stem = os.path.splitext(path)[0]
+        return cls(*(np.load(stem + suffix + ".npy", mmap_mode=mmap_mode)
+                     for suffix in cls.SUFFIXES))
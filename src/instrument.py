@@ -0,0 +1,363 @@
+"""This module is to measure pipeline functions and app routes, log each call as one
+structured line, and keep totals that can be served in the Prometheus text format"""
+import cProfile
+import functools
+import inspect
+import json
+import logging.config
+import os
+import pstats
+import resource
+import threading
+import time
+import types
+import weakref
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+
+logger = logging.getLogger(__name__)
+
+# total -> Prometheus type and help text, every total is kept per function
+METRICS = {
+    "calls": ("counter", "Calls of an instrumented function."),
+    "errors": ("counter", "Calls of an instrumented function that raised."),
+    "seconds": ("counter", "Wall time spent in an instrumented function, in seconds."),
+    "rows_in": ("counter", "Rows of the data passed to an instrumented function."),
+    "rows_out": ("counter", "Rows of the data returned by an instrumented function."),
+    "bytes_read": ("counter", "Bytes of the files an instrumented function read."),
+    "bytes_written": ("counter", "Bytes of the files an instrumented function wrote."),
+}
+
+
+class MetricsRegistry:
+    """Thread-safe totals of the calls of every instrumented function, per process"""
+    def __init__(self):
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, record: dict) -> None:
+        """Add a call to the totals of its function
+
+        Args:
+            record (`dict`): call record, see :class:`Measurement`
+        """
+        with self._lock:
+            totals = self._totals.setdefault(record["function"],
+                                             {name: 0 for name in METRICS})
+            totals["calls"] += 1
+            totals["errors"] += int(record["error"])
+            for name in ("seconds", "rows_in", "rows_out", "bytes_read", "bytes_written"):
+                totals[name] += record[name] or 0
+
+    def totals(self) -> Dict[str, Dict[str, float]]:
+        """Get a copy of the totals of every function
+
+        Returns:
+            totals (`dict`): function name -> total name -> value
+        """
+        with self._lock:
+            return {function: dict(totals) for function, totals in self._totals.items()}
+
+    def clear(self) -> None:
+        """Drop every total"""
+        with self._lock:
+            self._totals.clear()
+
+    def render(self, prefix: str = "recommender") -> str:
+        """Write the totals and the peak RSS of the process in the Prometheus text format
+
+        Args:
+            prefix (`str`): prefix of the metric names
+
+        Returns:
+            text (`str`): metrics exposition
+        """
+        totals = self.totals()
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            metric = f"{prefix}_function_{name}_total"
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {metric_type}"]
+            lines += [f'{metric}{{function="{_escape(function)}"}} {round(values[name], 6)}'
+                      for function, values in sorted(totals.items())]
+        metric = f"{prefix}_process_peak_rss_bytes"
+        lines += [f"# HELP {metric} Peak resident set size of the process, in bytes.",
+                  f"# TYPE {metric} gauge", f"{metric} {peak_rss_mb() * 2 ** 20:.0f}"]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _escape(value: str) -> str:
+    """Escape a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def status_mb(field: str) -> Optional[float]:
+    """Read a memory field of `/proc/self/status`, such as `VmRSS`, in megabytes
+
+    Args:
+        field (`str`): field name
+
+    Returns:
+        size (`float`): size in megabytes, None if the platform has no such field
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="ASCII") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the process to its current size, through
+    `/proc/self/clear_refs` on Linux
+
+    Returns:
+        reset (`bool`): whether the platform allows it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ASCII") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb() -> float:
+    """Get the peak resident set size of the process since :func:`reset_peak_rss`, or
+    since the process started if it cannot be reset, in megabytes"""
+    peak = status_mb("VmHWM")
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return peak
+
+
+# calls being measured, and the lock their peaks are read and reset under
+_RUNNING: "weakref.WeakSet[Measurement]" = weakref.WeakSet()
+_PEAK_LOCK = threading.Lock()
+
+
+def data_rows(value: Any) -> Optional[int]:
+    """Count the rows of a dataframe, an array, a matrix, or a list of chunks of them
+
+    A tuple counts as its first element, as in the `(matrix, item_ids, user_ids)`
+    returned by :func:`src.get_csr_matrix.get_csr_matrix`.
+
+    Args:
+        value (`Any`): data
+
+    Returns:
+        rows (`int`): number of rows, None if `value` is not data
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, np.ndarray) or sp.issparse(value):
+        return value.shape[0] if value.ndim > 0 else None
+    if isinstance(value, tuple) and value:
+        return data_rows(value[0])
+    if isinstance(value, list) and value:
+        rows = [data_rows(chunk) for chunk in value]
+        return None if None in rows else sum(rows)
+    return None
+
+
+def path_bytes(path: Any) -> Optional[int]:
+    """Get the size of a file, or of every file under a directory
+
+    Args:
+        path (`Any`): path, anything but a string is ignored
+
+    Returns:
+        size (`int`): size in bytes, None if there is no such file
+    """
+    if not isinstance(path, str) or not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(path) for name in names)
+    return os.path.getsize(path)
+
+
+def _sum_bytes(paths: Iterable[Any]) -> Optional[int]:
+    """Total size of the paths that exist, None if none of them does"""
+    sizes = [size for size in map(path_bytes, paths) if size is not None]
+    return sum(sizes) if sizes else None
+
+
+class Measurement:
+    """Measures one call from its creation until :meth:`finish`
+
+    The record of the call holds the `function` name, wall time in `seconds`, `rows_in`
+    and `rows_out`, `bytes_read` from the input files as they were before the call,
+    `bytes_written` to the output files as they are after it, the `peak_rss_mb` of the
+    process during the call, and whether the call raised an `error`.
+
+    The peak is reset when a call starts, after the calls in progress, such as the stage
+    around a function, took the peak they had reached. Where the peak cannot be reset,
+    it is the peak of the process so far. Concurrent calls, as in threaded app routes,
+    share the peaks of each other.
+
+    Args:
+        function (`str`): function name
+        rows_in (`int`): rows of the data passed in
+        read_paths (:obj:`list` of `str`): files or directories the call reads
+        write_paths (:obj:`list` of `str`): files or directories the call writes
+        registry (:obj:`MetricsRegistry`): totals to add the call to
+    """
+    def __init__(self, function: str, rows_in: Optional[int] = None,
+                 read_paths: Sequence[Any] = (), write_paths: Sequence[Any] = (),
+                 registry: MetricsRegistry = REGISTRY):
+        self.record: Dict[str, Any] = {"function": function, "rows_in": rows_in,
+                                       "rows_out": None, "bytes_read": _sum_bytes(read_paths)}
+        self._write_paths = write_paths
+        self._registry = registry
+        self._finished = False
+        with _PEAK_LOCK:
+            peak = peak_rss_mb()
+            for measurement in _RUNNING:
+                measurement._peak = max(measurement._peak, peak)
+            reset_peak_rss()
+            self._peak = 0.0
+            _RUNNING.add(self)
+        self._start = time.perf_counter()
+
+    def finish(self, rows_out: Optional[int] = None, error: bool = False) -> dict:
+        """Complete the record, log it as one json line and add it to the totals
+
+        Args:
+            rows_out (`int`): rows of the data returned
+            error (`bool`): whether the call raised
+
+        Returns:
+            record (`dict`): the record of the call
+        """
+        if self._finished:
+            return self.record
+        self._finished = True
+        seconds = time.perf_counter() - self._start
+        with _PEAK_LOCK:
+            self._peak = max(self._peak, peak_rss_mb())
+            _RUNNING.discard(self)
+        self.record.update(seconds=round(seconds, 6),
+                           rows_out=rows_out if rows_out is not None
+                           else self.record["rows_out"],
+                           bytes_written=_sum_bytes(self._write_paths),
+                           peak_rss_mb=round(self._peak, 1), error=error)
+        self._registry.record(self.record)
+        logger.info("metrics %s", json.dumps(self.record, sort_keys=True))
+        return self.record
+
+
+@contextmanager
+def track(function: str, rows_in: Optional[int] = None, read_paths: Sequence[Any] = (),
+          write_paths: Sequence[Any] = ()) -> Iterator[dict]:
+    """Measure a block of code as one call
+
+    Args:
+        function (`str`): name to record the block under
+        rows_in (`int`): rows of the data the block starts from
+        read_paths (:obj:`list` of `str`): files or directories the block reads
+        write_paths (:obj:`list` of `str`): files or directories the block writes
+
+    Yields:
+        record (`dict`): the record of the block, `rows_out` can be set inside it
+    """
+    measurement = Measurement(function, rows_in, read_paths, write_paths)
+    try:
+        yield measurement.record
+    except BaseException:
+        measurement.finish(error=True)
+        raise
+    measurement.finish()
+
+
+def instrument(name: Optional[str] = None, reads: Sequence[str] = (),
+               writes: Sequence[str] = ()) -> Callable[[Callable], Callable]:
+    """Decorate a function so that every call is measured, see :class:`Measurement`
+
+    Rows in are the rows of every dataframe, array or matrix argument, and rows out the
+    rows of the return value. A function that returns a generator of chunks is measured
+    until the last chunk is consumed, counting the rows of every chunk.
+
+    Args:
+        name (`str`): name to record calls under, `module.qualname` if None
+        reads (:obj:`list` of `str`): names of the path arguments the function reads
+        writes (:obj:`list` of `str`): names of the path arguments the function writes
+
+    Returns:
+        decorator (`Callable`): function decorator
+    """
+    def decorator(func: Callable) -> Callable:
+        function = name or f"{func.__module__}.{func.__qualname__}"
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            rows = [data_rows(value) for value in arguments.values()]
+            rows = [count for count in rows if count is not None]
+            measurement = Measurement(function, sum(rows) if rows else None,
+                                      [arguments.get(key) for key in reads],
+                                      [arguments.get(key) for key in writes])
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                measurement.finish(error=True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                return _measure_chunks(result, measurement)
+            measurement.finish(rows_out=data_rows(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def _measure_chunks(chunks: Iterator[Any], measurement: Measurement) -> Iterator[Any]:
+    """Pass chunks through, finishing the measurement once they are all consumed"""
+    rows = 0
+    try:
+        for chunk in chunks:
+            rows += data_rows(chunk) or 0
+            yield chunk
+    except BaseException:
+        measurement.finish(rows_out=rows, error=True)
+        raise
+    measurement.finish(rows_out=rows)
+
+
+@contextmanager
+def profiled(directory: Optional[str], name: str) -> Iterator[None]:
+    """Run a block under cProfile and save its statistics, if a directory is given
+
+    The statistics are saved to `<directory>/<name>.prof`, for :mod:`pstats` or a
+    viewer such as snakeviz, and the 30 functions with the most cumulative time to
+    `<directory>/<name>.txt`.
+
+    Args:
+        directory (`str`): directory to save the statistics to, no profiling if None
+        name (`str`): file name of the statistics, without extension
+    """
+    if directory is None:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        path = os.path.join(directory, name + ".prof")
+        profile.dump_stats(path)
+        with open(os.path.join(directory, name + ".txt"), "w", encoding="utf-8") as f:
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(30)
+        logger.info("cProfile statistics of %s are saved to %s", name, path)
@@ -0,0 +1,217 @@
+"""This module is to save fitted KNN models as raw arrays that load memory-mapped
+
+A model directory holds a small `metadata.json` and one `.npy` file per array, so
+loading a model only maps its files: start-up time does not grow with the matrix, and
+processes loading the same model share one copy of it in the page cache."""
+import json
+import logging.config
+import os
+import shutil
+import uuid
+from typing import Any, Optional, Tuple, Union
+
+import joblib
+import numpy as np
+from scipy import sparse as sp
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import NearestNeighbors
+from sklearn.random_projection import SparseRandomProjection
+
+from src.ann import LSHIndex
+from src.similarity import load_matrix_arrays, normalize_rows, save_matrix_arrays
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+METADATA = "metadata.json"
+
+Matrix = Union[np.ndarray, csr_matrix]
+
+
+class BruteIndex:
+    """Exact neighbor search over a memory-mapped matrix, with the interface of
+    :class:`sklearn.neighbors.NearestNeighbors`
+
+    Brute force search keeps nothing but the matrix, so the model is only built, with a
+    copy of the matrix, the first time :meth:`kneighbors` is called. The blocked top-k
+    engine and the online index only read `algorithm` and `metric`, and the online
+    index scores the items of cosine models with the row-normalized matrix and its
+    transpose.
+
+    Args:
+        items (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        n_neighbors (`int`): default number of neighbors to return
+        metric (`str`): distance metric
+        normalized (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): `items` with
+            every row scaled to unit length, if saved with a cosine model
+        normalized_t (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): users x
+            items transpose of `normalized`, if saved with the model
+    """
+    algorithm = "brute"
+
+    def __init__(self, items: Matrix, n_neighbors: int, metric: str,
+                 normalized: Optional[Matrix] = None, normalized_t: Optional[Matrix] = None):
+        self.items = items
+        self.n_neighbors = n_neighbors
+        self.metric = metric
+        self.normalized = normalized
+        self.normalized_t = normalized_t
+        self._model: Optional[NearestNeighbors] = None
+
+    def kneighbors(self, X: Optional[Matrix] = None, n_neighbors: Optional[int] = None,
+                   return_distance: bool = True
+                   ) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """Find exact neighbors, see :meth:`sklearn.neighbors.NearestNeighbors.kneighbors`"""
+        if self._model is None:
+            self._model = NearestNeighbors(n_neighbors=self.n_neighbors, algorithm="brute",
+                                           metric=self.metric).fit(self.items)
+        return self._model.kneighbors(X, n_neighbors, return_distance)
+
+
+def save_model(model: Any, output_path: str) -> None:
+    """Save a fitted model, with joblib if the path ends with `.joblib`, or else as a
+    directory of raw arrays, see :func:`swap_directory`
+
+    Args:
+        model (:obj:`sklearn.neighbors.NearestNeighbors` or :obj:`src.ann.LSHIndex`):
+            fitted model
+        output_path (`str`): path to the model file or directory
+
+    Raises:
+        FileNotFoundError: if the parent directory does not exist
+    """
+    if output_path.endswith(".joblib"):
+        joblib.dump(model, output_path)
+        return
+    output_path = output_path.rstrip("/")
+    if not os.path.isdir(os.path.dirname(output_path) or "."):
+        raise FileNotFoundError(f"No such directory: {os.path.dirname(output_path)}")
+
+    # write a new version and swap, so processes mapping the old one keep valid files
+    version_dir = version_directory(output_path)
+    metadata = {"format_version": FORMAT_VERSION, "algorithm": model.algorithm,
+                "metric": model.metric, "n_neighbors": model.n_neighbors}
+    if isinstance(model, LSHIndex):
+        metadata.update(n_tables=model.n_tables, n_bits=model.n_bits,
+                        random_state=model.random_state)
+        save_matrix_arrays(model.items, version_dir, "items_")
+        save_matrix_arrays(model.projection.components_, version_dir, "projection_")
+        np.save(os.path.join(version_dir, "sorted_codes.npy"), model.sorted_codes)
+        np.save(os.path.join(version_dir, "orders.npy"), model.orders)
+    else:
+        # the training matrix a brute force NearestNeighbors model keeps
+        items = model.items if isinstance(model, BruteIndex) else model._fit_X
+        save_matrix_arrays(items, version_dir, "items_")
+        # what the online index scores cosine models with, so that it only has to map them
+        if model.metric == "cosine":
+            normalized = normalize_rows(items)
+            save_matrix_arrays(normalized, version_dir, "normalized_")
+            if sp.issparse(normalized):
+                save_matrix_arrays(normalized.T.tocsr(), version_dir, "normalized_t_")
+    with open(os.path.join(version_dir, METADATA), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+
+    swap_directory(version_dir, output_path)
+
+
+def version_directory(output_path: str) -> str:
+    """Create an empty directory to write a new version of the artifact at a path to,
+    under `.versions/<name>/` next to it
+
+    Args:
+        output_path (`str`): path of the artifact
+
+    Returns:
+        version_dir (`str`): new version directory
+    """
+    parent, name = os.path.split(output_path.rstrip("/"))
+    version_dir = os.path.join(parent, ".versions", name, uuid.uuid4().hex)
+    os.makedirs(version_dir)
+    return version_dir
+
+
+def swap_directory(version_dir: str, output_path: str) -> None:
+    """Point the artifact path at a fully written version directory
+
+    The artifact path is a symbolic link to its current version, switched with one
+    atomic rename, so readers either see the old version or the complete new one. The
+    version it pointed at before is kept, for readers that resolved the link just before
+    the switch, and older versions are removed. Readers should resolve the link once,
+    see :func:`load_model`.
+
+    Args:
+        version_dir (`str`): directory from :func:`version_directory`
+        output_path (`str`): path of the artifact
+    """
+    previous = os.path.realpath(output_path) if os.path.islink(output_path) else None
+    link_path = f"{output_path}.link-{uuid.uuid4().hex}"
+    os.symlink(os.path.relpath(version_dir, os.path.dirname(output_path) or "."), link_path)
+    if os.path.isdir(output_path) and not os.path.islink(output_path):
+        # a plain directory, saved before versions were kept, cannot be replaced in one step
+        old_dir = f"{output_path}.old-{uuid.uuid4().hex}"
+        os.rename(output_path, old_dir)
+        os.replace(link_path, output_path)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(link_path, output_path)
+    kept = {os.path.realpath(version_dir), previous}
+    for entry in os.scandir(os.path.dirname(version_dir)):
+        if os.path.realpath(entry.path) not in kept:
+            shutil.rmtree(entry.path)
+
+
+def load_model(model_path: str, mmap_mode: Optional[str] = "r") -> Any:
+    """Load a model saved by :func:`save_model`
+
+    Args:
+        model_path (`str`): path to the model file or directory
+        mmap_mode (`str`): memory-map mode of :func:`numpy.load` for the arrays of a
+            model directory, read into memory if None
+
+    Returns:
+        model (:obj:`BruteIndex`, :obj:`src.ann.LSHIndex` or a joblib-loaded model):
+            fitted model
+
+    Raises:
+        FileNotFoundError: if the model does not exist
+        ValueError: if the model directory has an unknown format
+    """
+    if not os.path.isdir(model_path):
+        return joblib.load(model_path)
+    # read every file from the same version, even if a new one is swapped in meanwhile
+    model_path = os.path.realpath(model_path)
+    with open(os.path.join(model_path, METADATA), "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    if metadata.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unknown model format version {metadata.get('format_version')}")
+    items = load_matrix_arrays(model_path, "items_", mmap_mode)
+
+    if metadata["algorithm"] == "lsh":
+        model = LSHIndex(n_neighbors=metadata["n_neighbors"], n_tables=metadata["n_tables"],
+                         n_bits=metadata["n_bits"], random_state=metadata["random_state"])
+        components = load_matrix_arrays(model_path, "projection_", mmap_mode)
+        model.projection = SparseRandomProjection(n_components=components.shape[0],
+                                                  dense_output=True,
+                                                  random_state=model.random_state)
+        model.projection.components_ = components
+        model.projection.n_components_ = components.shape[0]
+        model.projection.n_features_in_ = components.shape[1]
+        model.items = items
+        model.sorted_codes = np.load(os.path.join(model_path, "sorted_codes.npy"),
+                                     mmap_mode=mmap_mode)
+        model.orders = np.load(os.path.join(model_path, "orders.npy"), mmap_mode=mmap_mode)
+        return model
+    if metadata["algorithm"] == "brute":
+        normalized = normalized_t = None
+        # models saved before the normalized matrix was saved with them have none, and
+        # only cosine models are scored with it
+        cosine = metadata["metric"] == "cosine"
+        if cosine and os.path.exists(os.path.join(model_path, "normalized_dense.npy")):
+            normalized = load_matrix_arrays(model_path, "normalized_", mmap_mode)
+            normalized_t = normalized.T
+        elif cosine and os.path.exists(os.path.join(model_path, "normalized_t_data.npy")):
+            normalized = load_matrix_arrays(model_path, "normalized_", mmap_mode)
+            normalized_t = load_matrix_arrays(model_path, "normalized_t_", mmap_mode)
+        return BruteIndex(items, metadata["n_neighbors"], metadata["metric"], normalized,
+                          normalized_t)
+    raise ValueError(f"Unknown model algorithm {metadata['algorithm']}")
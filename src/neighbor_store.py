@@ -0,0 +1,183 @@
+"""This module is to save the neighbors of every item in compact binary form, and to join
+their product metadata only when they are read
+
+A neighbor store is a directory with an int32 items x k matrix of neighbor positions,
+a float32 matrix of their cosine similarities, or of their distances for models fitted
+with another metric, the item id of every position and the
+product metadata of every item, once. The recommendation table repeats the metadata of
+every neighbor of every item, so the store is about k times smaller."""
+import json
+import logging.config
+import os
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.id_index import IdIndex
+from src.model_store import swap_directory, version_directory
+from src.table_io import read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+METADATA = "metadata.json"
+PRODUCTS = "products.parquet"
+
+
+def save_neighbors(indices: np.ndarray, scores: np.ndarray, item_ids: np.ndarray,
+                   product_data: pd.DataFrame, item_col: str, output_path: str,
+                   metric: str = "cosine") -> None:
+    """Save neighbor positions and scores with the product metadata of every item
+
+    Args:
+        indices (:obj:`numpy.ndarray`): items x k matrix of neighbor row positions,
+            ordered by rank
+        scores (:obj:`numpy.ndarray`): items x k matrix of neighbor cosine similarities,
+            or of neighbor distances if `metric` is not cosine
+        item_ids (:obj:`numpy.ndarray`): item id of every row position
+        product_data (:obj:`pandas.DataFrame`): product data
+        item_col (`str`): column name for item id in product data
+        output_path (`str`): directory to save the store to
+        metric (`str`): distance metric of the model the neighbors were found with
+
+    Raises:
+        FileNotFoundError: if the parent directory does not exist
+    """
+    output_path = output_path.rstrip("/")
+    if not os.path.isdir(os.path.dirname(output_path) or "."):
+        raise FileNotFoundError(f"No such directory: {os.path.dirname(output_path)}")
+
+    version_dir = version_directory(output_path)
+    np.save(os.path.join(version_dir, "indices.npy"), np.asarray(indices, dtype=np.int32))
+    np.save(os.path.join(version_dir, "scores.npy"), np.asarray(scores, dtype=np.float32))
+    IdIndex(np.asarray(item_ids)).save(os.path.join(version_dir, "item_ids.npy"))
+    # each item takes the first product row with its item id, in the product column order
+    products = product_data.drop_duplicates(item_col).set_index(item_col) \
+        .reindex(item_ids).reset_index()[list(product_data.columns)]
+    write_table(products, os.path.join(version_dir, PRODUCTS))
+    with open(os.path.join(version_dir, METADATA), "w", encoding="utf-8") as f:
+        json.dump({"format_version": FORMAT_VERSION, "item_col": item_col, "metric": metric,
+                   "n_items": int(indices.shape[0]), "k": int(indices.shape[1])}, f, indent=2)
+    swap_directory(version_dir, output_path)
+
+
+class NeighborStore:
+    """Reads a store saved by :func:`save_neighbors`
+
+    Neighbor positions and scores stay memory-mapped. Product metadata is only turned
+    into records for the neighbors that are read.
+
+    Args:
+        indices (:obj:`numpy.ndarray`): items x k matrix of neighbor row positions
+        scores (:obj:`numpy.ndarray`): items x k matrix of neighbor cosine similarities,
+            or of neighbor distances if `metric` is not cosine
+        item_index (:obj:`src.id_index.IdIndex`): item id of every row position
+        products (:obj:`pandas.DataFrame`): product metadata of every row position
+        metric (`str`): distance metric of the model the neighbors were found with
+    """
+    def __init__(self, indices: np.ndarray, scores: np.ndarray, item_index: IdIndex,
+                 products: pd.DataFrame, metric: str = "cosine"):
+        self.indices = indices
+        self.scores = scores
+        self.item_index = item_index
+        self.products = products
+        self.metric = metric
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "NeighborStore":
+        """Load a neighbor store
+
+        Args:
+            path (`str`): directory the store was saved to
+            mmap_mode (`str`): memory-map mode of :func:`numpy.load`, read into memory
+                if None
+
+        Returns:
+            store (:obj:`NeighborStore`): loaded store
+
+        Raises:
+            FileNotFoundError: if the store does not exist
+            ValueError: if the store has an unknown format
+        """
+        # read every file from the same version, see :func:`src.model_store.swap_directory`
+        path = os.path.realpath(path)
+        with open(os.path.join(path, METADATA), "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unknown neighbor store format version "
+                             f"{metadata.get('format_version')}")
+        return cls(np.load(os.path.join(path, "indices.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, "scores.npy"), mmap_mode=mmap_mode),
+                   IdIndex.load(os.path.join(path, "item_ids.npy"), mmap_mode=mmap_mode),
+                   read_table(os.path.join(path, PRODUCTS)),
+                   # stores saved before the metric was recorded only held cosine models
+                   metadata.get("metric", "cosine"))
+
+    def __len__(self) -> int:
+        return self.indices.shape[0]
+
+    def recommend(self, itemid: int, k: Optional[int] = None) -> List[dict]:
+        """Get the saved neighbors of an item, with their metadata
+
+        Args:
+            itemid (`int`): input item id
+            k (`int`): number of recommendations, all saved neighbors if None
+
+        Returns:
+            recommendations (:obj:`list` of `dict`): product records with their rank and
+                cosine similarity `score`, or their `distance` if the metric is not
+                cosine, most similar first, with None for missing metadata
+
+        Raises:
+            KeyError: if the item has no saved neighbors
+        """
+        position = self.item_index.position(itemid)
+        if position is None or position >= len(self):
+            raise KeyError(itemid)
+        indices = np.asarray(self.indices[position, :k])
+        scores = np.asarray(self.scores[position, :k])
+        products = self.products.iloc[indices]
+        # items without a product row have missing metadata, which is not valid json
+        records = products.astype(object).where(products.notna(), None) \
+            .to_dict(orient="records")
+        key = "score" if self.metric == "cosine" else "distance"
+        return [dict(record, rank=rank, **{key: float(score)})
+                for rank, (record, score) in enumerate(zip(records, scores), start=1)]
+
+    def to_frame(self, start: int = 0, stop: Optional[int] = None,
+                 columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Expand the neighbors of a range of items into the recommendation table
+
+        Args:
+            start (`int`): first row position
+            stop (`int`): row position to stop before, the last item if None
+            columns (:obj:`list` of `str`): product columns to include, all if None
+
+        Returns:
+            recommendations (:obj:`pd.DataFrame`): one row per (input item, rank) pair, as
+                built by :func:`src.recommend_products.build_recommendations`
+        """
+        indices = np.asarray(self.indices[start:stop])
+        n_items, k = indices.shape
+        products = self.products if columns is None else self.products[columns]
+        recommendations = products.take(indices.ravel()).reset_index(drop=True)
+        recommendations.insert(0, "rank", np.tile(np.arange(1, k + 1), n_items))
+        recommendations.insert(0, "input_itemid", np.repeat(
+            np.asarray(self.item_index.ids[start:start + n_items]), k))
+        return recommendations
+
+    def iter_frames(self, batch_size: int,
+                    columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+        """Expand the recommendation table a batch of about `batch_size` rows at a time
+
+        Args:
+            batch_size (`int`): number of rows per batch, rounded to whole items
+            columns (:obj:`list` of `str`): product columns to include, all if None
+
+        Returns:
+            batches (:obj:`Iterator` of :obj:`pd.DataFrame`): recommendation table batches
+        """
+        items_per_batch = max(1, batch_size // max(1, self.indices.shape[1]))
+        for start in range(0, len(self), items_per_batch):
+            yield self.to_frame(start, start + items_per_batch, columns)
@@ -0,0 +1,125 @@
+"""This module is to answer recommendation queries online from an in-memory index"""
+import logging.config
+from typing import List, Optional
+
+from scipy import sparse as sp
+
+from src.get_csr_matrix import load_csr_matrix, load_index
+from src.model_store import load_model
+from src.similarity import normalize_rows, select_top_k
+from src.table_io import read_table
+
+logger = logging.getLogger(__name__)
+
+
+class OnlineRecommender:
+    """Holds the item matrix, fitted model and product metadata in memory to answer
+    neighbor queries for any item and any k without re-running the batch pipeline.
+
+    Brute force cosine models score the queries with the normalized item matrix. A model
+    directory saved by :func:`src.model_store.save_model` holds it, so it is only
+    memory-mapped and processes serving the same model share one copy of it. Models
+    saved otherwise are scored with the normalized csr matrix, which is computed once
+    when the index is loaded. Models fitted with another metric answer the queries with
+    their own `kneighbors`, on the ratings they were fitted on, and report distances as
+    :class:`src.neighbor_store.NeighborStore` does.
+
+    Args:
+        product_path (`str`): path to the processed product data
+        csr_mat_path (`str`): path to csr matrix, `.npz` for sparse and `.npy` for dense
+        model_path (`str`): path to the fitted model, a `.joblib` file or a model
+            directory whose arrays are memory-mapped
+        item_col (`str`): column name for item id in product data
+
+    Raises:
+        FileNotFoundError: if an artifact is missing, or the matrix was saved without
+            the item id of its rows
+    """
+    def __init__(self, product_path: str, csr_mat_path: str, model_path: str,
+                 item_col: str):
+        product_data = read_table(product_path)
+        self.model = load_model(model_path)
+
+        # row position <-> item id, memory-mapped from the ids saved with the matrix
+        try:
+            self.item_index = load_index(csr_mat_path)[0]
+        except FileNotFoundError as err:
+            raise FileNotFoundError(f"No item ids are saved with the csr matrix "
+                                    f"{csr_mat_path}, please run get_csr_matrix again.") from err
+        self.item_ids = self.item_index.ids
+        # product metadata in row order, turned into records only for the neighbors returned
+        self.products = product_data.drop_duplicates(item_col).set_index(item_col) \
+            .reindex(self.item_ids).reset_index()
+
+        self.metric = getattr(self.model, "metric", "cosine")
+        self.cosine_brute = getattr(self.model, "algorithm", None) == "brute" \
+            and self.metric == "cosine"
+        if self.cosine_brute and getattr(self.model, "normalized", None) is not None:
+            self.items, self.items_t = self.model.normalized, self.model.normalized_t
+        elif getattr(self.model, "algorithm", None) == "lsh":
+            # an approximate index keeps the normalized rows it was fitted on
+            self.items, self.items_t = self.model.items, None
+        elif not self.cosine_brute:
+            # other metrics are queried with the ratings, as in the batch recommendations
+            self.items = getattr(self.model, "items", None)
+            if self.items is None:
+                self.items = load_csr_matrix(csr_mat_path, mmap_mode="r")
+            self.items_t = None
+        else:
+            self.items = normalize_rows(load_csr_matrix(csr_mat_path, mmap_mode="r"))
+            # users x items csr, so a query row touches only the users it rated
+            self.items_t = self.items.T.tocsr() if sp.issparse(self.items) else self.items.T
+        logger.info("Online index is loaded with %d items.", self.items.shape[0])
+
+    def position(self, itemid: int) -> Optional[int]:
+        """Find the matrix row of an item id
+
+        Args:
+            itemid (`int`): item id
+
+        Returns:
+            position (`int`): row position, or None if the item is not in the index, or
+                was appended to the matrix after the model was fitted
+        """
+        position = self.item_index.position(itemid)
+        return position if position is not None and position < self.items.shape[0] else None
+
+    def recommend(self, itemid: int, k: int) -> List[dict]:
+        """Get the k most similar products of an item, with their metadata
+
+        Args:
+            itemid (`int`): input item id
+            k (`int`): number of recommendations
+
+        Returns:
+            recommendations (:obj:`list` of `dict`): product records with their rank and
+                cosine similarity `score`, or their `distance` if the metric is not
+                cosine, most similar first, with None for missing metadata
+
+        Raises:
+            KeyError: if the item is not in the index
+        """
+        position = self.position(itemid)
+        if position is None:
+            raise KeyError(itemid)
+
+        if self.cosine_brute:
+            indices, scores = select_top_k(self.items[position:position + 1] @ self.items_t,
+                                           k + 1)
+            indices, scores = indices[0], scores[0]
+        else:
+            distances, indices = self.model.kneighbors(self.items[position:position + 1],
+                                                       n_neighbors=k + 1)
+            indices = indices[0]
+            scores = 1 - distances[0] if self.metric == "cosine" else distances[0]
+
+        # leave out the input item itself
+        keep = indices != position
+        indices, scores = indices[keep][:k], scores[keep][:k]
+        products = self.products.iloc[indices]
+        # items without a product row have missing metadata, which is not valid json
+        records = products.astype(object).where(products.notna(), None) \
+            .to_dict(orient="records")
+        key = "score" if self.metric == "cosine" else "distance"
+        return [dict(record, rank=rank, **{key: float(score)})
+                for rank, (record, score) in enumerate(zip(records, scores), start=1)]
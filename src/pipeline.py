@@ -0,0 +1,101 @@
+"""This module is to run the whole model pipeline in one process, passing data between
+stages in memory instead of through the interim files"""
+import logging.config
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from src import preprocess_products, preprocess_reviews, truncate_reviews
+from src.get_csr_matrix import convert_matrix, encode_ratings, restore_matrix, save_csr_matrix
+from src.fit_model import build_model, save_model
+from src.instrument import profiled, track
+from src.recommend_products import find_recommendations, save_recommendations
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def timed_stage(name: str, profile_dir: Optional[str] = None) -> Iterator[None]:
+    """Measure a pipeline stage as one call named `pipeline.<name>`, see
+    :func:`src.instrument.track`, and profile it if `profile_dir` is given
+
+    Args:
+        name (`str`): name of the stage
+        profile_dir (`str`): directory to save the cProfile statistics of the stage to,
+            as `pipeline_<name>.prof`
+    """
+    with profiled(profile_dir, "pipeline_" + name), track("pipeline." + name):
+        yield
+
+
+def _without(params: dict, *keys: str) -> dict:
+    """Copy a configuration block without its path keys"""
+    return {key: value for key, value in params.items() if key not in keys}
+
+
+def run_pipeline(config: dict, save_interim: bool = False,
+                 profile_dir: Optional[str] = None) -> None:
+    """Run preprocess, truncate, csr matrix, fit and recommend as one chain
+
+    The model and the recommendations are always saved. The processed products and
+    reviews, the truncated reviews and the csr matrix are only written to their
+    configured paths if `save_interim` is True.
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        save_interim (`bool`): whether to also save the interim data
+        profile_dir (`str`): if given, directory to save the cProfile statistics of
+            every stage to
+
+    Returns:
+        None
+    """
+    with timed_stage("preprocess_products", profile_dir):
+        product_df = preprocess_products.get_aggregated_features(
+            preprocess_products.get_product_features(
+                **config["preprocess_products"]["get_product_features"]),
+            **config["preprocess_products"]["get_aggregated_features"])
+        if save_interim:
+            preprocess_products.save_product_data(
+                product_df, **config["preprocess_products"]["save_product_data"])
+
+    with timed_stage("preprocess_reviews", profile_dir):
+        review_df = preprocess_reviews.get_review_features(
+            **config["preprocess_reviews"]["get_review_features"])
+        if save_interim:
+            preprocess_reviews.save_review_data(
+                review_df, **config["preprocess_reviews"]["save_review_data"])
+
+    with timed_stage("truncate_reviews", profile_dir):
+        truncate_config = config["truncate_reviews"]["truncate_reviews"]
+        review_df = truncate_reviews.filter_reviews(
+            review_df, truncate_config["review_col"],
+            product_df, truncate_config["product_col"])
+        if save_interim:
+            truncate_reviews.save_truncated_review_data(
+                review_df, **config["truncate_reviews"]["save_truncated_review_data"])
+
+    with timed_stage("get_csr_matrix", profile_dir):
+        mat, item_ids, user_ids = encode_ratings(review_df, **_without(
+            config["get_csr_matrix"]["get_csr_matrix"], "review_data_path"), return_ids=True)
+        del review_df
+        save_config = config["get_csr_matrix"]["save_csr_matrix"]
+        if save_interim:
+            save_csr_matrix(mat, **save_config, item_ids=item_ids, user_ids=user_ids)
+        # later stages see the ratings as they are read back from the saved matrix
+        mat = restore_matrix(*convert_matrix(mat, save_config.get("dtype")))
+
+    with timed_stage("fit_model", profile_dir):
+        fit_config = config["fit_model"]["fit_model"]
+        model = build_model(mat, **_without(fit_config, "csr_mat_path", "output_path"))
+        save_model(model, fit_config["output_path"])
+
+    with timed_stage("recommend", profile_dir):
+        recommend_config = _without(config["recommend_products"]["recommend_items"],
+                                    "product_path", "csr_mat_path", "model_path")
+        if not save_interim:
+            recommend_config.pop("neighbors_path", None)
+            recommend_config.pop("scores_path", None)
+        recommendations = find_recommendations(mat, model, product_df, **recommend_config,
+                                               item_ids=item_ids)
+        save_recommendations(
+            recommendations, **config["recommend_products"]["save_recommendations"])
@@ -1,27 +1,42 @@
 """This module is to process product data for recommendation"""
 import sys
 import logging.config
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
+from src.instrument import instrument
+from src.table_io import iter_table, read_table, write_table
+
 logger = logging.getLogger(__name__)
 
 
-def get_product_features(input_path: str, columns: List[str]) -> pd.DataFrame:
+@instrument(reads=("input_path",))
+def get_product_features(input_path: str, columns: List[str], chunksize: Optional[int] = None,
+                         dtype: Optional[Dict[str, str]] = None
+                         ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
     Get features from product data, remove rows with missing values, and reset index
 
     Args:
         input_path (`str`): input path to the product data
         columns (:obj:`list` of `str`): list of column names
+        chunksize (`int`): if given, stream the file instead and return an iterator of
+            chunks of at most this many rows, each reading only `columns` with missing
+            values dropped
+        dtype (:obj:`dict`): column name to dtype to parse the streamed columns with,
+            e.g. `int64` for ids or `category` for repeated strings
 
     Returns:
-        kept_data (:obj:`pandas.DataFrame`): pandas dataframe
+        kept_data (:obj:`pandas.DataFrame`): pandas dataframe, or an iterator of pandas
+            dataframes if `chunksize` is given
     """
+    if chunksize is not None:
+        return stream_features(input_path, columns, chunksize, dtype, "product")
     # read data
     try:
-        data = pd.read_csv(input_path, index_col=False)
+        data = read_table(input_path)
     except FileNotFoundError:
         logger.error("No such file or directory to load product data. Please try again.")
         sys.exit(1)
@@ -40,53 +55,208 @@ def get_product_features(input_path: str, columns: List[str]) -> pd.DataFrame:
     return kept_data
 
 
-def get_aggregated_features(data: pd.DataFrame, group_by: List[str], cols: List[str],
-                            agg_cols: List[str], agg_funs: List[str]) -> pd.DataFrame:
+def stream_features(input_path: str, columns: List[str], chunksize: int,
+                     dtype: Optional[Dict[str, str]], name: str) -> Iterator[pd.DataFrame]:
+    """
+    Open a table file for streaming only `columns`, in chunks with missing values dropped
+
+    Args:
+        input_path (`str`): input path to the data
+        columns (:obj:`list` of `str`): list of column names
+        chunksize (`int`): maximum number of rows per chunk
+        dtype (:obj:`dict`): column name to dtype to cast the columns to once missing
+            values are dropped
+        name (`str`): name of the data for log messages
+
+    Returns:
+        chunks (:obj:`iterator` of :obj:`pandas.DataFrame`): chunks of the kept columns
+    """
+    # open the reader now so that a missing file or column fails here rather than later
+    try:
+        reader = iter_table(input_path, columns, chunksize, _nullable(dtype))
+    except FileNotFoundError:
+        logger.error("No such file or directory to load %s data. Please try again.", name)
+        sys.exit(1)
+    except KeyError:
+        logger.error("At least one of column in provided `columns` "
+                     "is not included in provided data")
+        sys.exit(1)
+    except TypeError as err:
+        logger.error("Provided `dtype` is not valid: %s", err)
+        sys.exit(1)
+    else:
+        logger.info("%s data is successfully opened for streaming.", name.capitalize())
+
+    def chunks() -> Iterator[pd.DataFrame]:
+        try:
+            for chunk in reader:
+                chunk = chunk.dropna()
+                yield chunk if dtype is None else chunk.astype(dtype)
+        except (TypeError, ValueError) as err:
+            logger.error("Columns of the %s data cannot be parsed with provided `dtype`: %s",
+                         name, err)
+            sys.exit(1)
+    return chunks()
+
+
+def _nullable(dtype: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    """Swap integer dtypes for their nullable versions, e.g. `int8` for `Int8`, so that
+    columns with missing values can be parsed, dropped, and only then made compact"""
+    if dtype is None:
+        return None
+    nullable = {}
+    for col, col_dtype in dtype.items():
+        col_dtype = pd.api.types.pandas_dtype(col_dtype)
+        if isinstance(col_dtype, np.dtype) and col_dtype.kind in "iu":
+            col_dtype = f"{'UInt' if col_dtype.kind == 'u' else 'Int'}{col_dtype.itemsize * 8}"
+        nullable[col] = col_dtype
+    return nullable
+
+
+@instrument()
+def get_aggregated_features(data: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                            group_by: List[str], cols: List[str],
+                            agg_cols: List[str], agg_funs: List[str],
+                            keep: str = "last") -> pd.DataFrame:
     """
     Aggregate product data so that each row represents a unique product
 
+    Rows are grouped on the product id, the first column of `group_by`, alone. The other
+    `group_by` columns, such as the category and the name, can change between daily
+    snapshots of a product, so they are not grouped on: each product keeps their values
+    on its first or last row, and is aggregated over all of its rows in one pass.
+
     Args:
-        data (:obj:`pandas.DataFrame`): pandas dataframe
-        group_by (:obj:`list` of `str`): list of column names for group by
+        data (:obj:`pandas.DataFrame`): pandas dataframe, or an iterable of pandas
+            dataframe chunks as streamed by :func:`get_product_features`, which are
+            aggregated chunk by chunk with `sum`, `mean`, `min`, `max` or `count`
+        group_by (:obj:`list` of `str`): product id column, then the columns to keep
+            one value of per product
         cols (:obj:`list` of `str`): list of column names to be aggregated
         agg_cols (:obj:`list` of `str`): list of column names for aggregated columns
         agg_funs: (:obj:`list` of `str`): list of aggregation functions to perform
+        keep (`str`): "first" or "last", the row of each product to take the other
+            `group_by` columns from, in the order of the rows
 
     Returns:
-        agg_df (:obj:`pandas.DataFrame`): pandas dataframe with aggregated features
+        agg_df (:obj:`pandas.DataFrame`): pandas dataframe with aggregated features,
+            sorted by product id
     """
-    # check if input data is a pandas dataframe
-    if not isinstance(data, pd.DataFrame):
+    # check if input data is a pandas dataframe or chunks of them
+    streamed = not isinstance(data, pd.DataFrame)
+    if streamed and (isinstance(data, str) or not isinstance(data, Iterable)):
         logger.error("Input `data` is not a pandas DataFrame.")
         sys.exit(1)
     # map columns to be aggregated to aggregation functions
     if len(cols) != len(agg_funs):
         logger.error("Input `cols` and input `agg_funs` have differnent length.")
         sys.exit(1)
-    else:
-        aggregation_dict = dict(zip(cols, agg_funs))
     # map columns to be aggregated to aggregated column names
     if len(cols) != len(agg_cols):
         logger.error("Input `cols` and input `agg_cols` have differnent length.")
         sys.exit(1)
-    else:
-        columns_dict = dict(zip(cols, agg_cols))
-    # aggregate data with no duplicates
+    if keep not in ("first", "last"):
+        logger.error("Input `keep` has to be first or last.")
+        sys.exit(1)
+    if streamed and not set(agg_funs) <= set(PARTIAL_AGGREGATIONS):
+        logger.error("Streamed data can only be aggregated with %s.",
+                     ", ".join(PARTIAL_AGGREGATIONS))
+        sys.exit(1)
+    key, kept_cols = group_by[0], group_by[1:]
+    named_aggs = {agg_col: (col, fun) for col, agg_col, fun in zip(cols, agg_cols, agg_funs)}
     try:
-        agg_df = data.groupby(group_by, as_index=False) \
-            .agg(aggregation_dict) \
-            .rename(columns=columns_dict) \
-            .drop_duplicates(group_by[0])
+        if streamed:
+            kept, aggregated = _aggregate_chunks(data, key, kept_cols, keep, named_aggs)
+        else:
+            kept = _kept_rows(data, key, kept_cols, keep)
+            aggregated = data.groupby(key, observed=True).agg(**named_aggs)
     except KeyError:
         logger.error("At least one of column in provided `group_by` "
                      "or `cols` is not included in provided data")
         sys.exit(1)
     else:
         logger.info("Data is successfully aggregated.")
+    agg_df = kept.join(aggregated, how="inner").sort_index().reset_index()
+    # categorical columns keep the categories of every row, drop those no product kept
+    for col in kept_cols:
+        if isinstance(agg_df[col].dtype, pd.CategoricalDtype):
+            agg_df[col] = agg_df[col].cat.remove_unused_categories()
 
     return agg_df
 
 
+def _kept_rows(data: pd.DataFrame, key: str, kept_cols: List[str], keep: str) -> pd.DataFrame:
+    """
+    Take the first or last row of each product, which only hashes the integer ids and
+    copies the kept columns of one row per product, categorical or not
+
+    Args:
+        data (:obj:`pandas.DataFrame`): pandas dataframe
+        key (`str`): product id column
+        kept_cols (:obj:`list` of `str`): columns to keep one value of per product
+        keep (`str`): "first" or "last" row to keep
+
+    Returns:
+        kept (:obj:`pandas.DataFrame`): kept columns, indexed by product id
+    """
+    return data.loc[~data[key].duplicated(keep=keep), [key] + kept_cols].set_index(key)
+
+
+# how each aggregation is split into partial aggregates per chunk, then combined
+PARTIAL_AGGREGATIONS = {"sum": ["sum"], "mean": ["sum", "count"], "min": ["min"],
+                        "max": ["max"], "count": ["count"]}
+COMBINE_PARTIALS = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+
+def _aggregate_chunks(chunks: Iterable[pd.DataFrame], key: str, kept_cols: List[str],
+                      keep: str, named_aggs: Dict[str, Tuple[str, str]]
+                      ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Aggregate chunks of data, only keeping one row of partial aggregates per product
+
+    Args:
+        chunks (:obj:`iterable` of :obj:`pandas.DataFrame`): chunks of data
+        key (`str`): product id column to group by
+        kept_cols (:obj:`list` of `str`): columns to keep one value of per product
+        keep (`str`): "first" or "last" row to keep
+        named_aggs (:obj:`dict`): output column name to (column, aggregation function)
+
+    Returns:
+        kept (:obj:`pandas.DataFrame`): kept columns, indexed by product id
+        agg_df (:obj:`pandas.DataFrame`): aggregated columns, indexed by product id
+    """
+    # partial aggregates are named `<output column>:<partial>`
+    partial_aggs = {f"{name}:{partial}": (col, partial)
+                    for name, (col, fun) in named_aggs.items()
+                    for partial in PARTIAL_AGGREGATIONS[fun]}
+    combine_aggs = {name: (name, COMBINE_PARTIALS[partial])
+                    for name, (_, partial) in partial_aggs.items()}
+    kept, partials = None, None
+    for chunk in chunks:
+        chunk_kept = _kept_rows(chunk, key, kept_cols, keep)
+        chunk_partials = chunk.groupby(key, observed=True, sort=False).agg(**partial_aggs)
+        if partials is not None:
+            # earlier chunks come first, so the kept rows follow the order of the rows
+            chunk_kept = pd.concat([kept, chunk_kept])
+            chunk_partials = pd.concat([partials, chunk_partials])
+        # fold into the running partial aggregates so memory stays bounded by the products
+        kept = chunk_kept[~chunk_kept.index.duplicated(keep=keep)]
+        partials = chunk_partials.groupby(level=0, sort=False).agg(**combine_aggs)
+    if partials is None:
+        empty = pd.Index([], name=key)
+        return (pd.DataFrame(columns=kept_cols, index=empty),
+                pd.DataFrame(columns=list(named_aggs), index=empty))
+
+    agg_df = pd.DataFrame(index=partials.index)
+    for name, (_, fun) in named_aggs.items():
+        if fun == "mean":
+            agg_df[name] = partials[f"{name}:sum"] / partials[f"{name}:count"]
+        else:
+            agg_df[name] = partials[f"{name}:{PARTIAL_AGGREGATIONS[fun][0]}"]
+    return kept, agg_df
+
+
+@instrument(writes=("output_path",))
 def save_product_data(data: pd.DataFrame, output_path: str) -> None:
     """
     Save processed product data
@@ -99,7 +269,7 @@ def save_product_data(data: pd.DataFrame, output_path: str) -> None:
     """
     # save product data to given output path
     try:
-        data.to_csv(output_path, index=False)
+        write_table(data, output_path)
     except FileNotFoundError:
         logger.error("No such directory to save product data. Please try again.")
     else:
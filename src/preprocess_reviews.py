@@ -1,27 +1,43 @@
 """This module is to process review data for recommendation"""
 import sys
 import logging.config
-from typing import List
+from typing import Dict, List, Optional
 
 import pandas as pd
 
+from src.preprocess_products import stream_features
+from src.instrument import instrument
+from src.table_io import read_table, write_table
+
 logger = logging.getLogger(__name__)
 
 
-def get_review_features(input_path: str, columns: List[str]) -> pd.DataFrame:
+@instrument(reads=("input_path",))
+def get_review_features(input_path: str, columns: List[str], chunksize: Optional[int] = None,
+                        dtype: Optional[Dict[str, str]] = None) -> pd.DataFrame:
     """
         Get features from product data, remove rows with missing values, and reset index
 
         Args:
             input_path (`str`): input path to the review data
             columns (:obj:`list` of `str`): list of column names
+            chunksize (`int`): if given, stream the file in chunks of at most this many
+                rows, only reading `columns` and dropping missing values per chunk
+            dtype (:obj:`dict`): column name to dtype to parse the streamed columns with,
+                e.g. `int64` for ids or `int8` for ratings
 
         Returns:
             kept_data (:obj:`pandas.DataFrame`): pandas dataframe
         """
+    if chunksize is not None:
+        chunks = list(stream_features(input_path, columns, chunksize, dtype, "review"))
+        kept_data = pd.concat(chunks, ignore_index=True) if chunks \
+            else pd.DataFrame(columns=columns)
+        logger.info("Columns are successfully acquired from the review data.")
+        return kept_data
     # read data
     try:
-        data = pd.read_csv(input_path, index_col=False)
+        data = read_table(input_path)
     except FileNotFoundError:
         logger.error("No such file or directory to load review data. Please try again.")
         sys.exit(1)
@@ -40,6 +56,7 @@ def get_review_features(input_path: str, columns: List[str]) -> pd.DataFrame:
     return kept_data
 
 
+@instrument(writes=("output_path",))
 def save_review_data(data: pd.DataFrame, output_path: str) -> None:
     """
         Save processed review data
@@ -52,7 +69,7 @@ def save_review_data(data: pd.DataFrame, output_path: str) -> None:
         """
     # save product data to given output path
     try:
-        data.to_csv(output_path, index=False)
+        write_table(data, output_path)
     except FileNotFoundError:
         logger.error("No such directory to save review data. Please try again.")
     else:
@@ -1,39 +1,71 @@
 """This module is to generate recommendations"""
 import logging.config
 import sys
+import os
+from typing import Any, Dict, Optional, Tuple, Union
 
 import pandas as pd
 import numpy as np
-import joblib
+from scipy.sparse import csr_matrix
+
+from src.get_csr_matrix import (clear_changes, load_changes, load_csr_matrix, load_index,
+                                 matrix_digest)
+from src.instrument import instrument
+from src.model_store import load_model
+from src.neighbor_store import save_neighbors
+from src.similarity import blocked_top_k, update_top_k
+from src.table_io import read_table
 
 logger = logging.getLogger(__name__)
 
 
+@instrument(reads=("product_path", "csr_mat_path", "model_path"),
+             writes=("neighbors_path", "scores_path", "store_path"))
 def recommend_items(k: int, item_col: str, product_path: str,
-                    csr_mat_path: str, model_path: str) -> pd.DataFrame:
+                    csr_mat_path: str, model_path: str,
+                    block_size: Optional[int] = None,
+                    neighbors_path: Optional[str] = None,
+                    workers: int = 1,
+                    scores_path: Optional[str] = None,
+                    store_path: Optional[str] = None) -> pd.DataFrame:
     """Get product info for neighbors found by model
 
+    If :func:`src.get_csr_matrix.append_ratings` changed some items since the saved
+    neighbors and scores were found by the blocked engine, only the neighbors that can
+    differ are searched again.
+
     Args:
         k (`int`): number of recommendations
         item_col (`str`): column name for item id in product data
         product_path (`str`): path to the product data
-        csr_mat_path (`str`): path to csr matrix
-        model_path (`str`): path to the model
+        csr_mat_path (`str`): path to csr matrix, `.npz` for sparse and `.npy` for dense
+        model_path (`str`): path to the model, a `.joblib` file or a model directory
+        block_size (`int`): if given and the model is brute force, find cosine neighbors
+            with the blocked top-k engine, this many items at a time, instead of one
+            `kneighbors` call on the whole matrix
+        neighbors_path (`str`): optional `.npy` path the blocked engine streams
+            neighbor positions to
+        workers (`int`): number of processes the blocked engine splits the items across,
+            if more than one the blocked engine is used even without `block_size`
+        scores_path (`str`): optional `.npy` path the blocked engine streams neighbor
+            similarities to, needed with `neighbors_path` for incremental updates
+        store_path (`str`): optional directory to also save the neighbors to in compact
+            form, see :func:`src.neighbor_store.save_neighbors`
 
     Returns:
         recommendations (:obj:`pd.DataFrame`): pandas dataframe for recommendations
     """
     # load product data
     try:
-        product_data = pd.read_csv(product_path, index_col=False)
+        product_data = read_table(product_path)
     except FileNotFoundError:
         logger.error("No such file or directory to load product data. Please try again.")
         sys.exit(1)
     else:
         logger.info("Product data is successfully loaded.")
-    # load csr matrix
+    # map the csr matrix, rather than reading it, so start-up does not grow with it
     try:
-        mat = np.load(csr_mat_path)
+        mat = load_csr_matrix(csr_mat_path, mmap_mode="r")
     except FileNotFoundError:
         logger.error("No such directory or file to load the csr matrix. Please try again.")
         sys.exit(1)
@@ -42,44 +74,169 @@ def recommend_items(k: int, item_col: str, product_path: str,
 
     # load model
     try:
-        model = joblib.load(model_path)
+        model = load_model(model_path)
     except FileNotFoundError:
         logger.error("No such file or directory to load model. Please try again.")
         sys.exit(1)
     else:
         logger.info("Fitted model is successfully loaded.")
 
-    # map index to item id
+    # map index to item id with the ids saved with the matrix, memory-mapped
     try:
-        item_inv_mapper = dict(zip(list(range(len(np.unique(product_data[item_col])))),
-                                   np.unique(product_data[item_col])))
-    except KeyError:
-        logger.error("Provided `item_col` is not in product data.")
+        item_ids = load_index(csr_mat_path)[0].ids
+    except FileNotFoundError:
+        logger.error("No item ids are saved with the csr matrix, so its rows cannot be "
+                     "matched to products. Please run get_csr_matrix again.")
         sys.exit(1)
+    changes = load_changes(csr_mat_path)
+
+    recommendations = find_recommendations(mat, model, product_data, k, item_col, block_size,
+                                           neighbors_path, workers, scores_path, item_ids,
+                                           changes, store_path)
+    # neighbors now reflect every change
+    clear_changes(csr_mat_path)
+    return recommendations
+
+
+@instrument(writes=("neighbors_path", "scores_path", "store_path"))
+def find_recommendations(mat: Union[np.ndarray, csr_matrix], model: Any,
+                         product_data: pd.DataFrame, k: int, item_col: str,
+                         block_size: Optional[int] = None,
+                         neighbors_path: Optional[str] = None,
+                         workers: int = 1,
+                         scores_path: Optional[str] = None,
+                         item_ids: Optional[np.ndarray] = None,
+                         changes: Optional[Dict[str, Any]] = None,
+                         store_path: Optional[str] = None) -> pd.DataFrame:
+    """Find the neighbors of every item with a fitted model and get their product info
 
-    # construct pandas dataframe to store recommendations
-    recommendations = pd.DataFrame(columns=["input_itemid", "rank"] + list(product_data.columns))
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        model (`Any`): model fitted on `mat` by :func:`src.fit_model.build_model`
+        product_data (:obj:`pandas.DataFrame`): product data
+        k (`int`): number of recommendations
+        item_col (`str`): column name for item id in product data
+        block_size (`int`): see :func:`recommend_items`
+        neighbors_path (`str`): see :func:`recommend_items`
+        workers (`int`): see :func:`recommend_items`
+        scores_path (`str`): see :func:`recommend_items`
+        item_ids (:obj:`numpy.ndarray`): item id of every row of `mat`, the sorted
+            unique item ids of the product data if None
+        changes (`dict`): items changed since the saved neighbors were found, as loaded
+            by :func:`src.get_csr_matrix.load_changes`
+        store_path (`str`): see :func:`recommend_items`
+
+    Returns:
+        recommendations (:obj:`pd.DataFrame`): pandas dataframe for recommendations
+    """
+    # map index to item id
+    if item_col not in product_data.columns:
+        logger.error("Provided `item_col` is not in product data.")
+        sys.exit(1)
+    if item_ids is None:
+        item_ids = np.unique(product_data[item_col])
 
     # check k
     if not (str(k).isdigit() and k > 0):
         logger.warning("The input `k` is not a positive integer. k = 7 is used.")
         k = 7
 
-    # get product info for each recommendation
-    for i, items in enumerate(model.kneighbors(mat, return_distance=False)):
-        for j in range(1, k+1):
-            neighbor = items[j]
-            # locate product info and add to recommendation dataframe
-            product_info = product_data.loc[product_data[item_col] == item_inv_mapper[neighbor]] \
-                .values.tolist()[0]
-            recommendations.loc[j + k * i] = [item_inv_mapper[i], j] + product_info
-    # reset index for recommendations
-    recommendations = recommendations.reset_index(drop=True)
+    # find neighbors, then drop the first neighbor of each item, which is the item itself.
+    # approximate indexes always answer their own queries
+    metric = getattr(model, "metric", "cosine")
+    if (block_size is None and workers == 1) or getattr(model, "algorithm", None) != "brute":
+        distances, neighbors = model.kneighbors(mat)
+        # cosine similarity for cosine models, other metrics keep their distances
+        scores = 1 - distances if metric == "cosine" else distances
+    elif metric != "cosine":
+        logger.error("The blocked top-k engine only supports models fitted with cosine metric.")
+        sys.exit(1)
+    else:
+        try:
+            neighbors, scores = _search_neighbors(mat, k + 1, block_size or 1024,
+                                                  neighbors_path, scores_path, workers,
+                                                  changes)
+        except ValueError:
+            logger.error("The inputs `block_size` and `workers` have to be positive integers.")
+            sys.exit(1)
+        except FileNotFoundError:
+            logger.error("No such directory to save the neighbors. Please try again.")
+            sys.exit(1)
+    neighbors, scores = neighbors[:, 1:k + 1], scores[:, 1:k + 1]
+    recommendations = build_recommendations(neighbors, item_ids, product_data, item_col)
+    if store_path:
+        try:
+            save_neighbors(neighbors, scores, item_ids, product_data, item_col, store_path,
+                           metric)
+        except FileNotFoundError:
+            logger.error("No such directory to save the neighbor store. Please try again.")
+            sys.exit(1)
+        logger.info("Neighbor store is saved to %s", store_path)
 
     logger.info("Recommendations are successfully obtained.")
     return recommendations
 
 
+def _search_neighbors(mat: Union[np.ndarray, csr_matrix], k: int, block_size: int,
+                      neighbors_path: Optional[str], scores_path: Optional[str],
+                      workers: int, changes: Optional[Dict[str, Any]]
+                      ) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the top-k neighbors with the blocked engine, or only update the saved ones
+    if they were found on the matrix the changes were made to
+
+    The digest of the matrix the neighbors were found on is saved next to them.
+    """
+    previous = None
+    if changes is not None and neighbors_path and scores_path \
+            and os.path.exists(neighbors_path) and os.path.exists(scores_path) \
+            and os.path.exists(neighbors_path + ".digest"):
+        with open(neighbors_path + ".digest", "r", encoding="ASCII") as f:
+            digest = f.read().strip()
+        indices, scores = np.load(neighbors_path), np.load(scores_path)
+        if digest == changes["base"] and indices.shape[1] == k \
+                and indices.shape[0] <= mat.shape[0]:
+            previous = (indices, scores)
+
+    if previous is None:
+        indices, scores = blocked_top_k(mat, k, block_size, neighbors_path=neighbors_path,
+                                        scores_path=scores_path, workers=workers)
+    else:
+        indices, scores = update_top_k(mat, *previous, changes["rows"], block_size)
+        np.save(neighbors_path, indices)
+        if scores_path:
+            np.save(scores_path, scores)
+    if neighbors_path:
+        with open(neighbors_path + ".digest", "w", encoding="ASCII") as f:
+            f.write(matrix_digest(mat))
+    return indices, scores
+
+
+def build_recommendations(neighbors: np.ndarray, item_ids: np.ndarray,
+                          product_data: pd.DataFrame, item_col: str) -> pd.DataFrame:
+    """Turn a matrix of neighbor positions into the recommendation table in one batch
+
+    Args:
+        neighbors (:obj:`numpy.ndarray`): items x k matrix of neighbor row positions,
+            ordered by rank
+        item_ids (:obj:`numpy.ndarray`): item id of each row position
+        product_data (:obj:`pandas.DataFrame`): product data
+        item_col (`str`): column name for item id in product data
+
+    Returns:
+        recommendations (:obj:`pd.DataFrame`): one row per (input item, rank) pair, with
+            missing product info for a neighbor that is not in the product data
+    """
+    n_items, k = neighbors.shape
+    # each neighbor takes the first product row with its item id, as in the neighbor store
+    products = product_data.drop_duplicates(item_col).set_index(item_col)
+    recommendations = products.reindex(item_ids[neighbors.ravel()]).reset_index()
+    recommendations.insert(0, "rank", np.tile(np.arange(1, k + 1), n_items))
+    recommendations.insert(0, "input_itemid", np.repeat(item_ids[:n_items], k))
+    # the product columns keep their order, wherever the item id column is
+    return recommendations[["input_itemid", "rank"] + list(product_data.columns)]
+
+
+@instrument(writes=("output_path",))
 def save_recommendations(data: pd.DataFrame, output_path: str) -> None:
     """Save recommendations to given output path
 
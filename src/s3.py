@@ -1,13 +1,75 @@
-"""This module is to upload and download files from S3 bucket"""
+"""This module is to upload and download files from S3 bucket, sync whole prefixes
+of them, and stream objects straight into the chunked readers"""
+import functools
 import logging.config
+import os
 import re
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
+
+from src.instrument import instrument
 
 logger = logging.getLogger(__name__)
 
+# multipart part size and parts in flight per file, and files in flight per sync
+PART_SIZE_MB = 8
+MAX_CONCURRENCY = 10
+SYNC_WORKERS = 8
+
+NO_CREDENTIALS = ("Please provide AWS credentials via AWS_ACCESS_KEY_ID "
+                  "and AWS_SECRET_ACCESS_KEY env variables.")
+
+
+def get_client(max_connections: int = SYNC_WORKERS * MAX_CONCURRENCY
+               ) -> botocore.client.BaseClient:
+    """Get an S3 client shared by the transfers of the process
+
+    boto3 clients are thread-safe, so concurrent transfers share one client and its
+    connection pool. The default pool fits a sync of `SYNC_WORKERS` files of
+    `MAX_CONCURRENCY` parts each. Transfers that need more connections get a client
+    with a pool of their size, shared with the transfers of the same size.
+
+    Args:
+        max_connections (`int`): number of connections the caller uses at the same time
+
+    Returns:
+        client (:obj:`botocore.client.BaseClient`): S3 client
+    """
+    return _client(max(max_connections, SYNC_WORKERS * MAX_CONCURRENCY))
+
+
+@functools.lru_cache(maxsize=None)
+def _client(max_pool_connections: int) -> botocore.client.BaseClient:
+    """Create the S3 client with a connection pool of a size"""
+    config = botocore.config.Config(max_pool_connections=max_pool_connections)
+    return boto3.session.Session().client("s3", config=config)
+
+
+def transfer_config(part_size_mb: int = PART_SIZE_MB,
+                    max_concurrency: int = MAX_CONCURRENCY) -> TransferConfig:
+    """Get the settings of a multipart transfer
+
+    Args:
+        part_size_mb (`int`): size of each part in megabytes, files up to this size are
+            transferred in one request. S3 needs parts of at least 5 MB
+        max_concurrency (`int`): number of parts of a file transferred at the same time
+
+    Returns:
+        config (:obj:`boto3.s3.transfer.TransferConfig`): transfer settings
+    """
+    part_size = part_size_mb * 2 ** 20
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=max_concurrency, use_threads=max_concurrency > 1)
+
+
+def is_s3(path: str) -> bool:
+    """Whether a path is an S3 URL"""
+    return isinstance(path, str) and path.startswith("s3://")
+
 
 def parse_s3(s3path: str) -> Tuple[str, str]:
     """ split s3 path into bucket and file path
@@ -29,50 +91,174 @@ def parse_s3(s3path: str) -> Tuple[str, str]:
     return s3bucket, s3path
 
 
-def upload_file_to_s3(local_path: str, s3path: str) -> None:
+@instrument(reads=("local_path",))
+def upload_file_to_s3(local_path: str, s3path: str, part_size_mb: int = PART_SIZE_MB,
+                      max_concurrency: int = MAX_CONCURRENCY) -> None:
     """ Upload a file to S3 bucket
 
     Args:
         local_path (`str`): path to data in local
         s3path (`str`): s3 path to upload data
+        part_size_mb (`int`): multipart part size, see :func:`transfer_config`
+        max_concurrency (`int`): parts uploaded at the same time
 
     Returns:
         None
     """
     # parse s3 path
     s3bucket, s3_just_path = parse_s3(s3path)
-    # access s3
-    aws_s3 = boto3.resource("s3")
-    bucket = aws_s3.Bucket(s3bucket)
     # upload file
     try:
-        bucket.upload_file(local_path, s3_just_path)
+        get_client(max_concurrency).upload_file(
+            local_path, s3bucket, s3_just_path,
+            Config=transfer_config(part_size_mb, max_concurrency))
     except botocore.exceptions.NoCredentialsError:
-        logger.error("Please provide AWS credentials via AWS_ACCESS_KEY_ID "
-                     "and AWS_SECRET_ACCESS_KEY env variables.")
+        logger.error(NO_CREDENTIALS)
     else:
         logger.info("Data uploaded from %s to %s", local_path, s3path)
 
 
-def download_file_from_s3(local_path: str, s3path: str) -> None:
+@instrument(writes=("local_path",))
+def download_file_from_s3(local_path: str, s3path: str, part_size_mb: int = PART_SIZE_MB,
+                          max_concurrency: int = MAX_CONCURRENCY) -> None:
     """Download a data file from s3
 
     Args:
         local_path (`str`): the path that will store the downloaded data
         s3path (`str`): the s3 path that the data will be downloaded from
+        part_size_mb (`int`): multipart part size, see :func:`transfer_config`
+        max_concurrency (`int`): parts downloaded at the same time
     Returns:
         None
     """
     # parse s3 path
     s3bucket, s3_just_path = parse_s3(s3path)
-    # access s3 bucket
-    aws_s3 = boto3.resource("s3")
-    bucket = aws_s3.Bucket(s3bucket)
     # download file
     try:
-        bucket.download_file(s3_just_path, local_path)
+        get_client(max_concurrency).download_file(
+            s3bucket, s3_just_path, local_path,
+            Config=transfer_config(part_size_mb, max_concurrency))
     except botocore.exceptions.NoCredentialsError:
-        logger.error("Please provide AWS credentials via AWS_ACCESS_KEY_ID "
-                     "and AWS_SECRET_ACCESS_KEY env variables.")
+        logger.error(NO_CREDENTIALS)
     else:
         logger.info("Data downloaded from %s to %s", s3path, local_path)
+
+
+@instrument()
+def sync_prefix(local_dir: str, s3prefix: str, download: bool = False,
+                workers: int = SYNC_WORKERS, part_size_mb: int = PART_SIZE_MB,
+                max_concurrency: int = MAX_CONCURRENCY) -> int:
+    """Copy every file under a local directory to an S3 prefix, or the other way around
+
+    Like `aws s3 sync`, a file is skipped when the copy on the other side has the same
+    size and is newer. Files are transferred `workers` at a time through the shared
+    client, each in parts of `part_size_mb`.
+
+    Args:
+        local_dir (`str`): local directory, e.g. `data/interim`
+        s3prefix (`str`): S3 prefix, e.g. `s3://bucket/interim`
+        download (`bool`): download the objects under the prefix instead of uploading
+        workers (`int`): number of files transferred at the same time
+        part_size_mb (`int`): multipart part size, see :func:`transfer_config`
+        max_concurrency (`int`): parts of each file transferred at the same time
+
+    Returns:
+        n_files (`int`): number of files transferred
+    """
+    s3bucket, prefix = parse_s3(s3prefix)
+    prefix = prefix.rstrip("/") + "/"
+    client = get_client(workers * max_concurrency)
+    config = transfer_config(part_size_mb, max_concurrency)
+    try:
+        remote = _list_objects(s3bucket, prefix)
+        candidates = list(remote) if download else _list_files(local_dir)
+        names = [name for name in candidates
+                 if not _in_sync(os.path.join(local_dir, *name.split("/")),
+                                 remote.get(name), download)]
+
+        def transfer(name: str) -> None:
+            local_path = os.path.join(local_dir, *name.split("/"))
+            if download:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                client.download_file(s3bucket, prefix + name, local_path, Config=config)
+            else:
+                client.upload_file(local_path, s3bucket, prefix + name, Config=config)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(transfer, names))
+    except botocore.exceptions.NoCredentialsError:
+        logger.error(NO_CREDENTIALS)
+        return 0
+    logger.info("%d files %s, %d already in sync", len(names),
+                f"downloaded from {s3prefix} to {local_dir}" if download
+                else f"uploaded from {local_dir} to {s3prefix}",
+                len(candidates) - len(names))
+    return len(names)
+
+
+def _list_objects(s3bucket: str, prefix: str) -> Dict[str, dict]:
+    """List the objects under a prefix by their key relative to it"""
+    pages = get_client().get_paginator("list_objects_v2").paginate(Bucket=s3bucket,
+                                                                   Prefix=prefix)
+    return {obj["Key"][len(prefix):]: obj for page in pages
+            for obj in page.get("Contents", []) if not obj["Key"].endswith("/")}
+
+
+def _list_files(local_dir: str) -> List[str]:
+    """List the files under a directory by their path relative to it, with / separators"""
+    return [os.path.relpath(os.path.join(root, name), local_dir).replace(os.sep, "/")
+            for root, _, names in os.walk(local_dir) for name in names]
+
+
+def _in_sync(local_path: str, obj: Optional[dict], download: bool) -> bool:
+    """Whether the copy at the destination has the size of the source and is newer"""
+    if obj is None or not os.path.exists(local_path) \
+            or os.path.getsize(local_path) != obj["Size"]:
+        return False
+    # LastModified only has whole seconds
+    local_mtime = int(os.path.getmtime(local_path))
+    remote_mtime = obj["LastModified"].timestamp()
+    return local_mtime >= remote_mtime if download else remote_mtime >= local_mtime
+
+
+def head_object(s3bucket: str, key: str) -> dict:
+    """Get the metadata of an S3 object, such as its `ETag` and `ContentLength`
+
+    Args:
+        s3bucket (`str`): bucket name
+        key (`str`): object key
+
+    Returns:
+        metadata (`dict`): response of `head_object`
+
+    Raises:
+        FileNotFoundError: if there is no such object
+    """
+    try:
+        return get_client().head_object(Bucket=s3bucket, Key=key)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("404", "NoSuchKey", "NoSuchBucket"):
+            raise FileNotFoundError(f"No such object: s3://{s3bucket}/{key}") from err
+        raise
+
+
+def open_s3_stream(s3path: str) -> botocore.response.StreamingBody:
+    """Open an S3 object for reading as a stream, without saving it to local disk
+
+    Args:
+        s3path (`str`): s3 path of the object
+
+    Returns:
+        stream (:obj:`botocore.response.StreamingBody`): file-like body of the object
+
+    Raises:
+        FileNotFoundError: if there is no such object
+    """
+    s3bucket, s3_just_path = parse_s3(s3path)
+    try:
+        response = get_client().get_object(Bucket=s3bucket, Key=s3_just_path)
+    except botocore.exceptions.ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "NoSuchBucket", "404"):
+            raise FileNotFoundError(f"No such object: {s3path}") from err
+        raise
+    return response["Body"]
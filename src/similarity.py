@@ -0,0 +1,308 @@
+"""This module is to find the top-k most similar items block by block"""
+import logging.config
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple, Union
+
+import numpy as np
+from scipy import sparse as sp
+from scipy.sparse import csr_matrix
+from sklearn.preprocessing import normalize
+
+logger = logging.getLogger(__name__)
+
+Matrix = Union[np.ndarray, csr_matrix]
+
+
+def normalize_rows(mat: Matrix) -> Matrix:
+    """Scale every row to unit length so dot products become cosine similarities
+
+    float32 matrices stay float32, which halves the memory and bandwidth of every
+    similarity block; any other matrix is computed in float64.
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): row-normalized matrix
+    """
+    dtype = np.float32 if mat.dtype == np.float32 else np.float64
+    if sp.issparse(mat):
+        return normalize(mat.tocsr().astype(dtype), norm="l2", axis=1)
+    return normalize(np.asarray(mat, dtype=dtype), norm="l2", axis=1)
+
+
+def top_k_block(query: Matrix, items: Matrix, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the k most similar items for a block of normalized query rows
+
+    Args:
+        query (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): normalized query rows
+        items (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): normalized item rows
+        k (`int`): number of neighbors to keep per query row
+
+    Returns:
+        indices (:obj:`numpy.ndarray`): query rows x k item positions, most similar first
+        scores (:obj:`numpy.ndarray`): query rows x k cosine similarities
+    """
+    return select_top_k(query @ items.T, k)
+
+
+def select_top_k(sims: Matrix, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k largest similarities of every row
+
+    Args:
+        sims (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): queries x items
+            similarities
+        k (`int`): number of neighbors to keep per query row
+
+    Returns:
+        indices (:obj:`numpy.ndarray`): query rows x k item positions, most similar first
+        scores (:obj:`numpy.ndarray`): query rows x k similarities
+    """
+    sims = sims.toarray() if sp.issparse(sims) else np.asarray(sims)
+    k = min(k, sims.shape[1])
+    # keep only the k largest per row, then order them by score and position
+    if k < sims.shape[1]:
+        candidates = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+    scores = np.take_along_axis(sims, candidates, axis=1)
+    order = np.lexsort((candidates, -scores), axis=1)
+    return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def blocked_top_k(mat: Matrix, k: int, block_size: int = 1024,
+                  neighbors_path: Optional[str] = None,
+                  scores_path: Optional[str] = None,
+                  workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the k most similar items of every item by cosine similarity, one block at a time
+
+    Only a block_size x items similarity block is held in memory at once per process.
+    When output paths are given, results are written to `.npy` memory maps as each
+    block finishes. With several workers, the query items are split into contiguous
+    shards searched in a process pool; the normalized matrix is shared with the workers
+    through memory-mapped files and shards are merged back in item order.
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+        k (`int`): number of neighbors per item, the item itself included
+        block_size (`int`): number of query rows per block
+        neighbors_path (`str`): optional `.npy` path to stream neighbor positions to
+        scores_path (`str`): optional `.npy` path to stream similarities to
+        workers (`int`): number of worker processes
+
+    Returns:
+        indices (:obj:`numpy.ndarray`): items x k item positions, most similar first
+        scores (:obj:`numpy.ndarray`): items x k cosine similarities
+    """
+    if not (str(block_size).isdigit() and block_size > 0):
+        raise ValueError("The input block_size has to be a positive integer.")
+    if not (str(workers).isdigit() and workers > 0):
+        raise ValueError("The input workers has to be a positive integer.")
+    items = normalize_rows(mat)
+    n_items = items.shape[0]
+    k = min(k, n_items)
+    indices = _allocate(neighbors_path, (n_items, k), np.int64)
+    scores = _allocate(scores_path, (n_items, k), np.float64)
+
+    if workers == 1 or n_items <= block_size:
+        _search_shard(items, k, block_size, 0, n_items, indices, scores)
+    else:
+        shards = _split_shards(n_items, workers)
+        with tempfile.TemporaryDirectory() as shared_dir:
+            save_matrix_arrays(items, shared_dir)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # map yields shard results in submission order, whatever order they finish in
+                results = executor.map(_search_shared_shard,
+                                       [(shared_dir, k, block_size, start, stop)
+                                        for start, stop in shards])
+                for (start, stop), (shard_indices, shard_scores) in zip(shards, results):
+                    indices[start:stop], scores[start:stop] = shard_indices, shard_scores
+                    logger.debug("Shard of items %d to %d is merged", start, stop)
+
+    for result in (indices, scores):
+        if isinstance(result, np.memmap):
+            result.flush()
+    logger.info("Top %d neighbors are successfully found for %d items.", k, n_items)
+    return indices, scores
+
+
+def update_top_k(mat: Matrix, indices: np.ndarray, scores: np.ndarray,
+                 changed_rows: np.ndarray, block_size: int = 1024
+                 ) -> Tuple[np.ndarray, np.ndarray]:
+    """Update the top-k neighbors of every item after some item vectors changed
+
+    Only similarities to changed items can differ, so an unchanged item whose previous
+    neighbors are all unchanged keeps them, merged with the changed items that now score
+    higher. Changed items, rows appended after the previous search and items that had a
+    changed item among their neighbors are searched again from scratch.
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): items x users ratings
+            after the change, rows of new items appended at the end
+        indices (:obj:`numpy.ndarray`): previous items x k neighbor positions
+        scores (:obj:`numpy.ndarray`): previous items x k cosine similarities
+        changed_rows (:obj:`numpy.ndarray`): positions of the items whose vectors changed
+        block_size (`int`): number of query rows per block
+
+    Returns:
+        indices (:obj:`numpy.ndarray`): items x k item positions, most similar first
+        scores (:obj:`numpy.ndarray`): items x k cosine similarities
+    """
+    items = normalize_rows(mat)
+    n_items, n_previous, k = items.shape[0], indices.shape[0], indices.shape[1]
+    changed = np.union1d(changed_rows, np.arange(n_previous, n_items)).astype(np.int64)
+    stale = np.flatnonzero(np.isin(indices, changed).any(axis=1))
+    search = np.union1d(changed, stale)
+    keep = np.setdiff1d(np.arange(n_previous), search)
+
+    new_indices = np.empty((n_items, k), dtype=np.int64)
+    new_scores = np.empty((n_items, k), dtype=np.float64)
+    for start in range(0, len(search), block_size):
+        rows = search[start:start + block_size]
+        new_indices[rows], new_scores[rows] = top_k_block(items[rows], items, k)
+    for start in range(0, len(keep), block_size):
+        rows = keep[start:start + block_size]
+        sims = items[rows] @ items[changed].T
+        sims = sims.toarray() if sp.issparse(sims) else np.asarray(sims)
+        candidates = np.hstack([indices[rows], np.tile(changed, (len(rows), 1))])
+        candidate_scores = np.hstack([scores[rows], sims])
+        order = np.lexsort((candidates, -candidate_scores), axis=1)[:, :k]
+        new_indices[rows] = np.take_along_axis(candidates, order, axis=1)
+        new_scores[rows] = np.take_along_axis(candidate_scores, order, axis=1)
+    logger.info("Top %d neighbors are updated for %d items, %d of them searched again.",
+                k, n_items, len(search))
+    return new_indices, new_scores
+
+
+def compare_top_k(mat: Matrix, other: Matrix, k: int, sample_size: Optional[int] = 1000,
+                  block_size: int = 1024, random_state: int = 0) -> Tuple[int, int, int]:
+    """Count the items whose top-k neighbors differ between two versions of a matrix,
+    e.g. float64 ratings and the same ratings stored with a smaller dtype
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): reference
+            items x users ratings
+        other (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): the same ratings
+            in another form
+        k (`int`): number of neighbors per item, the item itself included
+        sample_size (`int`): number of items to compare, all items if None
+        block_size (`int`): number of sampled items per similarity block, which stays
+            sparse for sparse matrices
+        random_state (`int`): seed of the item sample
+
+    Returns:
+        n_items (`int`): number of items compared
+        n_reordered (`int`): number of items whose neighbor lists are not identical
+        n_changed (`int`): number of items whose sets of neighbors differ
+    """
+    n_items = mat.shape[0]
+    rows = np.arange(n_items)
+    if sample_size is not None and sample_size < n_items:
+        rows = np.sort(np.random.default_rng(random_state).choice(n_items, sample_size,
+                                                                  replace=False))
+    items, other_items = normalize_rows(mat), normalize_rows(other)
+    n_reordered = n_changed = 0
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        indices = _block_top_k_indices(items[block], items, k)
+        other_indices = _block_top_k_indices(other_items[block], other_items, k)
+        n_reordered += int((indices != other_indices).any(axis=1).sum())
+        n_changed += int((np.sort(indices, axis=1)
+                          != np.sort(other_indices, axis=1)).any(axis=1).sum())
+    return len(rows), n_reordered, n_changed
+
+
+def _block_top_k_indices(query: Matrix, items: Matrix, k: int) -> np.ndarray:
+    """Positions of the k most similar items of every query row, ordered by similarity
+    and then by position, without making a sparse similarity block dense"""
+    if not sp.issparse(query):
+        return top_k_block(query, items, k)[0]
+    sims = (query @ items.T).tocsr()
+    n_items = sims.shape[1]
+    k = min(k, n_items)
+    indices = np.empty((sims.shape[0], k), dtype=np.int64)
+    for row in range(sims.shape[0]):
+        stored = sims.indices[sims.indptr[row]:sims.indptr[row + 1]]
+        # items without a stored similarity score 0, so the first ones by position are
+        # the only others that can be among the k largest
+        candidates = np.union1d(stored, np.arange(min(k + len(stored), n_items)))
+        scores = np.zeros(len(candidates), dtype=sims.dtype)
+        scores[np.searchsorted(candidates, stored)] = \
+            sims.data[sims.indptr[row]:sims.indptr[row + 1]]
+        indices[row] = candidates[np.lexsort((candidates, -scores))[:k]]
+    return indices
+
+
+def _search_shard(items: Matrix, k: int, block_size: int, start: int, stop: int,
+                  indices: np.ndarray, scores: np.ndarray) -> None:
+    """Fill indices and scores for query rows start to stop, one block at a time"""
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        block_indices, block_scores = top_k_block(items[block_start:block_stop], items, k)
+        indices[block_start - start:block_stop - start] = block_indices
+        scores[block_start - start:block_stop - start] = block_scores
+        logger.debug("Neighbors found for items %d to %d", block_start, block_stop)
+
+
+def _split_shards(n_items: int, n_shards: int) -> list:
+    """Split item positions into contiguous (start, stop) shards of near-equal size"""
+    bounds = np.linspace(0, n_items, min(n_shards, n_items) + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def save_matrix_arrays(mat: Matrix, directory: str, prefix: str = "") -> None:
+    """Save a matrix as raw `.npy` arrays that can be memory-mapped back
+
+    Args:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): matrix
+        directory (`str`): existing directory to save the arrays to
+        prefix (`str`): prefix of the array file names
+    """
+    if sp.issparse(mat):
+        mat = mat.tocsr()
+        np.save(os.path.join(directory, prefix + "data.npy"), mat.data)
+        np.save(os.path.join(directory, prefix + "indices.npy"), mat.indices)
+        np.save(os.path.join(directory, prefix + "indptr.npy"), mat.indptr)
+        np.save(os.path.join(directory, prefix + "shape.npy"), np.array(mat.shape))
+    else:
+        np.save(os.path.join(directory, prefix + "dense.npy"), mat)
+
+
+def load_matrix_arrays(directory: str, prefix: str = "",
+                       mmap_mode: Optional[str] = "r") -> Matrix:
+    """Load a matrix saved by :func:`save_matrix_arrays`, without copying its arrays
+
+    Args:
+        directory (`str`): directory the arrays were saved to
+        prefix (`str`): prefix of the array file names
+        mmap_mode (`str`): memory-map mode of :func:`numpy.load`, read into memory if None
+
+    Returns:
+        mat (:obj:`numpy.ndarray` or :obj:`scipy.sparse.csr_matrix`): matrix
+    """
+    dense_path = os.path.join(directory, prefix + "dense.npy")
+    if os.path.exists(dense_path):
+        return np.load(dense_path, mmap_mode=mmap_mode)
+    arrays = [np.load(os.path.join(directory, prefix + name + ".npy"), mmap_mode=mmap_mode)
+              for name in ("data", "indices", "indptr")]
+    shape = tuple(np.load(os.path.join(directory, prefix + "shape.npy")))
+    return csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def _search_shared_shard(task: Tuple[str, int, int, int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Worker entry point: search one shard against the memory-mapped item matrix"""
+    shared_dir, k, block_size, start, stop = task
+    items = load_matrix_arrays(shared_dir)
+    indices = np.empty((stop - start, k), dtype=np.int64)
+    scores = np.empty((stop - start, k), dtype=np.float64)
+    _search_shard(items, k, block_size, start, stop, indices, scores)
+    return indices, scores
+
+
+def _allocate(path: Optional[str], shape: Tuple[int, int], dtype: type) -> np.ndarray:
+    """Allocate a result array in memory, or as a `.npy` memory map if a path is given"""
+    if path is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
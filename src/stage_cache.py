@@ -0,0 +1,151 @@
+"""This module is to skip model pipeline stages whose inputs and configuration have not
+changed since their outputs were saved"""
+import hashlib
+import json
+import logging.config
+import os
+from typing import List, Tuple
+
+from src.s3 import head_object, is_s3, parse_s3
+
+logger = logging.getLogger(__name__)
+
+# action -> configuration section, (function, key) of its input and output paths
+STAGES = {
+    "preprocess_products": ("preprocess_products",
+                            [("get_product_features", "input_path")],
+                            [("save_product_data", "output_path")]),
+    "preprocess_reviews": ("preprocess_reviews",
+                           [("get_review_features", "input_path")],
+                           [("save_review_data", "output_path")]),
+    "truncate_reviews": ("truncate_reviews",
+                         [("truncate_reviews", "review_path"),
+                          ("truncate_reviews", "product_path")],
+                         [("save_truncated_review_data", "output_path")]),
+    "get_csr_matrix": ("get_csr_matrix",
+                       [("get_csr_matrix", "review_data_path")],
+                       [("save_csr_matrix", "output_path")]),
+    "fit_model": ("fit_model",
+                  [("fit_model", "csr_mat_path")],
+                  [("fit_model", "output_path")]),
+    "recommend": ("recommend_products",
+                  [("recommend_items", "product_path"),
+                   ("recommend_items", "csr_mat_path"),
+                   ("recommend_items", "model_path")],
+                  [("save_recommendations", "output_path"),
+                   ("recommend_items", "store_path")]),
+}
+SUFFIX = ".fingerprint"
+# settings that only change how fast a stage runs, not what it outputs
+IGNORED_KEYS = {"workers"}
+
+
+def stage_paths(config: dict, action: str) -> Tuple[List[str], List[str]]:
+    """Get the input and output paths of a stage from the model configuration
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        action (`str`): stage name, one of the `run.py model` actions
+
+    Returns:
+        input_paths (:obj:`list` of `str`): files the stage reads
+        output_paths (:obj:`list` of `str`): files the stage writes
+    """
+    section, inputs, outputs = STAGES[action]
+    block = config[section]
+    # optional outputs are left out when they are not configured
+    return ([block[function][key] for function, key in inputs],
+            [block[function][key] for function, key in outputs
+             if block[function].get(key)])
+
+
+def stage_fingerprint(config: dict, action: str) -> str:
+    """Fingerprint the inputs of a stage by their size and modification time, or ETag
+    for S3 objects, together
+    with the stage's configuration block, leaving out the `IGNORED_KEYS` settings
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        action (`str`): stage name, one of the `run.py model` actions
+
+    Returns:
+        fingerprint (`str`): sha256 hex digest, empty if an input is missing
+    """
+    input_paths, _ = stage_paths(config, action)
+    states = []
+    for path in input_paths:
+        try:
+            states.append(_file_state(path))
+        except FileNotFoundError:
+            return ""
+    block = {function: {key: value for key, value in params.items()
+                        if key not in IGNORED_KEYS}
+             for function, params in config[STAGES[action][0]].items()}
+    content = json.dumps({"inputs": states, "config": block}, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def is_up_to_date(config: dict, action: str, fingerprint: str) -> bool:
+    """Check whether every output of a stage exists, was saved from the same inputs
+    and configuration, and was not changed since, e.g. by `append_ratings`
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        action (`str`): stage name, one of the `run.py model` actions
+        fingerprint (`str`): current fingerprint from :func:`stage_fingerprint`
+
+    Returns:
+        up_to_date (`bool`): True if the stage can be skipped
+    """
+    if not fingerprint:
+        return False
+    _, output_paths = stage_paths(config, action)
+    for path in output_paths:
+        try:
+            with open(path + SUFFIX, "r", encoding="ASCII") as f:
+                recorded = f.read().strip()
+        except FileNotFoundError:
+            return False
+        if not os.path.exists(path) or recorded != _record(fingerprint, path):
+            return False
+    return True
+
+
+def record_fingerprint(config: dict, action: str, fingerprint: str) -> None:
+    """Save the fingerprint, with the size and modification time of the output, next to
+    every output of a stage that was written
+
+    Args:
+        config (`dict`): model configuration, as in `config/model_config.yaml`
+        action (`str`): stage name, one of the `run.py model` actions
+        fingerprint (`str`): fingerprint of the inputs the outputs were computed from
+
+    Returns:
+        None
+    """
+    if not fingerprint:
+        return
+    _, output_paths = stage_paths(config, action)
+    for path in output_paths:
+        if os.path.exists(path):
+            with open(path + SUFFIX, "w", encoding="ASCII") as f:
+                f.write(_record(fingerprint, path))
+    logger.info("Fingerprint of %s is recorded next to its outputs.", action)
+
+
+def _record(fingerprint: str, path: str) -> str:
+    """Content of the fingerprint file of an output"""
+    return fingerprint + "\n" + json.dumps(_file_state(path))
+
+
+def _file_state(path: str) -> list:
+    """Size and modification time of a file, or of every file under a directory, or size
+    and ETag of an S3 object, such as a raw csv file that is streamed from S3"""
+    if is_s3(path):
+        head = head_object(*parse_s3(path))
+        return [path, head["ContentLength"], head["ETag"]]
+    if os.path.isdir(path):
+        return [_file_state(os.path.join(root, name))
+                for root, _, names in sorted(os.walk(path)) for name in sorted(names)]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
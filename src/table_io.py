@@ -0,0 +1,246 @@
+"""This module is to read and write tabular data as csv, Parquet or Feather files.
+The format of a file follows its extension, so switching the interim format of the
+pipeline only takes changing the paths in `config/model_config.yaml`. Tables can also
+be read straight from an `s3://` path: csv files are streamed without saving them to
+local disk, other formats are read from the local artifact cache."""
+import os
+from contextlib import contextmanager
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import feather
+
+from src.artifact_store import ArtifactCache
+from src.s3 import is_s3, open_s3_stream
+
+FORMATS = {".csv": "csv", ".parquet": "parquet", ".feather": "feather"}
+
+
+def table_format(path: str) -> str:
+    """Get the format of a table file from its extension
+
+    Args:
+        path (`str`): path to the table file
+
+    Returns:
+        file_format (`str`): "csv", "parquet" or "feather"
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported table file extension `{extension}`, "
+                         f"use one of {', '.join(FORMATS)}.")
+    return FORMATS[extension]
+
+
+def table_columns(path: str) -> List[str]:
+    """Get the column names of a table file without reading its rows
+
+    Args:
+        path (`str`): path to the table file
+
+    Returns:
+        columns (:obj:`list` of `str`): column names
+    """
+    path, file_format = _resolve(path)
+    return _columns(path, file_format)
+
+
+def read_table(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read a table file, only reading the requested columns
+
+    Args:
+        path (`str`): path to the table file
+        columns (:obj:`list` of `str`): columns to read, in this order, all if None
+
+    Returns:
+        data (:obj:`pandas.DataFrame`): pandas dataframe
+
+    Raises:
+        FileNotFoundError: if the file does not exist
+        KeyError: if one of `columns` is not in the file
+    """
+    path, file_format = _resolve(path)
+    if columns is not None:
+        _check_columns(path, file_format, columns)
+    if file_format == "csv":
+        with _reading(path) as source:
+            data = pd.read_csv(source, index_col=False, usecols=columns)
+    elif file_format == "parquet":
+        data = pd.read_parquet(path, columns=columns)
+    else:
+        data = pd.read_feather(path, columns=columns)
+    return data if columns is None else data[columns]
+
+
+def iter_table(path: str, columns: Optional[List[str]] = None, chunksize: int = 100000,
+               dtype: Optional[Dict[str, str]] = None) -> Iterator[pd.DataFrame]:
+    """Open a table file for reading in chunks, only reading the requested columns
+
+    The file is opened, and its columns checked, before the first chunk is requested.
+
+    Args:
+        path (`str`): path to the table file
+        columns (:obj:`list` of `str`): columns to read, in this order, all if None
+        chunksize (`int`): maximum number of rows per chunk
+        dtype (:obj:`dict`): column name to dtype to parse the columns with
+
+    Returns:
+        chunks (:obj:`iterator` of :obj:`pandas.DataFrame`): chunks of the table
+
+    Raises:
+        FileNotFoundError: if the file does not exist
+        KeyError: if one of `columns` is not in the file
+    """
+    path, file_format = _resolve(path)
+    if columns is not None:
+        _check_columns(path, file_format, columns)
+    source = None
+    if file_format == "csv":
+        source = _open_source(path)
+        try:
+            batches = pd.read_csv(source, index_col=False, usecols=columns, dtype=dtype,
+                                  chunksize=chunksize)
+        except BaseException:
+            _close(source, path)
+            raise
+    elif file_format == "parquet":
+        batches = (batch.to_pandas() for batch in
+                   pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        batches = (batch.to_pandas() for batch in table.to_batches(max_chunksize=chunksize))
+
+    def chunks() -> Iterator[pd.DataFrame]:
+        try:
+            for chunk in batches:
+                if columns is not None:
+                    chunk = chunk[columns]
+                yield chunk if dtype is None or file_format == "csv" else chunk.astype(dtype)
+        finally:
+            # close an S3 stream once the reader is exhausted, or closed before that
+            if source is not None:
+                _close(source, path)
+    return chunks()
+
+
+def write_table(data: pd.DataFrame, path: str) -> None:
+    """Write a dataframe to a table file, without its index
+
+    Args:
+        data (:obj:`pandas.DataFrame`): pandas dataframe
+        path (`str`): path to the table file
+
+    Raises:
+        FileNotFoundError: if the directory does not exist
+    """
+    file_format = table_format(path)
+    if not os.path.isdir(os.path.dirname(path) or "."):
+        raise FileNotFoundError(f"No such directory: {os.path.dirname(path)}")
+    if file_format == "csv":
+        data.to_csv(path, index=False)
+    elif file_format == "parquet":
+        data.to_parquet(path, index=False)
+    else:
+        data.reset_index(drop=True).to_feather(path)
+
+
+def write_table_chunks(chunks: Iterable[pd.DataFrame], path: str) -> int:
+    """Write chunks of a dataframe to one table file as they come, without their index
+
+    csv and Parquet files are appended to chunk by chunk, so only one chunk is held in
+    memory. Feather files cannot be appended to, so their chunks are collected as Arrow
+    record batches and written at the end.
+
+    Args:
+        chunks (:obj:`iterable` of :obj:`pandas.DataFrame`): chunks with the same columns
+        path (`str`): path to the table file
+
+    Returns:
+        n_rows (`int`): number of rows written
+
+    Raises:
+        FileNotFoundError: if the directory does not exist
+    """
+    file_format = table_format(path)
+    if not os.path.isdir(os.path.dirname(path) or "."):
+        raise FileNotFoundError(f"No such directory: {os.path.dirname(path)}")
+    n_rows = 0
+    writer = None
+    batches = []
+    try:
+        for chunk in chunks:
+            if file_format == "csv":
+                chunk.to_csv(path, index=False, mode="a" if writer else "w", header=not writer)
+                writer = True
+            elif file_format == "parquet":
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(path, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema,
+                                                 preserve_index=False)
+                writer.write_table(table)
+            else:
+                schema = batches[0].schema if batches else None
+                batches.append(pa.RecordBatch.from_pandas(chunk, schema=schema,
+                                                          preserve_index=False))
+            n_rows += len(chunk)
+    finally:
+        if file_format == "parquet" and writer is not None:
+            writer.close()
+    if file_format == "feather" and batches:
+        feather.write_feather(pa.Table.from_batches(batches), path)
+    elif not writer and not batches:
+        write_table(pd.DataFrame(), path)
+    return n_rows
+
+
+def _resolve(path: str) -> Tuple[str, str]:
+    """Get the path to read a table file from, and its format. csv objects on S3 are
+    streamed, other objects on S3 are read from the artifact cache"""
+    file_format = table_format(path)
+    if is_s3(path) and file_format != "csv":
+        path = ArtifactCache().fetch(path)
+    return path, file_format
+
+
+def _columns(path: str, file_format: str) -> List[str]:
+    """Get the column names of a table file in a known format"""
+    if file_format == "csv":
+        with _reading(path) as source:
+            return list(pd.read_csv(source, nrows=0).columns)
+    if file_format == "parquet":
+        return pq.read_schema(path).names
+    return feather.read_table(path, memory_map=True).schema.names
+
+
+def _open_source(path: str) -> Union[str, IO]:
+    """Open an S3 object as a stream to read it from, or keep a local path as it is"""
+    return open_s3_stream(path) if is_s3(path) else path
+
+
+@contextmanager
+def _reading(path: str) -> Iterator[Union[str, IO]]:
+    """Open a table file to read it once, closing its stream afterwards if it has one"""
+    source = _open_source(path)
+    try:
+        yield source
+    finally:
+        _close(source, path)
+
+
+def _close(source: Union[str, IO], path: str) -> None:
+    """Close the stream a table file was opened as, if it is not a local path"""
+    if source is not path:
+        source.close()
+
+
+def _check_columns(path: str, file_format: str, columns: List[str]) -> None:
+    """Raise a KeyError if one of the columns is not in the table file"""
+    if not is_s3(path) and not os.path.exists(path):
+        raise FileNotFoundError(f"No such file: {path}")
+    missing = set(columns) - set(_columns(path, file_format))
+    if missing:
+        raise KeyError(f"Columns {sorted(missing)} are not in {path}")
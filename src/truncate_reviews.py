@@ -1,14 +1,22 @@
 """This module is to truncate review data for recommendation"""
 import sys
 import logging.config
+from typing import Iterable, Iterator, Optional, Union
 
+import numpy as np
 import pandas as pd
 
+from src.instrument import instrument
+from src.table_io import iter_table, read_table, write_table, write_table_chunks
+
 logger = logging.getLogger(__name__)
 
 
+@instrument(reads=("review_path", "product_path"))
 def truncate_reviews(review_path: str, review_col: str,
-                     product_path: str, product_col: str) -> pd.DataFrame:
+                     product_path: str, product_col: str,
+                     chunksize: Optional[int] = None
+                     ) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """Truncate df2 with df2_col only in df1_col
 
     Args:
@@ -16,46 +24,107 @@ def truncate_reviews(review_path: str, review_col: str,
         review_col (`str`): product id column name in review data
         product_path (`str`): path to product data
         product_col (`str`): product id column in product data
+        chunksize (`int`): if given, stream the review data instead and return an
+            iterator of truncated chunks of at most this many reviews, so that memory is
+            bounded by the product ids rather than the number of reviews
 
     Returns:
-        review_data (:obj:`pandas.DataFrame`): truncated review data with only existing products
+        review_data (:obj:`pandas.DataFrame`): truncated review data with only existing
+            products, or an iterator of truncated chunks if `chunksize` is given
     """
-    # read review data
+    # read product data, only the product id column is needed
     try:
-        review_data = pd.read_csv(review_path, index_col=False)
+        product_data = read_table(product_path, columns=[product_col])
     except FileNotFoundError:
-        logger.error("No such file or directory to load review data. Please try again.")
+        logger.error("No such file or directory to load product data. Please try again.")
+        sys.exit(1)
+    except KeyError:
+        logger.error("Either `review_col` and/or `product_col` does not exist "
+                     "in its corresponding data.")
         sys.exit(1)
     else:
-        logger.info("Review data is successfully loaded.")
+        logger.info("Product data is successfully loaded.")
+    ids = product_ids(product_data, product_col)
 
-    # read product data
+    # read review data
     try:
-        product_data = pd.read_csv(product_path, index_col=False)
+        if chunksize is not None:
+            review_data = iter_table(review_path, chunksize=chunksize)
+        else:
+            review_data = read_table(review_path)
     except FileNotFoundError:
-        logger.error("No such file or directory to load product data. Please try again.")
+        logger.error("No such file or directory to load review data. Please try again.")
         sys.exit(1)
     else:
-        logger.info("Product data is successfully loaded.")
+        logger.info("Review data is successfully loaded.")
+
+    if chunksize is not None:
+        return (_keep_reviews(chunk, review_col, ids) for chunk in review_data)
+    review_data = _keep_reviews(review_data, review_col, ids)
+    logger.info("Review data is successfully truncated.")
+    return review_data
+
+
+@instrument()
+def filter_reviews(review_data: pd.DataFrame, review_col: str,
+                   product_data: pd.DataFrame, product_col: str) -> pd.DataFrame:
+    """Keep the reviews of products in the product data
+
+    Args:
+        review_data (:obj:`pandas.DataFrame`): review data
+        review_col (`str`): product id column name in review data
+        product_data (:obj:`pandas.DataFrame`): product data
+        product_col (`str`): product id column in product data
 
-    # truncate review data
+    Returns:
+        review_data (:obj:`pandas.DataFrame`): truncated review data with only existing products
+    """
+    return _keep_reviews(review_data, review_col, product_ids(product_data, product_col))
+
+
+def product_ids(product_data: pd.DataFrame, product_col: str) -> np.ndarray:
+    """Get the sorted unique product ids to truncate reviews with
+
+    Args:
+        product_data (:obj:`pandas.DataFrame`): product data
+        product_col (`str`): product id column in product data
+
+    Returns:
+        ids (:obj:`numpy.ndarray`): sorted unique product ids
+    """
     try:
-        review_data = review_data[review_data[review_col].isin(product_data[product_col])]
+        return np.unique(product_data[product_col].to_numpy())
     except KeyError:
         logger.error("Either `review_col` and/or `product_col` does not exist "
                      "in its corresponding data.")
         sys.exit(1)
-    else:
-        logger.info("Review data is successfully truncated.")
 
+
+def _keep_reviews(review_data: pd.DataFrame, review_col: str, ids: np.ndarray) -> pd.DataFrame:
+    """Keep the reviews whose product id is in the sorted ids, with a binary search per
+    review instead of hashing the product ids again for every chunk"""
+    try:
+        values = review_data[review_col].to_numpy()
+    except KeyError:
+        logger.error("Either `review_col` and/or `product_col` does not exist "
+                     "in its corresponding data.")
+        sys.exit(1)
+    if len(ids) == 0:
+        return review_data.iloc[:0]
+    positions = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+    review_data = review_data[ids[positions] == values]
+    logger.debug("%d reviews are kept after truncation.", len(review_data))
     return review_data
 
 
-def save_truncated_review_data(data: pd.DataFrame, output_path: str) -> None:
+@instrument(writes=("output_path",))
+def save_truncated_review_data(data: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+                               output_path: str) -> None:
     """
         Save processed review data
         Args:
-            data(:obj:`pandas.DataFrame`): pandas dataframe
+            data(:obj:`pandas.DataFrame`): pandas dataframe, or an iterable of chunks as
+                streamed by :func:`truncate_reviews`, which are written as they come
             output_path(`str`): path to output file
 
         Returns:
@@ -63,7 +132,11 @@ def save_truncated_review_data(data: pd.DataFrame, output_path: str) -> None:
         """
     # save product data to given output path
     try:
-        data.to_csv(output_path, index=False)
+        if isinstance(data, pd.DataFrame):
+            write_table(data, output_path)
+        else:
+            n_rows = write_table_chunks(data, output_path)
+            logger.info("%d truncated reviews are streamed to the output file.", n_rows)
     except FileNotFoundError:
         logger.error("No such directory to save review data. Please try again.")
     else:
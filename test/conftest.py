@@ -0,0 +1,25 @@
+"""This module is to share test fixtures"""
+
+import moto
+import pytest
+
+from src.s3 import _client, get_client
+
+
+@pytest.fixture(name="s3")
+def fixture_s3(monkeypatch, tmp_path):
+    """Create a bucket in a mocked S3 and fresh shared clients that talk to it, with
+    the artifact cache in a temporary directory"""
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    # older stand-ins do not understand the checksum trailers of newer clients
+    monkeypatch.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    monkeypatch.setattr("src.artifact_store.CACHE_DIR", str(tmp_path / "artifact_cache"))
+    mock = moto.mock_aws() if hasattr(moto, "mock_aws") else moto.mock_s3()
+    with mock:
+        _client.cache_clear()
+        client = get_client()
+        client.create_bucket(Bucket="test-bucket")
+        yield client
+    _client.cache_clear()
@@ -0,0 +1,98 @@
+"""This module is to test functions to ingest products into the database"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from src.add_products import ProductManager, create_db
+from src.neighbor_store import NeighborStore, save_neighbors
+
+
+def test_add_products(tmp_path):
+    """Test for ingesting recommendations in several batches"""
+    engine_string = f"sqlite:///{tmp_path / 'products.db'}"
+    input_path = tmp_path / "recommendations.csv"
+    pd.read_csv("models/recommendations.csv", nrows=5).to_csv(input_path, index=False)
+    create_db(engine_string)
+    product_manager = ProductManager(engine_string=engine_string)
+    product_manager.add_products(str(input_path), batch_size=2)
+    product_manager.close()
+    df_results = pd.read_sql_table("products", create_engine(engine_string)) \
+        .drop(columns="id")
+    pd.testing.assert_frame_equal(pd.read_csv(input_path), df_results)
+
+
+def test_add_products_neighbor_store(tmp_path):
+    """Test for ingesting recommendations expanded from a neighbor store"""
+    engine_string = f"sqlite:///{tmp_path / 'products.db'}"
+    products = pd.read_csv("models/recommendations.csv", nrows=3).iloc[:, 2:]
+    save_neighbors(np.array([[1, 2], [2, 0], [0, 1]]), np.ones((3, 2)),
+                   products["product_itemid"].to_numpy(), products, "product_itemid",
+                   str(tmp_path / "neighbors"))
+    create_db(engine_string)
+    product_manager = ProductManager(engine_string=engine_string)
+    product_manager.add_products(str(tmp_path / "neighbors"), batch_size=3)
+    product_manager.close()
+    df_results = pd.read_sql_table("products", create_engine(engine_string)) \
+        .drop(columns="id")
+    pd.testing.assert_frame_equal(NeighborStore.load(str(tmp_path / "neighbors")).to_frame(),
+                                  df_results, check_dtype=False)
+
+
+def test_add_products_invalid_input_path(tmp_path):
+    """Test for ingesting recommendations with invalid input data path"""
+    engine_string = f"sqlite:///{tmp_path / 'products.db'}"
+    create_db(engine_string)
+    product_manager = ProductManager(engine_string=engine_string)
+    with pytest.raises(SystemExit) as err:
+        product_manager.add_products("data/sample/invalid_data.csv")
+    assert err.type == SystemExit
+    assert err.value.code == 1
+
+
+def test_create_db_logs_database_error(tmp_path, caplog):
+    """Test for logging the database error when the database cannot be created"""
+    with pytest.raises(SystemExit) as err:
+        create_db(f"sqlite:///{tmp_path / 'missing' / 'products.db'}")
+    assert err.value.code == 1
+    assert "unable to open database file" in caplog.text
+
+
+@pytest.mark.parametrize("diff_only", [False, True])
+def test_refresh_products(tmp_path, diff_only):
+    """Test for refreshing recommendations without duplicating or keeping stale rows"""
+    engine_string = f"sqlite:///{tmp_path / 'products.db'}"
+    old_path, new_path = tmp_path / "old.csv", tmp_path / "new.csv"
+    # four input items with 7 recommendations each
+    recommendations = pd.read_csv("models/recommendations.csv", nrows=28)
+    recommendations.iloc[[*range(14), *range(21, 28)]].to_csv(old_path, index=False)
+    # first item is unchanged, second one has a new neighbor, third one is new
+    # and the fourth one is stale
+    new_recommendations = recommendations.iloc[:21].copy()
+    new_recommendations.loc[13, "product_itemid"] = 7589366746
+    new_recommendations.to_csv(new_path, index=False)
+
+    create_db(engine_string)
+    product_manager = ProductManager(engine_string=engine_string)
+    product_manager.add_products(str(old_path))
+    product_manager.add_products(str(old_path))
+    product_manager.refresh_products(str(new_path), batch_size=5, diff_only=diff_only)
+    product_manager.close()
+    df_results = pd.read_sql_table("products", create_engine(engine_string)) \
+        .drop(columns="id").sort_values(["input_itemid", "rank"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(new_recommendations, df_results)
+
+
+def test_add_products_input_items(tmp_path):
+    """Test for keeping one row per input item in the input_items table"""
+    engine_string = f"sqlite:///{tmp_path / 'products.db'}"
+    input_path = tmp_path / "recommendations.csv"
+    pd.read_csv("models/recommendations.csv", nrows=21).to_csv(input_path, index=False)
+    create_db(engine_string)
+    product_manager = ProductManager(engine_string=engine_string)
+    product_manager.add_products(str(input_path))
+    product_manager.add_products(str(input_path))
+    product_manager.close()
+    df_results = pd.read_sql_table("input_items", create_engine(engine_string))
+    assert sorted(df_results["input_itemid"]) == [674045966, 704464761, 706814827]
@@ -0,0 +1,40 @@
+"""This module is to test the approximate nearest-neighbor index"""
+
+import numpy as np
+import pytest
+from scipy import sparse as sp
+
+from src.ann import LSHIndex, evaluate_recall, recall_at_k
+
+
+def test_lsh_index_falls_back_to_exact():
+    """Test for LSH neighbors matching an exact search when buckets are too small"""
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0],
+                                  [0, 4, 1]]))
+    index = LSHIndex(n_neighbors=4, n_tables=1, n_bits=8, random_state=0).fit(mat)
+    distances, indices = index.kneighbors(mat)
+    assert np.array_equal(indices[:, :2], np.array([[0, 1], [1, 0], [2, 3], [3, 2]]))
+    assert np.allclose(distances[:, 0], 0)
+
+
+def test_evaluate_recall():
+    """Test for reporting recall@k of the LSH index against brute force"""
+    mat = sp.random(200, 40, density=0.2, format="csr", random_state=0)
+    index = LSHIndex(n_neighbors=5, n_tables=8, n_bits=4).fit(mat)
+    recall = evaluate_recall(index, mat, 5, sample_size=50)
+    assert 0 < recall <= 1
+
+
+def test_recall_at_k():
+    """Test for computing recall@k"""
+    approx = np.array([[0, 1, 2], [3, 4, 5]])
+    exact = np.array([[0, 2, 1], [3, 6, 7]])
+    assert recall_at_k(approx, exact) == pytest.approx(4 / 6)
+
+
+def test_lsh_index_invalid_params():
+    """Test for creating the LSH index with invalid parameters"""
+    with pytest.raises(ValueError):
+        LSHIndex(n_tables=0)
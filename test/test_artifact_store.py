@@ -0,0 +1,139 @@
+"""This module is to test reading and writing s3:// paths through the artifact cache"""
+
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from src import preprocess_products
+from src.artifact_store import ArtifactCache, Workspace, action_paths
+from src.stage_cache import is_up_to_date, record_fingerprint, stage_fingerprint
+from src.table_io import read_table
+
+BUCKET = "test-bucket"
+
+
+def test_artifact_cache_fetches_by_etag(s3, tmp_path):
+    """Test for downloading an object once per content and evicting old objects"""
+    cache = ArtifactCache(str(tmp_path / "cache"), max_mb=1.5)
+    s3.put_object(Bucket=BUCKET, Key="a.bin", Body=b"0" * 2 ** 20)
+    s3.put_object(Bucket=BUCKET, Key="copy/a.bin", Body=b"0" * 2 ** 20)
+    first = cache.fetch(f"s3://{BUCKET}/a.bin")
+    mtime = os.stat(first).st_mtime_ns
+    assert cache.fetch(f"s3://{BUCKET}/copy/a.bin") == first
+    assert os.stat(first).st_mtime_ns == mtime
+
+    s3.put_object(Bucket=BUCKET, Key="a.bin", Body=b"1" * 2 ** 20)
+    second = cache.fetch(f"s3://{BUCKET}/a.bin")
+    assert second != first
+    assert open(second, "rb").read(1) == b"1"
+    # the cache only fits one object, so the least recently used one is removed
+    assert not os.path.exists(first)
+    with pytest.raises(FileNotFoundError):
+        cache.fetch(f"s3://{BUCKET}/missing.bin")
+
+
+def test_workspace_publishes_changed_files(s3, tmp_path):
+    """Test for fetching an artifact with the files next to it, and publishing changes"""
+    for key in ["interim/mat.npz", "interim/mat_items.npy", "interim/other.npz",
+                "models/model/a.npy", "models/model/b.npy"]:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+    config = {"fit": {"fit": {"csr_mat_path": f"s3://{BUCKET}/interim/mat.npz",
+                              "output_path": f"s3://{BUCKET}/models/model", "k": 7}}}
+    workspace = Workspace(ArtifactCache(str(tmp_path / "cache")))
+    local_config = workspace.localize(config, [config["fit"]["fit"]["csr_mat_path"]],
+                                      [config["fit"]["fit"]["output_path"]])
+    mat_path = local_config["fit"]["fit"]["csr_mat_path"]
+    model_path = local_config["fit"]["fit"]["output_path"]
+    assert local_config["fit"]["fit"]["k"] == 7
+    assert open(mat_path, "rb").read() == b"interim/mat.npz"
+    assert os.path.exists(mat_path.replace("mat.npz", "mat_items.npy"))
+    assert not os.path.exists(mat_path.replace("mat.npz", "other.npz"))
+    assert sorted(os.listdir(model_path)) == ["a.npy", "b.npy"]
+    assert workspace.publish() == 0
+
+    with open(os.path.join(model_path, "a.npy"), "wb") as f:
+        f.write(b"new")
+    os.remove(os.path.join(model_path, "b.npy"))
+    assert workspace.publish() == 1
+    keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert "models/model/b.npy" not in keys
+    assert s3.get_object(Bucket=BUCKET, Key="models/model/a.npy")["Body"].read() == b"new"
+    # the copy that was written is not the cached object it was fetched from
+    assert workspace.cache.fetch(f"s3://{BUCKET}/interim/mat.npz") != mat_path
+
+
+def test_workspace_streams_raw_csv(s3, tmp_path):
+    """Test for leaving csv inputs on S3 for streaming, and fetching other artifacts"""
+    data = pd.DataFrame({"itemid": [1, 2], "cmtid": [3, 4], "rating_star": [5, 4]})
+    for key in ["raw/products.csv", "raw/reviews.csv", "external/delta.csv"]:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=data.to_csv(index=False))
+    s3.put_object(Bucket=BUCKET, Key="interim/products.parquet", Body=b"parquet")
+    s3.put_object(Bucket=BUCKET, Key="interim/mat.npz", Body=b"npz")
+    config = {
+        "preprocess_products": {"get_product_features": {
+            "input_path": f"s3://{BUCKET}/raw/products.csv"}},
+        "preprocess_reviews": {"get_review_features": {
+            "input_path": f"s3://{BUCKET}/raw/reviews.csv"}},
+        "get_csr_matrix": {"append_ratings": {
+            "delta_path": f"s3://{BUCKET}/external/delta.csv",
+            "product_path": f"s3://{BUCKET}/interim/products.parquet",
+            "csr_mat_path": f"s3://{BUCKET}/interim/mat.npz"}}}
+    cache_dir = tmp_path / "cache"
+
+    workspace = Workspace(ArtifactCache(str(cache_dir)))
+    local = workspace.localize(config, *action_paths(config, "pipeline"))
+    for section in ["preprocess_products", "preprocess_reviews"]:
+        function = next(iter(config[section]))
+        assert local[section][function]["input_path"] == config[section][function]["input_path"]
+        pd.testing.assert_frame_equal(read_table(local[section][function]["input_path"]), data)
+    assert not cache_dir.exists() or not any(path.is_file() for path in cache_dir.rglob("*"))
+
+    local = workspace.localize(config, *action_paths(config, "append_ratings"))
+    block = local["get_csr_matrix"]["append_ratings"]
+    assert block["delta_path"] == f"s3://{BUCKET}/external/delta.csv"
+    # other formats are read from the cache, and outputs are fetched to be written
+    assert open(block["product_path"], "rb").read() == b"parquet"
+    assert open(block["csr_mat_path"], "rb").read() == b"npz"
+
+
+def test_stage_on_s3_paths(s3, tmp_path):
+    """Test for running a stage on s3:// paths and skipping it on a fresh machine"""
+    data = pd.DataFrame({"product_itemid": [1, 1, 2], "product_name": ["a", "a", "b"],
+                         "product_category": "Top", "product_price": [1.0, 3.0, 5.0]})
+    s3.put_object(Bucket=BUCKET, Key="raw/products.csv", Body=data.to_csv(index=False))
+    config = {"preprocess_products": {
+        "get_product_features": {"input_path": f"s3://{BUCKET}/raw/products.csv",
+                                 "columns": list(data.columns)},
+        "get_aggregated_features": {"group_by": ["product_itemid", "product_category",
+                                                 "product_name"],
+                                    "cols": ["product_price"], "agg_cols": ["avg_price"],
+                                    "agg_funs": ["mean"]},
+        "save_product_data": {"output_path": f"s3://{BUCKET}/interim/products.parquet"}}}
+
+    def run_stage() -> bool:
+        workspace = Workspace(ArtifactCache(str(tmp_path / "cache")))
+        local = workspace.localize(config, *action_paths(config, "preprocess_products"))
+        # the raw csv is streamed from S3, never saved to the cache or the workspace
+        assert local["preprocess_products"]["get_product_features"]["input_path"] == \
+            f"s3://{BUCKET}/raw/products.csv"
+        assert not os.path.exists(workspace.local_path(f"s3://{BUCKET}/raw/products.csv"))
+        fingerprint = stage_fingerprint(local, "preprocess_products")
+        if is_up_to_date(local, "preprocess_products", fingerprint):
+            return False
+        block = local["preprocess_products"]
+        preprocess_products.save_product_data(
+            preprocess_products.get_aggregated_features(
+                preprocess_products.get_product_features(**block["get_product_features"]),
+                **block["get_aggregated_features"]),
+            **block["save_product_data"])
+        record_fingerprint(local, "preprocess_products", fingerprint)
+        workspace.publish()
+        return True
+
+    assert run_stage()
+    products = read_table(f"s3://{BUCKET}/interim/products.parquet")
+    assert products["avg_price"].tolist() == [2.0, 5.0]
+    shutil.rmtree(tmp_path / "cache")
+    assert not run_stage()
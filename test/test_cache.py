@@ -0,0 +1,36 @@
+"""This module is to test the in-process LRU cache"""
+
+import time
+
+import pytest
+
+from src.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """Test for evicting the least recently used entry when the cache is full"""
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 3, "misses": 1,
+                             "hit_rate": 0.75}
+
+
+def test_lru_cache_expires_entries():
+    """Test for expiring entries after their time to live"""
+    cache = LRUCache(max_size=2, ttl=0.01)
+    assert cache.get_or_compute("a", lambda: 1) == 1
+    assert cache.get_or_compute("a", lambda: 2) == 1
+    time.sleep(0.02)
+    assert cache.get_or_compute("a", lambda: 3) == 3
+
+
+def test_lru_cache_invalid_max_size():
+    """Test for creating a cache with an invalid size"""
+    with pytest.raises(ValueError):
+        LRUCache(max_size=0)
@@ -1,9 +1,12 @@
 """This module is to test functions to generate csr matrix for reviews"""
 
 import numpy as np
+import pandas as pd
 import pytest
+from scipy import sparse as sp
 
-from src.get_csr_matrix import get_csr_matrix
+from src.get_csr_matrix import (append_ratings, get_csr_matrix, index_paths, load_changes,
+                                load_csr_matrix, load_index, save_csr_matrix)
 
 
 def test_get_csr_matrix():
@@ -23,3 +26,112 @@ def test_get_csr_matrix_invalid_review_path():
         get_csr_matrix("data/sample/invalid_reviews.csv", "itemid", "cmtid", "rating_star")
     assert err.type == SystemExit
     assert err.value.code == 1
+
+
+def test_get_csr_matrix_sparse():
+    """Test for encoding reviews straight into a sparse csr matrix"""
+    mat_dense = get_csr_matrix("data/sample/sample_reviews.csv", "itemid",
+                               "cmtid", "rating_star")
+    mat_sparse = get_csr_matrix("data/sample/sample_reviews.csv", "itemid",
+                                "cmtid", "rating_star", sparse=True)
+    assert sp.isspmatrix_csr(mat_sparse)
+    assert mat_sparse.nnz == 10
+    assert np.array_equiv(mat_sparse.toarray(), mat_dense)
+
+
+def test_save_load_csr_matrix_sparse(tmp_path):
+    """Test for saving and loading a sparse csr matrix"""
+    mat = get_csr_matrix("data/sample/sample_reviews.csv", "itemid",
+                         "cmtid", "rating_star", sparse=True)
+    output_path = str(tmp_path / "csr_matrix.npz")
+    save_csr_matrix(mat, output_path)
+    mat_loaded = load_csr_matrix(output_path)
+    assert sp.isspmatrix_csr(mat_loaded)
+    assert (mat_loaded != mat).nnz == 0
+
+
+def test_append_ratings(tmp_path):
+    """Test for appending new reviews to a saved matrix, matching a full rebuild"""
+    reviews = pd.read_csv("data/sample/sample_reviews.csv")
+    base_path, delta_path = str(tmp_path / "base.csv"), str(tmp_path / "delta.csv")
+    reviews.iloc[:6].to_csv(base_path, index=False)
+    delta = reviews.iloc[6:].copy()
+    # one review of a new item and one changed rating of an existing review
+    delta.loc[delta.index[0], "itemid"] = 1
+    changed = reviews.iloc[[0]].assign(rating_star=1)
+    pd.concat([delta, changed]).to_csv(delta_path, index=False)
+
+    csr_mat_path = str(tmp_path / "csr_matrix.npz")
+    mat, item_ids, user_ids = get_csr_matrix(base_path, "itemid", "cmtid", "rating_star",
+                                             sparse=True, return_ids=True)
+    save_csr_matrix(mat, csr_mat_path, item_ids=item_ids, user_ids=user_ids)
+    changed_items = append_ratings(delta_path, csr_mat_path, "itemid", "cmtid", "rating_star")
+
+    item_index, user_index = load_index(csr_mat_path)
+    item_ids, user_ids = item_index.ids, user_index.ids
+    assert np.array_equal(item_index.positions(item_ids), np.arange(len(item_ids)))
+    mat = load_csr_matrix(csr_mat_path)
+    full = pd.concat([reviews.iloc[:6].assign(rating_star=[1, 4, 4, 4, 4, 4]), delta])
+    expected = full.pivot_table(index="itemid", columns="cmtid", values="rating_star",
+                                fill_value=0).loc[item_ids, user_ids]
+    assert np.array_equal(mat.toarray(), expected.to_numpy())
+    assert set(changed_items) == set(delta["itemid"]) | {reviews["itemid"].iloc[0]}
+    assert set(load_changes(csr_mat_path)["items"]) == set(changed_items)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "int8"])
+def test_save_load_csr_matrix_dtype(tmp_path, dtype):
+    """Test for saving a matrix with a smaller dtype and reading float32 ratings back"""
+    rng = np.random.default_rng(0)
+    mat = sp.random(50, 40, density=0.2, format="csr", random_state=0)
+    mat.data = rng.integers(1, 11, mat.nnz) / 2
+    output_path = str(tmp_path / "csr_matrix.npz")
+    save_csr_matrix(mat, output_path, dtype=dtype, check_k=3)
+
+    assert sp.load_npz(output_path).dtype == dtype
+    mat_loaded = load_csr_matrix(output_path)
+    assert mat_loaded.dtype == np.float32
+    # int8 ratings are within half a step of 1/127 of the row maximum
+    assert np.allclose(mat_loaded.toarray(), mat.toarray(), atol=5 / 254 + 1e-6)
+
+    save_csr_matrix(mat, output_path)
+    assert load_csr_matrix(output_path).dtype == np.float64
+    assert not (tmp_path / "csr_matrix_scale.npy").exists()
+
+
+def test_append_ratings_int8(tmp_path):
+    """Test for appending to an int8 matrix without touching the rows that did not change"""
+    reviews = pd.read_csv("data/sample/sample_reviews.csv")
+    base_path, delta_path = str(tmp_path / "base.csv"), str(tmp_path / "delta.csv")
+    reviews.iloc[:6].to_csv(base_path, index=False)
+    # a changed rating, and a review of another item collected again with the same rating
+    same = reviews.iloc[:6][reviews["itemid"].iloc[:6] != reviews["itemid"].iloc[0]].iloc[[0]]
+    pd.concat([reviews.iloc[[0]].assign(rating_star=1), same]).to_csv(delta_path, index=False)
+
+    csr_mat_path = str(tmp_path / "csr_matrix.npz")
+    mat, item_ids, user_ids = get_csr_matrix(base_path, "itemid", "cmtid", "rating_star",
+                                             sparse=True, return_ids=True)
+    save_csr_matrix(mat, csr_mat_path, item_ids=item_ids, user_ids=user_ids, dtype="int8")
+    before = load_csr_matrix(csr_mat_path).toarray()
+    append_ratings(delta_path, csr_mat_path, "itemid", "cmtid", "rating_star")
+
+    assert sp.load_npz(csr_mat_path).dtype == np.int8
+    after = load_csr_matrix(csr_mat_path).toarray()
+    changed_rows = load_changes(csr_mat_path)["rows"]
+    assert list(load_changes(csr_mat_path)["items"]) == [reviews["itemid"].iloc[0]]
+    unchanged = np.setdiff1d(np.arange(len(before)), changed_rows)
+    assert np.array_equal(after[unchanged], before[unchanged])
+    assert np.load(index_paths(csr_mat_path)["scale"]).shape == (len(before),)
+
+
+def test_load_csr_matrix_mmap(tmp_path):
+    """Test for memory-mapping a saved sparse matrix instead of reading it"""
+    mat = sp.random(20, 10, density=0.3, format="csr", random_state=0, dtype=np.float32)
+    save_csr_matrix(mat, str(tmp_path / "csr_matrix.npz"))
+    mapped = load_csr_matrix(str(tmp_path / "csr_matrix.npz"), mmap_mode="r")
+    # read-only memory maps, not copies
+    assert not mapped.data.flags.writeable and not mapped.indices.flags.writeable
+    assert (mapped != mat).nnz == 0
+    # compressed matrices are read into memory
+    sp.save_npz(tmp_path / "compressed.npz", mat)
+    assert (load_csr_matrix(str(tmp_path / "compressed.npz"), mmap_mode="r") != mat).nnz == 0
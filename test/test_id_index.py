@@ -0,0 +1,28 @@
+"""This module is to test the id to position index"""
+
+import numpy as np
+
+from src.id_index import IdIndex
+
+
+def test_id_index_positions():
+    """Test for looking up positions of ids that are not in sorted order"""
+    index = IdIndex(np.array([40, 10, 30]))
+    assert np.array_equal(index.positions(np.array([10, 30, 40, 99, 5])), [1, 2, 0, -1, -1])
+    assert index.position(30) == 2
+    assert index.position(99) is None
+
+
+def test_id_index_extend():
+    """Test for appending only the ids that are not indexed yet"""
+    index = IdIndex(np.array([40, 10])).extend(np.array([30, 10, 20, 30]))
+    assert np.array_equal(index.ids, [40, 10, 20, 30])
+    assert np.array_equal(index.positions(np.array([20, 30])), [2, 3])
+
+
+def test_id_index_save_load(tmp_path):
+    """Test for saving an index and loading it memory-mapped"""
+    IdIndex(np.array([40, 10, 30])).save(str(tmp_path / "items.npy"))
+    index = IdIndex.load(str(tmp_path / "items.npy"))
+    assert isinstance(index.ids, np.memmap)
+    assert index.position(40) == 0
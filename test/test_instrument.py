@@ -0,0 +1,75 @@
+"""This module is to test the instrumentation of pipeline functions"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.instrument import REGISTRY, instrument, profiled, reset_peak_rss, track
+
+
+@instrument("test.double", reads=("input_path",), writes=("output_path",))
+def double(data: pd.DataFrame, input_path: str, output_path: str) -> pd.DataFrame:
+    """Write a dataframe twice over"""
+    doubled = pd.concat([data, data])
+    doubled.to_csv(output_path, index=False)
+    return doubled
+
+
+@instrument("test.chunks")
+def chunks(n_chunks: int):
+    """Yield dataframes of two rows"""
+    for _ in range(n_chunks):
+        yield pd.DataFrame({"a": [1, 2]})
+
+
+def test_instrument_records_rows_and_bytes(tmp_path):
+    """Test for recording the rows and file sizes of a call in the totals"""
+    REGISTRY.clear()
+    input_path = tmp_path / "input.csv"
+    input_path.write_text("a\n1\n")
+    doubled = double(pd.DataFrame({"a": [1, 2, 3]}), input_path=str(input_path),
+                     output_path=str(tmp_path / "output.csv"))
+    totals = REGISTRY.totals()["test.double"]
+    assert len(doubled) == 6
+    assert totals["calls"] == 1 and totals["errors"] == 0
+    assert totals["rows_in"] == 3 and totals["rows_out"] == 6
+    assert totals["bytes_read"] == 4
+    assert totals["bytes_written"] == (tmp_path / "output.csv").stat().st_size
+    assert 'recommender_function_rows_out_total{function="test.double"} 6' \
+        in REGISTRY.render()
+
+
+def test_instrument_generator_and_error():
+    """Test for measuring a generator until it is consumed, and counting errors"""
+    REGISTRY.clear()
+    stream = chunks(3)
+    assert "test.chunks" not in REGISTRY.totals()
+    assert sum(len(chunk) for chunk in stream) == 6
+    assert REGISTRY.totals()["test.chunks"]["rows_out"] == 6
+
+    with pytest.raises(ValueError):
+        with track("test.block"):
+            raise ValueError
+    assert REGISTRY.totals()["test.block"]["errors"] == 1
+
+
+def test_profiled(tmp_path):
+    """Test for saving cProfile statistics of a block"""
+    with profiled(str(tmp_path / "profiles"), "stage"):
+        sum(range(1000))
+    assert (tmp_path / "profiles" / "stage.prof").exists()
+    assert "function calls" in (tmp_path / "profiles" / "stage.txt").read_text()
+
+
+def test_peak_per_call():
+    """Test for measuring the peak memory of each call, and of the calls around it"""
+    if not reset_peak_rss():
+        pytest.skip("The peak resident set size cannot be reset on this platform.")
+    with track("test.outer") as outer:
+        with track("test.big") as big:
+            data = np.ones(2 ** 25)
+            del data
+        with track("test.small") as small:
+            np.ones(2 ** 10).sum()
+    assert big["peak_rss_mb"] - small["peak_rss_mb"] > 200
+    assert outer["peak_rss_mb"] >= big["peak_rss_mb"]
@@ -0,0 +1,59 @@
+"""This module is to test saving models as memory-mapped arrays"""
+
+import os
+
+import numpy as np
+from scipy import sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from src.ann import LSHIndex
+from src.model_store import BruteIndex, load_model, save_model
+from src.similarity import normalize_rows
+
+mat = sp.random(50, 30, density=0.3, format="csr", random_state=0)
+
+
+def test_save_load_brute_model(tmp_path):
+    """Test for loading a brute force model with its matrix memory-mapped"""
+    model = NearestNeighbors(n_neighbors=4, algorithm="brute", metric="cosine").fit(mat)
+    save_model(model, str(tmp_path / "model"))
+    loaded = load_model(str(tmp_path / "model"))
+    assert isinstance(loaded, BruteIndex)
+    assert (loaded.algorithm, loaded.metric, loaded.n_neighbors) == ("brute", "cosine", 4)
+    # read-only memory maps, not copies
+    assert not loaded.items.data.flags.writeable
+    assert np.array_equal(loaded.kneighbors(mat[:5], return_distance=False),
+                          model.kneighbors(mat[:5], return_distance=False))
+    # the normalized matrix and its transpose are saved for the online index
+    assert not loaded.normalized.data.flags.writeable
+    assert np.allclose(loaded.normalized.toarray(), normalize_rows(mat).toarray())
+    assert np.allclose(loaded.normalized_t.toarray(), normalize_rows(mat).T.toarray())
+
+
+def test_save_load_lsh_model(tmp_path):
+    """Test for loading an approximate index that answers queries the same way"""
+    model = LSHIndex(n_neighbors=4, n_tables=4, n_bits=4).fit(mat)
+    save_model(model, str(tmp_path / "model"))
+    loaded = load_model(str(tmp_path / "model"))
+    assert isinstance(loaded.sorted_codes, np.memmap)
+    assert np.array_equal(loaded.kneighbors(mat[:5], return_distance=False),
+                          model.kneighbors(mat[:5], return_distance=False))
+
+
+def test_save_model_swaps_versions(tmp_path):
+    """Test for switching the model path to a new version while the old one is loaded"""
+    model = NearestNeighbors(n_neighbors=4, algorithm="brute", metric="cosine").fit(mat)
+    # a model saved as a plain directory is replaced too
+    (tmp_path / "model").mkdir()
+    (tmp_path / "model" / "metadata.json").write_text("{}")
+    save_model(model, str(tmp_path / "model"))
+    loaded = load_model(str(tmp_path / "model"))
+    for _ in range(3):
+        save_model(model, str(tmp_path / "model"))
+    assert os.path.islink(tmp_path / "model")
+    assert sorted(path.name for path in tmp_path.iterdir()) == [".versions", "model"]
+    # the current version and the one before it
+    assert len(os.listdir(tmp_path / ".versions" / "model")) == 2
+    assert np.array_equal(loaded.kneighbors(mat[:5], return_distance=False),
+                          load_model(str(tmp_path / "model")).kneighbors(
+                              mat[:5], return_distance=False))
@@ -0,0 +1,91 @@
+"""This module is to test saving neighbors in compact form and reading them back"""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from src.neighbor_store import NeighborStore, save_neighbors
+from src.recommend_products import build_recommendations, find_recommendations
+
+
+def make_products() -> pd.DataFrame:
+    """Product data with a duplicated item id, in another order than the matrix rows"""
+    return pd.DataFrame([[30, "Top", "c", 3.0],
+                         [10, "Top", "a", 1.0],
+                         [20, "Crop Top", "b", 2.0],
+                         [10, "Top", "a duplicate", 9.0]],
+                        columns=["product_itemid", "product_category",
+                                 "product_name", "avg_price"])
+
+
+def test_neighbor_store_to_frame(tmp_path):
+    """Test for expanding a saved store into the recommendation table"""
+    product_data = make_products()
+    neighbors, item_ids = np.array([[1, 2], [2, 0], [0, 1]]), np.array([10, 20, 30])
+    scores = np.array([[0.9, 0.5], [0.8, 0.4], [0.7, 0.3]])
+    save_neighbors(neighbors, scores, item_ids, product_data, "product_itemid",
+                   str(tmp_path / "neighbors"))
+
+    store = NeighborStore.load(str(tmp_path / "neighbors"))
+    assert store.indices.dtype == np.int32 and store.scores.dtype == np.float32
+    df_true = build_recommendations(neighbors, item_ids, product_data, "product_itemid")
+    pd.testing.assert_frame_equal(df_true, store.to_frame())
+    pd.testing.assert_frame_equal(df_true, pd.concat(store.iter_frames(3), ignore_index=True))
+
+
+def test_neighbor_store_to_frame_column_order(tmp_path):
+    """Test for expanding the same table as the batch when the id column is not first"""
+    product_data = make_products()[["product_name", "product_itemid", "avg_price"]]
+    neighbors, item_ids = np.array([[1], [2], [0]]), np.array([10, 20, 30])
+    save_neighbors(neighbors, np.ones((3, 1)), item_ids, product_data, "product_itemid",
+                   str(tmp_path / "neighbors"))
+    pd.testing.assert_frame_equal(
+        build_recommendations(neighbors, item_ids, product_data, "product_itemid"),
+        NeighborStore.load(str(tmp_path / "neighbors")).to_frame())
+
+
+def test_neighbor_store_recommend(tmp_path):
+    """Test for joining the metadata of the neighbors of one item"""
+    save_neighbors(np.array([[1, 2], [2, 0], [0, 1]]),
+                   np.array([[0.9, 0.5], [0.8, 0.4], [0.7, 0.3]]),
+                   np.array([10, 20, 30]), make_products(), "product_itemid",
+                   str(tmp_path / "neighbors"))
+    store = NeighborStore.load(str(tmp_path / "neighbors"))
+
+    records = store.recommend(20, k=1)
+    assert records == [{"product_itemid": 30, "product_category": "Top",
+                        "product_name": "c", "avg_price": 3.0, "rank": 1,
+                        "score": pytest.approx(0.8)}]
+    assert [record["product_itemid"] for record in store.recommend(10)] == [20, 30]
+    with pytest.raises(KeyError):
+        store.recommend(40)
+
+
+def test_neighbor_store_missing_product(tmp_path):
+    """Test for returning valid json records for a neighbor with no product row"""
+    save_neighbors(np.array([[1, 2], [2, 0], [0, 1]]),
+                   np.array([[0.9, 0.5], [0.8, 0.4], [0.7, 0.3]]),
+                   np.array([10, 20, 40]), make_products(), "product_itemid",
+                   str(tmp_path / "neighbors"))
+    records = NeighborStore.load(str(tmp_path / "neighbors")).recommend(10)
+    assert records[1]["product_itemid"] == 40
+    assert records[1]["product_name"] is None and records[1]["avg_price"] is None
+    json.dumps(records, allow_nan=False)
+
+
+def test_neighbor_store_distances(tmp_path):
+    """Test for keeping the distances of neighbors found with a metric other than cosine"""
+    mat = np.array([[5.0, 0.0], [4.0, 1.0], [0.0, 3.0]])
+    model = NearestNeighbors(n_neighbors=3, algorithm="brute", metric="euclidean").fit(mat)
+    find_recommendations(mat, model, make_products(), 2, "product_itemid",
+                         item_ids=np.array([10, 20, 30]),
+                         store_path=str(tmp_path / "neighbors"))
+    store = NeighborStore.load(str(tmp_path / "neighbors"))
+    assert store.metric == "euclidean"
+    records = store.recommend(10)
+    assert [record["product_itemid"] for record in records] == [20, 30]
+    assert [record["distance"] for record in records] == pytest.approx([2 ** 0.5, 34 ** 0.5])
+    assert "score" not in records[0]
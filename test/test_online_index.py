@@ -0,0 +1,141 @@
+"""This module is to test the in-memory online recommender"""
+
+import json
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from src.get_csr_matrix import save_csr_matrix
+from src.model_store import save_model
+from src.online_index import OnlineRecommender
+
+
+@pytest.fixture(name="recommender")
+def fixture_recommender(tmp_path):
+    """Write a small product table, matrix and model, and load them"""
+    pd.DataFrame({"product_itemid": [30, 10, 20, 40],
+                  "product_name": ["c", "a", "b", "d"]}) \
+        .to_csv(tmp_path / "products.csv", index=False)
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0],
+                                  [0, 4, 1]], dtype=float))
+    save_csr_matrix(mat, str(tmp_path / "csr_matrix.npz"),
+                    item_ids=np.array([10, 20, 30, 40]), user_ids=np.array([1, 2, 3]))
+    model = NearestNeighbors(n_neighbors=3, algorithm="brute", metric="cosine").fit(mat)
+    joblib.dump(model, tmp_path / "model.joblib")
+    return OnlineRecommender(str(tmp_path / "products.csv"), str(tmp_path / "csr_matrix.npz"),
+                             str(tmp_path / "model.joblib"), "product_itemid")
+
+
+def test_recommend(recommender):
+    """Test for recommending products of an item from the in-memory index"""
+    products = recommender.recommend(10, 2)
+    assert [product["product_itemid"] for product in products] == [20, 40]
+    assert [product["rank"] for product in products] == [1, 2]
+    assert products[0]["product_name"] == "b"
+    assert products[0]["score"] > products[1]["score"]
+
+
+def test_recommend_unknown_item(recommender):
+    """Test for recommending products of an item that is not in the index"""
+    with pytest.raises(KeyError):
+        recommender.recommend(99, 2)
+
+
+def test_recommend_without_saved_index(tmp_path):
+    """Test for refusing to guess the item id of the rows of a matrix saved without them"""
+    pd.DataFrame({"product_itemid": [10, 20]}).to_csv(tmp_path / "products.csv", index=False)
+    mat = sp.csr_matrix(np.array([[5, 0], [4, 1]], dtype=float))
+    sp.save_npz(tmp_path / "csr_matrix.npz", mat)
+    joblib.dump(NearestNeighbors(n_neighbors=2, algorithm="brute", metric="cosine").fit(mat),
+                tmp_path / "model.joblib")
+    with pytest.raises(FileNotFoundError, match="get_csr_matrix"):
+        OnlineRecommender(str(tmp_path / "products.csv"), str(tmp_path / "csr_matrix.npz"),
+                          str(tmp_path / "model.joblib"), "product_itemid")
+
+
+def test_recommend_saved_index(tmp_path):
+    """Test for mapping rows to item ids with the ids saved with the matrix"""
+    pd.DataFrame({"product_itemid": [10, 20, 30, 40, 50],
+                  "product_name": ["a", "b", "c", "d", "e"]}) \
+        .to_csv(tmp_path / "products.csv", index=False)
+    # rows are not in id order, and item 50 has no reviews
+    mat = sp.csr_matrix(np.array([[0, 3, 0],
+                                  [5, 0, 1],
+                                  [4, 0, 0]], dtype=float))
+    save_csr_matrix(mat, str(tmp_path / "csr_matrix.npz"),
+                    item_ids=np.array([40, 10, 20]), user_ids=np.array([1, 2, 3]))
+    model = NearestNeighbors(n_neighbors=3, algorithm="brute", metric="cosine").fit(mat)
+    joblib.dump(model, tmp_path / "model.joblib")
+    recommender = OnlineRecommender(str(tmp_path / "products.csv"),
+                                    str(tmp_path / "csr_matrix.npz"),
+                                    str(tmp_path / "model.joblib"), "product_itemid")
+    assert recommender.position(20) == 2
+    assert recommender.position(50) is None
+    products = recommender.recommend(20, 1)
+    assert products[0]["product_itemid"] == 10
+    assert products[0]["product_name"] == "a"
+
+
+def test_recommend_missing_product(tmp_path):
+    """Test for returning valid json records for a neighbor with no product row"""
+    pd.DataFrame({"product_itemid": [10, 20], "product_name": ["a", "b"],
+                  "avg_price": [1.0, 2.0]}).to_csv(tmp_path / "products.csv", index=False)
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0]], dtype=float))
+    save_csr_matrix(mat, str(tmp_path / "csr_matrix.npz"),
+                    item_ids=np.array([10, 20, 30]), user_ids=np.array([1, 2, 3]))
+    model = NearestNeighbors(n_neighbors=3, algorithm="brute", metric="cosine").fit(mat)
+    joblib.dump(model, tmp_path / "model.joblib")
+    recommender = OnlineRecommender(str(tmp_path / "products.csv"),
+                                    str(tmp_path / "csr_matrix.npz"),
+                                    str(tmp_path / "model.joblib"), "product_itemid")
+    products = recommender.recommend(10, 2)
+    assert products[1]["product_itemid"] == 30
+    assert products[1]["product_name"] is None and products[1]["avg_price"] is None
+    json.dumps(products, allow_nan=False)
+
+
+def test_recommend_model_directory(tmp_path, recommender):
+    """Test for scoring with the normalized matrix memory-mapped from a model directory"""
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0],
+                                  [0, 4, 1]], dtype=float))
+    save_model(NearestNeighbors(n_neighbors=3, algorithm="brute", metric="cosine").fit(mat),
+               str(tmp_path / "model"))
+    mapped = OnlineRecommender(str(tmp_path / "products.csv"),
+                               str(tmp_path / "csr_matrix.npz"),
+                               str(tmp_path / "model"), "product_itemid")
+    assert not mapped.items.data.flags.writeable
+    assert mapped.recommend(10, 3) == recommender.recommend(10, 3)
+
+
+@pytest.mark.parametrize("model_file", ["model.joblib", "model"])
+def test_recommend_distance_metric(tmp_path, recommender, model_file):
+    """Test for answering queries of a model fitted with another metric by its distances"""
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0],
+                                  [0, 4, 1]], dtype=float))
+    model = NearestNeighbors(n_neighbors=3, algorithm="brute", metric="euclidean").fit(mat)
+    if model_file == "model":
+        save_model(model, str(tmp_path / "model"))
+        assert not list((tmp_path / "model").glob("normalized_*"))
+    else:
+        joblib.dump(model, tmp_path / "model.joblib")
+    euclidean = OnlineRecommender(str(tmp_path / "products.csv"),
+                                  str(tmp_path / "csr_matrix.npz"),
+                                  str(tmp_path / model_file), "product_itemid")
+    distances, indices = model.kneighbors(mat[:1], n_neighbors=4)
+    products = euclidean.recommend(10, 3)
+    assert [product["product_itemid"] for product in products] == \
+        [[10, 20, 30, 40][i] for i in indices[0][1:]]
+    assert [product["distance"] for product in products] == pytest.approx(distances[0][1:])
+    assert "score" not in products[0]
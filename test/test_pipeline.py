@@ -0,0 +1,63 @@
+"""This module is to test running the model pipeline in one process"""
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from src.pipeline import run_pipeline
+
+
+def make_config(tmp_path) -> dict:
+    """Point the model configuration at small raw files in a temporary directory"""
+    rng = np.random.default_rng(0)
+    item_ids = np.arange(100, 120)
+    products = pd.DataFrame({
+        "product_itemid": np.tile(item_ids, 2),
+        "product_name": np.tile([f"top {i}" for i in item_ids], 2),
+        "product_category": "Top",
+        **{col: rng.integers(0, 100, 40) for col in
+           ["product_price", "product_discount", "product_like_count",
+            "product_comment_count", "product_views", "product_total_rating", "units_sold"]},
+    })
+    reviews = pd.DataFrame({"cmtid": rng.integers(0, 30, 400),
+                            "itemid": rng.choice(np.append(item_ids, [999]), 400),
+                            "rating_star": rng.integers(1, 6, 400)})
+    products.to_csv(tmp_path / "products.csv", index=False)
+    reviews.to_csv(tmp_path / "reviews.csv", index=False)
+
+    with open("config/model_config.yaml", "r", encoding="ASCII") as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config["preprocess_products"]["get_product_features"]["input_path"] = \
+        str(tmp_path / "products.csv")
+    config["preprocess_reviews"]["get_review_features"]["input_path"] = \
+        str(tmp_path / "reviews.csv")
+    for name, section in config.items():
+        if name == "model":
+            continue
+        for params in section.values():
+            for key, value in params.items():
+                if key.endswith("_path") and str(value).startswith(("data/interim", "models/")):
+                    params[key] = str(tmp_path / value.split("/")[-1])
+    return config
+
+
+def test_run_pipeline(tmp_path):
+    """Test for running every stage without writing interim data"""
+    config = make_config(tmp_path)
+    run_pipeline(config)
+    recommendations = pd.read_csv(tmp_path / "recommendations.csv")
+    assert len(recommendations) == 20 * 7
+    assert (recommendations["input_itemid"] != recommendations["product_itemid"]).all()
+    assert (tmp_path / "model" / "metadata.json").exists()
+    assert not (tmp_path / "processed_products.parquet").exists()
+    assert not (tmp_path / "csr_matrix.npz").exists()
+
+
+def test_run_pipeline_save_interim(tmp_path):
+    """Test for saving the interim data passed between stages"""
+    config = make_config(tmp_path)
+    run_pipeline(config, save_interim=True)
+    for name in ["processed_products.parquet", "processed_reviews.parquet",
+                 "truncated_reviews.parquet", "csr_matrix.npz"]:
+        assert (tmp_path / name).exists()
+    assert 999 not in pd.read_parquet(tmp_path / "truncated_reviews.parquet")["itemid"].values
@@ -192,3 +192,65 @@ def test_get_aggregated_features_no_df():
                                 ["mean", "mean", "sum", "sum", "sum", "mean", "sum"])
     assert err.type == SystemExit
     assert err.value.code == 1
+
+
+def test_get_aggregated_features_streamed():
+    """Test for aggregating product features chunk by chunk"""
+    columns = ["product_itemid", "product_name", "product_category", "product_price",
+               "product_discount", "product_like_count", "product_comment_count",
+               "product_views", "product_total_rating", "units_sold"]
+    agg_args = (["product_itemid", "product_category", "product_name"],
+                ["product_price", "product_discount", "product_like_count",
+                 "product_comment_count", "product_views", "product_total_rating",
+                 "units_sold"],
+                ["avg_price", "avg_discount", "like_count", "comment_count",
+                 "product_views", "avg_rating", "units_sold"],
+                ["mean", "mean", "sum", "sum", "sum", "mean", "sum"])
+    df_true = get_aggregated_features(
+        get_product_features("data/external/2021June-July_product_data.csv", columns),
+        *agg_args)
+    df_results = get_aggregated_features(
+        get_product_features("data/external/2021June-July_product_data.csv", columns,
+                             chunksize=100, dtype={"product_itemid": "int64"}),
+        *agg_args)
+    pd.testing.assert_frame_equal(df_true, df_results, check_dtype=False)
+
+
+def test_get_aggregated_features_renamed_product():
+    """Test for keeping one name of a renamed product and aggregating all of its rows"""
+    df_in = pd.DataFrame({"product_itemid": [2, 1, 2, 1],
+                          "product_name": ["b", "a", "b new", "a"],
+                          "product_category": pd.Categorical(["x", "y", "x", "z"]),
+                          "units_sold": [1, 2, 3, 4]})
+    agg_args = (["product_itemid", "product_category", "product_name"], ["units_sold"],
+                ["units_sold"], ["sum"])
+    df_last = get_aggregated_features(df_in, *agg_args)
+    assert df_last["product_itemid"].tolist() == [1, 2]
+    assert df_last["product_name"].tolist() == ["a", "b new"]
+    assert df_last["product_category"].tolist() == ["z", "x"]
+    assert list(df_last["product_category"].cat.categories) == ["x", "z"]
+    assert df_last["units_sold"].tolist() == [6, 4]
+
+    df_first = get_aggregated_features(df_in, *agg_args, keep="first")
+    assert df_first["product_name"].tolist() == ["a", "b"]
+    assert df_first["product_category"].tolist() == ["y", "x"]
+    streamed = get_aggregated_features((df_in[:1], df_in[1:3], df_in[3:]), *agg_args,
+                                       keep="first")
+    pd.testing.assert_frame_equal(df_first, streamed)
+
+    with pytest.raises(SystemExit):
+        get_aggregated_features(df_in, *agg_args, keep="any")
+
+
+def test_get_product_features_streamed_missing_id(tmp_path):
+    """Test for dropping products with a missing id before parsing ids as int64"""
+    pd.DataFrame({"product_itemid": [1, None, 3], "product_category": ["x", "y", "z"],
+                  "units_sold": [1.0, 2.0, 3.0]}).to_csv(tmp_path / "products.csv",
+                                                         index=False)
+    chunks = get_product_features(str(tmp_path / "products.csv"),
+                                  ["product_itemid", "product_category", "units_sold"],
+                                  chunksize=2, dtype={"product_itemid": "int64",
+                                                      "product_category": "category"})
+    df_results = pd.concat(chunks, ignore_index=True)
+    assert df_results["product_itemid"].tolist() == [1, 3]
+    assert df_results["product_itemid"].dtype == "int64"
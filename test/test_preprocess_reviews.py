@@ -35,3 +35,30 @@ def test_get_review_features_invalid_input_path():
                             columns=["cmtid", "itemid", "rating_star"])
     assert err.type == SystemExit
     assert err.value.code == 1
+
+
+def test_get_review_features_streamed():
+    """Test for getting review features in chunks with compact dtypes"""
+    df_true = get_review_features("data/sample/sample_reviews.csv",
+                                  columns=["cmtid", "itemid", "rating_star"])
+    df_results = get_review_features("data/sample/sample_reviews.csv",
+                                     columns=["cmtid", "itemid", "rating_star"],
+                                     chunksize=3, dtype={"rating_star": "int8"})
+    assert df_results["rating_star"].dtype == "int8"
+    pd.testing.assert_frame_equal(df_true, df_results, check_dtype=False)
+
+
+def test_get_review_features_streamed_missing_values(tmp_path):
+    """Test for dropping reviews with a missing id or rating before the compact dtypes"""
+    pd.DataFrame({"cmtid": [1, 2, 3, 4], "itemid": [10, None, 30, 40],
+                  "rating_star": [5, 4, None, 3]}).to_csv(tmp_path / "reviews.csv",
+                                                          index=False)
+    df_results = get_review_features(str(tmp_path / "reviews.csv"),
+                                     columns=["cmtid", "itemid", "rating_star"],
+                                     chunksize=2,
+                                     dtype={"cmtid": "int64", "itemid": "int64",
+                                            "rating_star": "int8"})
+    assert df_results["cmtid"].tolist() == [1, 4]
+    assert df_results["itemid"].tolist() == [10, 40]
+    assert df_results["itemid"].dtype == "int64"
+    assert df_results["rating_star"].dtype == "int8"
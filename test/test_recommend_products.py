@@ -0,0 +1,54 @@
+"""This module is to test functions to generate recommendations"""
+
+import numpy as np
+import pandas as pd
+
+from src.recommend_products import build_recommendations
+
+
+def test_build_recommendations():
+    """Test for assembling recommendations from neighbor positions"""
+    product_data = pd.DataFrame([[30, "Top", "c", 3.0],
+                                 [10, "Top", "a", 1.0],
+                                 [20, "Crop Top", "b", 2.0],
+                                 [10, "Top", "a duplicate", 9.0]],
+                                columns=["product_itemid", "product_category",
+                                         "product_name", "avg_price"])
+    neighbors = np.array([[1, 2], [2, 0], [0, 1]])
+    df_true = pd.DataFrame([[10, 1, 20, "Crop Top", "b", 2.0],
+                            [10, 2, 30, "Top", "c", 3.0],
+                            [20, 1, 30, "Top", "c", 3.0],
+                            [20, 2, 10, "Top", "a", 1.0],
+                            [30, 1, 10, "Top", "a", 1.0],
+                            [30, 2, 20, "Crop Top", "b", 2.0]],
+                           columns=["input_itemid", "rank", "product_itemid",
+                                    "product_category", "product_name", "avg_price"])
+    df_results = build_recommendations(neighbors, np.array([10, 20, 30]),
+                                       product_data, "product_itemid")
+    pd.testing.assert_frame_equal(df_true, df_results)
+
+
+def test_build_recommendations_column_order():
+    """Test for keeping the product column order when the item id column is not first"""
+    product_data = pd.DataFrame({"product_name": ["a", "b", "c"],
+                                 "product_itemid": [10, 20, 30],
+                                 "avg_price": [1.0, 2.0, 3.0]})
+    neighbors = np.array([[1], [2], [0]])
+    df_results = build_recommendations(neighbors, np.array([10, 20, 30]),
+                                       product_data, "product_itemid")
+    assert df_results.columns.tolist() == ["input_itemid", "rank", "product_name",
+                                           "product_itemid", "avg_price"]
+    assert df_results["product_name"].tolist() == ["b", "c", "a"]
+
+
+def test_build_recommendations_missing_product():
+    """Test for a neighbor that is not in the product data, as after append_ratings"""
+    product_data = pd.DataFrame({"product_itemid": [10, 20], "product_name": ["a", "b"]})
+    neighbors = np.array([[1, 2], [2, 0], [0, 1]])
+    df_results = build_recommendations(neighbors, np.array([10, 20, 30]),
+                                       product_data, "product_itemid")
+    assert df_results["product_itemid"].tolist() == [20, 30, 30, 10, 10, 20]
+    assert df_results["product_name"].isna().tolist() == [False, True, True,
+                                                          False, False, False]
+    # the item is never recommended to itself
+    assert (df_results["input_itemid"] != df_results["product_itemid"]).all()
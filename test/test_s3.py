@@ -0,0 +1,83 @@
+"""This module is to test S3 transfers and streaming against a local stand-in for S3"""
+
+import pandas as pd
+import pytest
+
+from src.preprocess_products import get_product_features
+from src.s3 import (download_file_from_s3, get_client, open_s3_stream, sync_prefix,
+                    upload_file_to_s3)
+from src.table_io import iter_table, read_table
+
+BUCKET = "test-bucket"
+
+
+def test_upload_download_multipart(s3, tmp_path):
+    """Test for round-tripping a file big enough to be sent in several parts"""
+    data = bytes(range(256)) * (6 * 2 ** 12)
+    (tmp_path / "big.bin").write_bytes(data)
+    upload_file_to_s3(str(tmp_path / "big.bin"), f"s3://{BUCKET}/raw/big.bin",
+                      part_size_mb=5, max_concurrency=2)
+    assert s3.head_object(Bucket=BUCKET, Key="raw/big.bin")["ContentLength"] == len(data)
+    download_file_from_s3(str(tmp_path / "copy.bin"), f"s3://{BUCKET}/raw/big.bin",
+                          part_size_mb=5, max_concurrency=2)
+    assert (tmp_path / "copy.bin").read_bytes() == data
+
+
+def test_sync_prefix(s3, tmp_path):
+    """Test for syncing a directory both ways and skipping files already in sync"""
+    source = tmp_path / "interim"
+    (source / "model").mkdir(parents=True)
+    (source / "a.csv").write_text("a\n1\n")
+    (source / "model" / "b.npy").write_bytes(b"12345")
+
+    assert sync_prefix(str(source), f"s3://{BUCKET}/interim", workers=2) == 2
+    assert sync_prefix(str(source), f"s3://{BUCKET}/interim", workers=2) == 0
+    keys = [obj["Key"] for obj in s3.list_objects_v2(Bucket=BUCKET)["Contents"]]
+    assert sorted(keys) == ["interim/a.csv", "interim/model/b.npy"]
+
+    target = tmp_path / "copy"
+    assert sync_prefix(str(target), f"s3://{BUCKET}/interim/", download=True) == 2
+    assert (target / "model" / "b.npy").read_bytes() == b"12345"
+    assert sync_prefix(str(target), f"s3://{BUCKET}/interim/", download=True) == 0
+
+
+def test_stream_csv_from_s3(s3):
+    """Test for reading a csv object in chunks without saving it to local disk"""
+    data = pd.DataFrame({"product_itemid": range(10), "product_name": list("abcdefghij"),
+                         "units_sold": [1.0, None] * 5})
+    s3.put_object(Bucket=BUCKET, Key="raw/products.csv", Body=data.to_csv(index=False))
+    path = f"s3://{BUCKET}/raw/products.csv"
+
+    chunks = list(iter_table(path, ["units_sold", "product_itemid"], chunksize=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert list(chunks[0].columns) == ["units_sold", "product_itemid"]
+    streamed = pd.concat(get_product_features(path, ["product_itemid", "units_sold"],
+                                              chunksize=3))
+    assert streamed["product_itemid"].tolist() == [0, 2, 4, 6, 8]
+    pd.testing.assert_frame_equal(read_table(path), data)
+
+    with pytest.raises(FileNotFoundError):
+        iter_table(f"s3://{BUCKET}/raw/missing.csv", ["units_sold"])
+    with pytest.raises(FileNotFoundError):
+        read_table(f"s3://{BUCKET}/raw/products.parquet")
+
+
+def test_client_pool_size(s3):
+    """Test for sharing clients with a connection pool big enough for each transfer"""
+    assert get_client(1) is get_client()
+    assert get_client(16 * 20).meta.config.max_pool_connections == 320
+    assert get_client(16 * 20) is get_client(320)
+
+
+def test_stream_closed_when_exhausted(s3, monkeypatch):
+    """Test for closing the S3 stream of a chunked reader once it is consumed"""
+    s3.put_object(Bucket=BUCKET, Key="raw/ids.csv", Body="a\n1\n2\n3\n")
+    streams = []
+
+    def open_stream(path):
+        streams.append(open_s3_stream(path))
+        return streams[-1]
+    monkeypatch.setattr("src.table_io.open_s3_stream", open_stream)
+    chunks = iter_table(f"s3://{BUCKET}/raw/ids.csv", ["a"], chunksize=2)
+    assert sum(len(chunk) for chunk in chunks) == 3
+    assert streams[-1]._raw_stream.closed
@@ -0,0 +1,89 @@
+"""This module is to test the blocked top-k similarity engine"""
+
+import numpy as np
+import pytest
+from scipy import sparse as sp
+
+from src.similarity import blocked_top_k, compare_top_k, update_top_k
+
+
+def test_blocked_top_k():
+    """Test for finding top-k neighbors with blocks smaller than the matrix"""
+    mat = sp.csr_matrix(np.array([[5, 0, 1],
+                                  [4, 0, 0],
+                                  [0, 3, 0],
+                                  [0, 4, 1]]))
+    indices_true = np.array([[0, 1], [1, 0], [2, 3], [3, 2]])
+    indices, scores = blocked_top_k(mat, 2, block_size=3)
+    assert np.array_equal(indices, indices_true)
+    assert np.allclose(scores[:, 0], 1)
+    assert np.all(scores[:, 0] >= scores[:, 1])
+
+
+def test_blocked_top_k_streams_to_disk(tmp_path):
+    """Test for streaming blocked top-k results into memory-mapped files"""
+    mat = sp.random(20, 6, density=0.5, format="csr", random_state=0)
+    indices, scores = blocked_top_k(mat, 4, block_size=100)
+    blocked_indices, _ = blocked_top_k(mat, 4, block_size=3,
+                                       neighbors_path=str(tmp_path / "neighbors.npy"),
+                                       scores_path=str(tmp_path / "scores.npy"))
+    assert np.array_equal(indices, blocked_indices)
+    assert np.array_equal(indices, np.load(tmp_path / "neighbors.npy"))
+    assert np.allclose(scores, np.load(tmp_path / "scores.npy"))
+
+
+def test_blocked_top_k_invalid_block_size():
+    """Test for blocked top-k with an invalid block size"""
+    with pytest.raises(ValueError):
+        blocked_top_k(np.eye(3), 2, block_size=0)
+
+
+def test_blocked_top_k_workers():
+    """Test for splitting the top-k search across worker processes"""
+    mat = sp.random(50, 10, density=0.4, format="csr", random_state=1)
+    indices, scores = blocked_top_k(mat, 5, block_size=4)
+    parallel_indices, parallel_scores = blocked_top_k(mat, 5, block_size=4, workers=3)
+    assert np.array_equal(indices, parallel_indices)
+    assert np.array_equal(scores, parallel_scores)
+
+
+def test_update_top_k():
+    """Test for updating neighbors after some items changed, matching a full search"""
+    mat = sp.random(60, 40, density=0.2, format="csr", random_state=1)
+    indices, scores = blocked_top_k(mat, 5, block_size=16)
+    changed = sp.random(60, 40, density=0.2, format="lil", random_state=2)
+    new_mat = mat.tolil()
+    for row in [3, 17, 42]:
+        new_mat[row] = changed[row]
+    new_mat = sp.vstack([new_mat, changed[:4]]).tocsr()
+
+    new_indices, new_scores = update_top_k(new_mat, indices, scores, np.array([3, 17, 42]),
+                                           block_size=16)
+    full_indices, full_scores = blocked_top_k(new_mat, 5, block_size=16)
+    assert np.array_equal(new_indices, full_indices)
+    assert np.allclose(new_scores, full_scores)
+
+
+def test_compare_top_k():
+    """Test for counting the top-k lists that change with a lower precision matrix"""
+    mat = sp.random(40, 30, density=0.3, format="csr", random_state=3)
+    assert compare_top_k(mat, mat.astype(np.float32), 5, sample_size=None) == (40, 0, 0)
+    swapped = mat.tolil()
+    swapped[[0, 1]] = mat[[1, 0]]
+    n_items, n_reordered, n_changed = compare_top_k(mat, swapped.tocsr(), 5, sample_size=None)
+    assert n_items == 40 and n_reordered >= n_changed > 0
+    assert compare_top_k(mat, mat, 5, sample_size=10)[0] == 10
+
+
+
+def test_compare_top_k_sparse_blocks():
+    """Test for comparing sparse matrices block by block without making them dense"""
+    mat = sp.random(40, 30, density=0.5, format="lil", random_state=4)
+    # an item without ratings has no similar items, so its neighbors are filled by position
+    mat[5] = 0
+    mat = mat.tocsr()
+    other = mat.copy()
+    other.data = np.round(other.data, 1)
+    counts = compare_top_k(mat, other, 5, sample_size=None, block_size=7)
+    assert counts == compare_top_k(mat.toarray(), other.toarray(), 5, sample_size=None)
+    assert counts[1] > 0
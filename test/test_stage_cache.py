@@ -0,0 +1,63 @@
+"""This module is to test skipping unchanged model pipeline stages"""
+
+import os
+
+from src.stage_cache import is_up_to_date, record_fingerprint, stage_fingerprint
+
+
+def make_config(tmp_path) -> dict:
+    """Configuration of the preprocess_products stage with files in a temporary directory"""
+    input_path = tmp_path / "products.csv"
+    input_path.write_text("product_itemid\n1\n")
+    return {"preprocess_products": {
+        "get_product_features": {"input_path": str(input_path), "columns": ["product_itemid"]},
+        "get_aggregated_features": {"group_by": ["product_itemid"]},
+        "save_product_data": {"output_path": str(tmp_path / "processed_products.csv")}}}
+
+
+def test_stage_up_to_date(tmp_path):
+    """Test for skipping a stage only once its outputs are saved with a fingerprint"""
+    config = make_config(tmp_path)
+    fingerprint = stage_fingerprint(config, "preprocess_products")
+    assert not is_up_to_date(config, "preprocess_products", fingerprint)
+    (tmp_path / "processed_products.csv").write_text("product_itemid\n1\n")
+    record_fingerprint(config, "preprocess_products", fingerprint)
+    assert is_up_to_date(config, "preprocess_products",
+                         stage_fingerprint(config, "preprocess_products"))
+
+
+def test_stage_input_or_config_changed(tmp_path):
+    """Test for rerunning a stage after its input or its configuration changed"""
+    config = make_config(tmp_path)
+    (tmp_path / "processed_products.csv").write_text("product_itemid\n1\n")
+    record_fingerprint(config, "preprocess_products",
+                       stage_fingerprint(config, "preprocess_products"))
+
+    config["preprocess_products"]["get_aggregated_features"]["group_by"].append("name")
+    assert not is_up_to_date(config, "preprocess_products",
+                             stage_fingerprint(config, "preprocess_products"))
+
+    config = make_config(tmp_path)
+    stat = os.stat(tmp_path / "products.csv")
+    os.utime(tmp_path / "products.csv", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not is_up_to_date(config, "preprocess_products",
+                             stage_fingerprint(config, "preprocess_products"))
+
+
+def test_stage_fingerprint_missing_input(tmp_path):
+    """Test for never skipping a stage whose input is missing"""
+    config = make_config(tmp_path)
+    os.remove(tmp_path / "products.csv")
+    assert stage_fingerprint(config, "preprocess_products") == ""
+    assert not is_up_to_date(config, "preprocess_products", "")
+
+
+def test_stage_output_changed(tmp_path):
+    """Test for rerunning a stage after its output was changed by another action"""
+    config = make_config(tmp_path)
+    output_path = tmp_path / "processed_products.csv"
+    output_path.write_text("product_itemid\n1\n")
+    fingerprint = stage_fingerprint(config, "preprocess_products")
+    record_fingerprint(config, "preprocess_products", fingerprint)
+    output_path.write_text("product_itemid\n1\n2\n")
+    assert not is_up_to_date(config, "preprocess_products", fingerprint)
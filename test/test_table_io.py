@@ -0,0 +1,45 @@
+"""This module is to test functions to read and write table files"""
+
+import pandas as pd
+import pytest
+
+from src.table_io import iter_table, read_table, write_table, write_table_chunks
+
+df_in = pd.DataFrame({"itemid": [3, 1, 2], "name": ["a", "b", "c"], "score": [0.5, 1.5, 2.5]})
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet", ".feather"])
+def test_write_read_table(tmp_path, extension):
+    """Test for a round trip through every table format, reading only some columns"""
+    path = str(tmp_path / f"table{extension}")
+    write_table(df_in, path)
+    pd.testing.assert_frame_equal(read_table(path), df_in)
+    pd.testing.assert_frame_equal(read_table(path, columns=["score", "itemid"]),
+                                  df_in[["score", "itemid"]])
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet", ".feather"])
+def test_iter_table(tmp_path, extension):
+    """Test for reading a table file in chunks with dtypes"""
+    path = str(tmp_path / f"table{extension}")
+    write_table(df_in, path)
+    chunks = list(iter_table(path, columns=["itemid"], chunksize=2, dtype={"itemid": "int32"}))
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert all(chunk["itemid"].dtype == "int32" for chunk in chunks)
+
+
+def test_read_table_non():
+    """Test for unsupported extensions and missing columns"""
+    with pytest.raises(ValueError):
+        read_table("data/sample/sample_products.txt")
+    with pytest.raises(KeyError):
+        read_table("data/sample/sample_products.csv", columns=["not_a_column"])
+
+
+@pytest.mark.parametrize("extension", [".csv", ".parquet", ".feather"])
+def test_write_table_chunks(tmp_path, extension):
+    """Test for writing chunks to one table file as they come"""
+    path = str(tmp_path / f"table{extension}")
+    chunks = (df_in.iloc[start:start + 2] for start in range(0, len(df_in), 2))
+    assert write_table_chunks(chunks, path) == 3
+    pd.testing.assert_frame_equal(read_table(path), df_in)
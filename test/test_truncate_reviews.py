@@ -3,7 +3,7 @@
 import pandas as pd
 import pytest
 
-from src.truncate_reviews import truncate_reviews
+from src.truncate_reviews import save_truncated_review_data, truncate_reviews
 
 
 def test_truncate_reviews():
@@ -40,3 +40,15 @@ def test_truncate_reviews_invalid_review_path():
                          "data/sample/sample_products.csv", "product_itemid")
     assert err.type == SystemExit
     assert err.value.code == 1
+
+
+def test_truncate_reviews_chunks(tmp_path):
+    """Test for streaming truncated review data in chunks to the output file"""
+    df_full = truncate_reviews("data/sample/sample_reviews.csv", "itemid",
+                               "data/sample/sample_products.csv", "product_itemid")
+    chunks = truncate_reviews("data/sample/sample_reviews.csv", "itemid",
+                              "data/sample/sample_products.csv", "product_itemid", chunksize=4)
+    output_path = str(tmp_path / "truncated_reviews.csv")
+    save_truncated_review_data(chunks, output_path)
+    pd.testing.assert_frame_equal(pd.read_csv(output_path),
+                                  df_full.reset_index(drop=True))